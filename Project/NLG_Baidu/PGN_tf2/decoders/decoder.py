@@ -1,6 +1,16 @@
 import tensorflow as tf
 
 
+def _mask_score(score, enc_pad_mask):
+    """
+    pad位置的score加上-1e9，softmax之后attention和copy概率都为0，
+    batch中pad的多少不影响结果
+    score [batch_sz, max_len, 1], enc_pad_mask [batch_sz, max_len]
+    """
+    mask = tf.expand_dims(tf.cast(enc_pad_mask, dtype=score.dtype), axis=2)
+    return score + (1.0 - mask) * -1e9
+
+
 class BahdanauAttention(tf.keras.layers.Layer):
     def __init__(self, units):
         super(BahdanauAttention, self).__init__()
@@ -11,15 +21,27 @@ class BahdanauAttention(tf.keras.layers.Layer):
 
         #  model.keras.layers.Dense
 
-    def __call__(self, dec_hidden, enc_output, enc_pad_mask, use_coverage=False, prev_coverage=None):
+    def encode_keys(self, enc_output):
+        """
+        W_s(enc_output)只和encoder输出有关，每篇文章算一次，传给__call__的enc_features在所有解码步/beam中复用
+        enc_output [batch_sz, max_len_x, enc_units] -> [batch_sz, max_len_x, attn_units]
+        """
+        return self.W_s(enc_output)
+
+    def __call__(self, dec_hidden, enc_output, enc_pad_mask, use_coverage=False, prev_coverage=None,
+                 enc_features=None):
         """
          calculate attention and coverage from dec_hidden enc_output and prev_coverage
          one dec_hidden(word) by one dec_hidden
          dec_hidden or query is [batch_sz, enc_unit], enc_output or values is [batch_sz, max_train_x, enc_units],
          prev_coverage is [batch_sz, max_len_x, 1]
          dec_hidden is initialized as enc_hidden, prev_coverage is initialized as None
+         enc_features is encode_keys(enc_output), computed here when None
+         enc_output/enc_features with batch_sz 1 are broadcast against all dec_hidden rows
          output context_vector [batch_sz, enc_units] attention_weights & coverage [batch_sz, max_len_x, 1]
          """
+        if enc_features is None:
+            enc_features = self.encode_keys(enc_output)
         # hidden shape == (batch_size, hidden size)
         # hidden_with_time_axis shape == (batch_size, 1, hidden size)
         # we are doing this to perform addition to calculate the score
@@ -29,15 +51,11 @@ class BahdanauAttention(tf.keras.layers.Layer):
             # Multiply coverage vector by w_c to get coverage_features.
             # self.W_s(values) [batch_sz, max_len, units] self.W_h(hidden_with_time_axis) [batch_sz, 1, units]
             # self.W_c(prev_coverage) [batch_sz, max_len, units]  score [batch_sz, max_len, 1]
-            score = self.V(tf.nn.tanh(self.W_s(enc_output) + self.W_h(hidden_with_time_axis) + self.W_c(prev_coverage)))
+            score = self.V(tf.nn.tanh(enc_features + self.W_h(hidden_with_time_axis) + self.W_c(prev_coverage)))
             # attention_weights shape (batch_size, max_len, 1)
 
             # attention_weights sha== (batch_size, max_length, 1)
-            mask = tf.cast(enc_pad_mask, dtype=score.dtype)
-            masked_score = tf.squeeze(score, axis=-1) * mask
-            masked_score = tf.expand_dims(masked_score, axis=2)
-
-            attention_weights = tf.nn.softmax(masked_score, axis=1)
+            attention_weights = tf.nn.softmax(_mask_score(score, enc_pad_mask), axis=1)
 
             # attention_weights = masked_attention(enc_pad_mask, attention_weights)
             coverage = attention_weights + prev_coverage
@@ -47,12 +65,9 @@ class BahdanauAttention(tf.keras.layers.Layer):
             # the shape of the tensor before applying self.V is (batch_size, max_length, units)
             # 计算注意力权重值
             score = self.V(tf.nn.tanh(
-                self.W_s(enc_output) + self.W_h(hidden_with_time_axis)))
+                enc_features + self.W_h(hidden_with_time_axis)))
 
-            mask = tf.cast(enc_pad_mask, dtype=score.dtype)
-            masked_score = tf.squeeze(score, axis=-1) * mask
-            masked_score = tf.expand_dims(masked_score, axis=2)
-            attention_weights = tf.nn.softmax(masked_score, axis=1)
+            attention_weights = tf.nn.softmax(_mask_score(score, enc_pad_mask), axis=1)
             # attention_weights = masked_attention(enc_pad_mask, attention_weights)
             if use_coverage:
                 coverage = attention_weights
@@ -67,21 +82,25 @@ class BahdanauAttention(tf.keras.layers.Layer):
 
 
 class Decoder(tf.keras.Model):
-    def __init__(self, vocab_size, embedding_dim, embedding_matrix, dec_units, batch_size):
+    def __init__(self, vocab_size, embedding_dim, embedding_matrix, dec_units, batch_size, embedding_layer=None):
         super(Decoder, self).__init__()
         self.batch_sz = batch_size
         self.dec_units = dec_units
-        self.embedding = tf.keras.layers.Embedding(vocab_size, embedding_dim, weights=[embedding_matrix],
-                                                   trainable=False)
+        # embedding_layer不为None时与encoder/decoder共用同一个Embedding层
+        if embedding_layer is None:
+            embedding_layer = tf.keras.layers.Embedding(vocab_size, embedding_dim, weights=[embedding_matrix],
+                                                        trainable=False)
+        self.embedding = embedding_layer
         self.gru = tf.keras.layers.GRU(self.dec_units,
                                        return_sequences=True,
                                        return_state=True,
                                        recurrent_initializer='glorot_uniform')
         self.fc = tf.keras.layers.Dense(vocab_size, activation=tf.keras.activations.softmax)
 
-    def call(self, dec_input, prev_dec_hidden, enc_output, context_vector):
+    def call(self, dec_input, prev_dec_hidden, enc_output, context_vector, project=True):
         # 使用上次的隐藏层（第一次使用编码器隐藏层）、编码器输出计算注意力权重
         # enc_output shape == (batch_size, max_length, hidden_size)
+        # project=False时不经过fc，直接返回GRU的输出，由loss只对target词计算概率
 
         # x shape after passing through embedding == (batch_size, 1, embedding_dim)
         dec_input = self.embedding(dec_input)
@@ -95,6 +114,9 @@ class Decoder(tf.keras.Model):
         # dec_output shape == (batch_size * 1, hidden_size)
         dec_output = tf.reshape(dec_output, (-1, dec_output.shape[2]))
 
+        if not project:
+            return dec_input, dec_output, dec_hidden
+
         # pred shape == (batch_size, vocab)
         pred = self.fc(dec_output)
         return dec_input, pred, dec_hidden
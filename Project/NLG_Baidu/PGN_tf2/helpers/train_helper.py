@@ -1,27 +1,38 @@
 import tensorflow as tf
 import time
 from PGN_tf2.models.losses import calc_loss
+from utils.train_utils import compile_train_step, train_step_args, distribute_dataset, strategy_scope
+from utils.metrics_utils import TrainMetrics
+from utils.checkpoint_utils import AsyncCheckpointWriter
 import numpy as np
 
+# train_step依次需要的batch字段
+TRAIN_STEP_KEYS = ["enc_input", "extended_enc_input", "max_oov_len",
+                   "dec_input", "dec_target",
+                   "encoder_pad_mask", "decoder_pad_mask"]
 
-def train_model(model, dataset, params, ckpt_manager, vocab):
-    print(vocab)
-    start_index = vocab.word_to_id('<START>')
-    pad_index = vocab.word_to_id('<PAD>')
 
-    optimizer = tf.keras.optimizers.Adagrad(params['learning_rate'],
-                                            initial_accumulator_value=params['adagrad_init_acc'],
-                                            clipnorm=params['max_grad_norm'],
-                                            epsilon=params['eps'])
+def get_optimizer(params):
+    return tf.keras.optimizers.Adagrad(params['learning_rate'],
+                                       initial_accumulator_value=params['adagrad_init_acc'],
+                                       clipnorm=params['max_grad_norm'],
+                                       epsilon=params['eps'])
+
+
+def make_train_step(model, optimizer, params, strategy=None):
+    """
+    返回按TRAIN_STEP_KEYS顺序接收参数的train_step，函数内不做打印，可以直接用tf.function编译
+    strategy不为None时train_step在每个replica上运行，loss按global batch size缩放
+    """
+    global_batch_size = params['batch_size'] if strategy is not None else None
 
-    # @tf.function()
     def train_step(enc_inp, extended_enc_input, max_oov_len,
                    dec_input, dec_target,
                    enc_pad_mask, padding_mask):
         with tf.GradientTape() as tape:
             # 逐个预测序列
-            # encoder
-            enc_output, enc_hidden = model.encoder(enc_inp)
+            # encoder，与batch_beam_decode一样按encoder_pad_mask跳过pad
+            enc_output, enc_hidden = model.encoder(enc_inp, enc_pad_mask)
             dec_hidden = enc_hidden
 
             final_dists, _, attentions, coverages = model(dec_hidden,
@@ -31,13 +42,15 @@ def train_model(model, dataset, params, ckpt_manager, vocab):
                                                           max_oov_len,
                                                           enc_pad_mask=enc_pad_mask,
                                                           use_coverage=params['use_coverage'],
-                                                          prev_coverage=None)
+                                                          prev_coverage=None,
+                                                          dec_target=dec_target)
 
             batch_loss, log_loss, cov_loss = calc_loss(dec_target, final_dists, padding_mask, attentions,
                                                        params['cov_loss_wt'],
                                                        params['use_coverage'],
-                                                       params['model'])
-            print('Batch_Loss: {}, Log_Loss: {}, cov_loss: {}'.format(batch_loss, log_loss, cov_loss))
+                                                       params['model'],
+                                                       params['loss_mode'],
+                                                       global_batch_size)
         variables = model.encoder.trainable_variables + model.decoder.trainable_variables + \
                     model.attention.trainable_variables + model.pointer.trainable_variables
         gradients = tape.gradient(batch_loss, variables)
@@ -45,6 +58,20 @@ def train_model(model, dataset, params, ckpt_manager, vocab):
 
         return batch_loss, log_loss, cov_loss
 
+    return train_step
+
+
+def train_model(model, dataset, params, ckpt_manager, vocab, strategy=None):
+    print(vocab)
+    start_index = vocab.word_to_id('<START>')
+    pad_index = vocab.word_to_id('<PAD>')
+
+    with strategy_scope(strategy):
+        optimizer = get_optimizer(params)
+    train_step = compile_train_step(make_train_step(model, optimizer, params, strategy), dataset, TRAIN_STEP_KEYS,
+                                    params, strategy)
+    metrics = TrainMetrics(params, params['model'])
+
     # max_train_steps = params['max_train_steps']
     best_loss = 100
     for epoch in range(params['epochs']):
@@ -54,19 +81,18 @@ def train_model(model, dataset, params, ckpt_manager, vocab):
         total_log_loss = 0
         total_cov_loss = 0
 
-        for step, batch in enumerate(dataset.take(params['steps_per_epoch'])):
-            enc_batch = batch[0]
-            dec_batch = batch[1]
+        epoch_dataset = distribute_dataset(dataset.take(params['steps_per_epoch']), strategy)
+        for step, batch in enumerate(metrics.timed(epoch_dataset, epoch + 1)):
             print('Step: ', step)
-            batch_loss, log_loss, cov_loss = train_step(enc_batch["enc_input"],
-                                                        enc_batch["extended_enc_input"],
-                                                        enc_batch["max_oov_len"],
-                                                        dec_batch["dec_input"],
-                                                        dec_batch["dec_target"],
-                                                        enc_pad_mask=enc_batch["encoder_pad_mask"],
-                                                        padding_mask=dec_batch["decoder_pad_mask"])
-            total_loss += batch_loss.numpy()
-            total_log_loss += log_loss.numpy()
+            batch_loss, log_loss, cov_loss = train_step(*train_step_args(batch, TRAIN_STEP_KEYS))
+            # loss在图外取值打印
+            batch_loss, log_loss, cov_loss = float(batch_loss), float(log_loss), float(cov_loss)
+            metrics.end_step(batch, batch_loss)
+            if isinstance(ckpt_manager, AsyncCheckpointWriter):
+                ckpt_manager.after_step()
+            print('Batch_Loss: {}, Log_Loss: {}, cov_loss: {}'.format(batch_loss, log_loss, cov_loss))
+            total_loss += batch_loss
+            total_log_loss += log_loss
             total_cov_loss += cov_loss
 
             total_loss = float(format(total_loss, '.4f'))
@@ -94,3 +120,7 @@ def train_model(model, dataset, params, ckpt_manager, vocab):
             # lr = params['learning_rate'] * np.power(0.9, epoch + 1)
             # optimizer = tf.keras.optimizers.Adam(name='Adam', learning_rate=lr)
             # print("learning_rate=", optimizer.get_config()["learning_rate"])
+    metrics.close()
+    if isinstance(ckpt_manager, AsyncCheckpointWriter):
+        # 等待最后一个checkpoint写完
+        ckpt_manager.close()
@@ -9,11 +9,17 @@ class PGN(tf.keras.Model):
         super(PGN, self).__init__()
         self.embedding_matrix = load_word2vec(params, max_vocab_size=params["vocab_size"])
         self.params = params
+        # share_embedding时encoder和decoder共用一个Embedding层，embedding矩阵只保存一份
+        self.embedding = None
+        if params["share_embedding"]:
+            self.embedding = tf.keras.layers.Embedding(params["vocab_size"], params["embed_size"],
+                                                       weights=[self.embedding_matrix], trainable=False)
         self.encoder = encoder.Encoder(vocab_size=params["vocab_size"],
                                        embedding_dim=params["embed_size"],
                                        embedding_matrix=self.embedding_matrix,
                                        enc_units=params["enc_units"],
-                                       batch_size=params["batch_size"])
+                                       batch_size=params["batch_size"],
+                                       embedding_layer=self.embedding)
 
         self.attention = BahdanauAttention(units=params["attn_units"])
 
@@ -21,61 +27,85 @@ class PGN(tf.keras.Model):
                                embedding_dim=params["embed_size"],
                                embedding_matrix=self.embedding_matrix,
                                dec_units=params["dec_units"],
-                               batch_size=params["batch_size"])
+                               batch_size=params["batch_size"],
+                               embedding_layer=self.embedding)
         self.pointer = Pointer()
 
+    def build_variables(self):
+        """
+        用长度为1的输入运行encoder和一步decoder，创建与训练时相同的变量
+        按变量list恢复权重(utils.checkpoint_utils)之前调用
+        """
+        inp = tf.zeros([1, 1], dtype=tf.int32)
+        enc_output, enc_hidden = self.encoder(inp)
+        prev_coverage = tf.zeros([1, 1, 1]) if self.params['use_coverage'] else None
+        self.call_decoder_one_step(inp, enc_hidden, enc_output, inp, 0, tf.ones([1, 1]),
+                                   use_coverage=self.params['use_coverage'], prev_coverage=prev_coverage)
+
     def call_decoder_one_step(self, dec_input, dec_hidden, enc_output, enc_extended_inp, batch_oov_len,
                                   enc_pad_mask,
-                                  use_coverage, prev_coverage):
+                                  use_coverage, prev_coverage, enc_features=None):
+        # enc_features: attention.encode_keys(enc_output)，解码时每篇文章只算一次
         context_vector, attentions, coverage_ret = self.attention(dec_hidden,
                                                                   enc_output,
                                                                   enc_pad_mask,
                                                                   use_coverage,
-                                                                  prev_coverage)
+                                                                  prev_coverage,
+                                                                  enc_features=enc_features)
         dec_x, pred, dec_hidden = self.decoder(dec_input,
                                                dec_hidden,
                                                enc_output,
                                                context_vector)
         if self.params["model"] == 'PGN':
             p_gen = self.pointer(context_vector, dec_hidden, dec_x)
+            # 单步也按[batch_sz, 1, ...]的形式计算，结果为[batch_sz, 1, extended_vsize]
             final_dists = _calc_final_dist(enc_extended_inp,
-                                           [pred],
-                                           [tf.squeeze(attentions, axis=2)],
-                                           [p_gen],
+                                           tf.expand_dims(pred, 1),
+                                           tf.transpose(attentions, [0, 2, 1]),
+                                           tf.expand_dims(p_gen, 1),
                                            batch_oov_len,
-                                           self.params["vocab_size"],
-                                           self.params["batch_size"])
-            return tf.stack(final_dists, 1), dec_hidden, context_vector, tf.squeeze(attentions,
-                                                                                    axis=2), p_gen, coverage_ret
+                                           self.params["vocab_size"])
+            return final_dists, dec_hidden, context_vector, tf.squeeze(attentions, axis=2), p_gen, coverage_ret
         else:
             return pred, dec_hidden, context_vector, attentions, None, coverage_ret
 
     def call(self, dec_hidden, enc_output, dec_inp,
              enc_extended_inp, batch_oov_len,
-             enc_pad_mask, use_coverage, prev_coverage=None):
+             enc_pad_mask, use_coverage, prev_coverage=None, dec_target=None):
+        """
+        teacher forcing运行decoder
+        传入dec_target且loss_mode不是final_dist时，不计算完整的final_dists，
+        第一个返回值是target词的概率 [batch_sz, dec_len]
+        """
+        target_gather = dec_target is not None and self.params["loss_mode"] != "final_dist"
         predictions = []
         attentions = []
         p_gens = []
         coverages = []
 
+        # W_s(enc_output)在所有时间步中相同，只计算一次
+        enc_features = self.attention.encode_keys(enc_output)
         context_vector, _, coverage_ret = self.attention(dec_hidden,
                                                          enc_output,
                                                          enc_pad_mask,
                                                          use_coverage,
-                                                         prev_coverage)
+                                                         prev_coverage,
+                                                         enc_features=enc_features)
         for t in range(dec_inp.shape[1]):
             # decoder
             # using teacher forcing
             dec_x, dec_pred, dec_hidden = self.decoder(tf.expand_dims(dec_inp[:, t], 1),
                                                        dec_hidden,
                                                        enc_output,
-                                                       context_vector)
+                                                       context_vector,
+                                                       project=not target_gather)
 
             context_vector, attn, coverage_ret = self.attention(dec_hidden,
                                                                 enc_output,
                                                                 enc_pad_mask,
                                                                 use_coverage,
-                                                                coverage_ret)
+                                                                coverage_ret,
+                                                                enc_features=enc_features)
 
             p_gen = self.pointer(context_vector, dec_hidden, dec_x)
             coverages.append(coverage_ret)
@@ -83,63 +113,97 @@ class PGN(tf.keras.Model):
             predictions.append(dec_pred)
             p_gens.append(p_gen)
 
+        # attn_dists [batch_sz, dec_len, attn_len]
+        attn_dists = tf.stack(attentions, 1)
+        if target_gather:
+            gold_probs = self._calc_gold_probs(enc_extended_inp,
+                                               tf.stack(predictions, 1),
+                                               attn_dists,
+                                               tf.stack(p_gens, 1),
+                                               dec_target)
+            return gold_probs, dec_hidden, attn_dists, tf.stack(coverages, 1)
+
+        # 所有时间步一次计算，final_dists [batch_sz, dec_len, extended_vsize]
         final_dists = _calc_final_dist(enc_extended_inp,
-                                       predictions,
-                                       attentions,
-                                       p_gens,
+                                       tf.stack(predictions, 1),
+                                       attn_dists,
+                                       tf.stack(p_gens, 1),
                                        batch_oov_len,
-                                       self.params["vocab_size"],
-                                       self.params["batch_size"])
-        if self.params["mode"] == "train":
-            return final_dists, dec_hidden, attentions, tf.stack(coverages, 1)
+                                       self.params["vocab_size"])
+        return final_dists, dec_hidden, attn_dists, tf.stack(coverages, 1)
+
+    def _calc_gold_probs(self, enc_extended_inp, dec_outputs, attn_dists, p_gens, dec_target):
+        """
+        只计算target词在final distribution中的概率，不生成[batch_sz, dec_len, extended_vsize]的张量
+        p(y) = p_gen * P_vocab(y) * (y < vocab_size) + (1 - p_gen) * sum(attn[enc_extended_inp == y])
+        :param dec_outputs: 没有经过fc的decoder输出 [batch_sz, dec_len, dec_units]
+        :param attn_dists: [batch_sz, dec_len, attn_len]
+        :param p_gens: [batch_sz, dec_len, 1]
+        :param dec_target: 扩展词表中的target id [batch_sz, dec_len]
+        :return: [batch_sz, dec_len]
+        """
+        vocab_size = self.params["vocab_size"]
+        fc = self.decoder.fc
+        if not fc.built:
+            fc.build(dec_outputs.shape[-1:])
+
+        # oov的target只能来自copy，生成部分的概率为0，先换成一个合法的id
+        in_vocab = dec_target < vocab_size
+        vocab_target = tf.where(in_vocab, dec_target, tf.zeros_like(dec_target))
+        flat_outputs = tf.reshape(dec_outputs, [-1, dec_outputs.shape[-1]])
+        if self.params["loss_mode"] == "sampled_softmax":
+            # 只对num_sampled个负样本做softmax，P_vocab(y)是采样近似的结果
+            vocab_log_probs = -tf.nn.sampled_softmax_loss(weights=tf.transpose(fc.kernel),
+                                                          biases=fc.bias,
+                                                          labels=tf.reshape(vocab_target, [-1, 1]),
+                                                          inputs=flat_outputs,
+                                                          num_sampled=self.params["num_sampled"],
+                                                          num_classes=vocab_size)
         else:
-            return tf.stack(final_dists, 1), dec_hidden, attentions, tf.stack(coverages, 1)
+            logits = tf.matmul(flat_outputs, fc.kernel) + fc.bias
+            vocab_log_probs = tf.gather(tf.nn.log_softmax(logits), tf.reshape(vocab_target, [-1]), batch_dims=1)
+        vocab_probs = tf.reshape(tf.exp(vocab_log_probs), tf.shape(dec_target))
+        vocab_probs *= tf.cast(in_vocab, vocab_probs.dtype)
+
+        # copy部分: encoder中所有等于target的位置的attention之和
+        copy_mask = tf.equal(tf.expand_dims(enc_extended_inp, 1), tf.expand_dims(dec_target, 2))
+        copy_probs = tf.reduce_sum(attn_dists * tf.cast(copy_mask, attn_dists.dtype), axis=2)
+
+        p_gens = tf.squeeze(p_gens, axis=2)
+        return p_gens * vocab_probs + (1 - p_gens) * copy_probs
 
 
-def _calc_final_dist(_enc_batch_extend_vocab, vocab_dists, attn_dists, p_gens, batch_oov_len, vocab_size, batch_size):
+def _calc_final_dist(_enc_batch_extend_vocab, vocab_dists, attn_dists, p_gens, batch_oov_len, vocab_size):
     """
     Calculate the final distribution, for the pointer-generator model
+    All decoder steps are projected with a single scatter instead of one scatter_nd per step.
     Args:
-    vocab_dists: The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays.
+    _enc_batch_extend_vocab: (batch_size, attn_len) ids of the encoder words in the extended vocabulary
+    vocab_dists: (batch_size, dec_steps, vsize) vocabulary distributions.
                 The words are in the order they appear in the vocabulary file.
-    attn_dists: The attention distributions. List length max_dec_steps of (batch_size, attn_len) arrays
+    attn_dists: (batch_size, dec_steps, attn_len) attention distributions
+    p_gens: (batch_size, dec_steps, 1) generation probabilities
     Returns:
-    final_dists: The final distributions. List length max_dec_steps of (batch_size, extended_vsize) arrays.
+    final_dists: (batch_size, dec_steps, extended_vsize) final distributions.
     """
     # Multiply vocab dists by p_gen and attention dists by (1-p_gen)
-    vocab_dists = [p_gen * dist for (p_gen, dist) in zip(p_gens, vocab_dists)]
-    attn_dists = [(1 - p_gen) * dist for (p_gen, dist) in zip(p_gens, attn_dists)]
+    vocab_dists = p_gens * vocab_dists
+    attn_dists = (1 - p_gens) * attn_dists
 
-    # Concatenate some zeros to each vocabulary dist, to hold the probabilities for in-article OOV words
-    extended_vsize = vocab_size + batch_oov_len  # the maximum (over the batch) size of the extended vocabulary
-    extra_zeros = tf.zeros((batch_size, batch_oov_len))
-    # list length max_dec_steps of shape (batch_size, extended_vsize)
-    vocab_dists_extended = [tf.concat(axis=1, values=[dist, extra_zeros]) for dist in vocab_dists]
+    # Pad the vocabulary dists with zeros to hold the probabilities for in-article OOV words
+    # shape (batch_size, dec_steps, extended_vsize)
+    final_dists = tf.pad(vocab_dists, [[0, 0], [0, 0], [0, batch_oov_len]])
 
     # Project the values in the attention distributions onto the appropriate entries in the final distributions
     # This means that if a_i = 0.1 and the ith encoder word is w, and w has index 500 in the vocabulary,
     # then we add 0.1 onto the 500th entry of the final distribution
-    # This is done for each decoder timestep.
-    # This is fiddly; we use tf.scatter_nd to do the projection
-    batch_nums = tf.range(0, limit=batch_size)  # shape (batch_size)
-    batch_nums = tf.expand_dims(batch_nums, 1)  # shape (batch_size, 1)
-    attn_len = tf.shape(_enc_batch_extend_vocab)[1]  # number of states we attend over
-    batch_nums = tf.tile(batch_nums, [1, attn_len])  # shape (batch_size, attn_len)
-    indices = tf.stack((batch_nums, _enc_batch_extend_vocab), axis=2)  # shape (batch_size, enc_t, 2)
-    shape = [batch_size, extended_vsize]
-    # list length max_dec_steps (batch_size, extended_vsize)
-    attn_dists_projected = [tf.scatter_nd(indices, copy_dist, shape) for copy_dist in attn_dists]
-
-    # Add the vocab distributions and the copy distributions together to get the final distributions
-    # final_dists is a list length max_dec_steps; each entry is a tensor shape (batch_size, extended_vsize) giving
-    # the final distribution for that decoder timestep
+    # indices (batch_size, dec_steps, attn_len, 3) of (batch, step, extended vocab id)
+    attn_shape = tf.shape(attn_dists)
+    batch_nums = tf.broadcast_to(tf.range(attn_shape[0])[:, None, None], attn_shape)
+    step_nums = tf.broadcast_to(tf.range(attn_shape[1])[None, :, None], attn_shape)
+    vocab_ids = tf.broadcast_to(tf.expand_dims(_enc_batch_extend_vocab, 1), attn_shape)
+    indices = tf.stack((batch_nums, step_nums, vocab_ids), axis=3)
+
+    # Add the copy distributions onto the vocab distributions in place
     # Note that for decoder timesteps and examples corresponding to a [PAD] token, this is junk - ignore.
-    # print('%'*30)
-    # import numpy as  np
-    # print(np.array(vocab_dists_extended).shape)
-    # print(np.array(attn_dists_projected).shape)
-    # print('%' * 30)
-    final_dists = [vocab_dist + copy_dist for (vocab_dist, copy_dist) in
-                   zip(vocab_dists_extended, attn_dists_projected)]
-
-    return final_dists
+    return tf.tensor_scatter_nd_add(final_dists, indices, attn_dists)
@@ -24,70 +24,85 @@ def loss_function(real, pred, padding_mask):
 #     return tf.reduce_mean(loss_)
 
 
-def calc_loss(real, pred, padding_mask, attentions, cov_loss_wt, use_coverage, model):
+def calc_loss(real, pred, padding_mask, attentions, cov_loss_wt, use_coverage, model, loss_mode='final_dist',
+              global_batch_size=None):
+    """
+    :param pred: loss_mode为final_dist时是final_dists [batch_size, dec_steps, extended_vsize]，
+                 target_gather/sampled_softmax时是PGN直接算出的target词概率 [batch_size, dec_steps]
+    :param attentions: 所有时间步的attention分布 [batch_size, dec_steps, attn_len]
+    :param global_batch_size: 分布式训练时所有replica的总batch size，每个replica的loss除以它，
+                              replica间求和后等于整个global batch的平均值；为None时对当前batch求平均
+    """
     if model == 'PGN':
-        log_loss = pgn_log_loss_function(real, pred, padding_mask)
+        if loss_mode == 'final_dist':
+            log_loss = pgn_log_loss_function(real, pred, padding_mask, global_batch_size)
+        else:
+            log_loss = gold_probs_log_loss(pred, padding_mask, global_batch_size)
     else:
         log_loss = loss_function(real, pred, padding_mask)
 
     if use_coverage:
-        cov_loss = _coverage_loss(attentions, padding_mask)
+        # 每个replica只用自己的attention计算coverage loss
+        cov_loss = _coverage_loss(attentions, padding_mask, global_batch_size)
         return log_loss + cov_loss_wt * cov_loss, log_loss, cov_loss
     else:
         return log_loss, 0, 0
 
 
-def pgn_log_loss_function(real, final_dists, padding_mask):
-    # Calculate the loss per step
-    # This is fiddly; we use tf.gather_nd to pick out the probabilities of the gold target words
-    loss_per_step = []  # will be list length max_dec_steps containing shape (batch_size)
-    batch_nums = tf.range(0, limit=real.shape[0])  # shape (batch_size)
-    for dec_step, dist in enumerate(final_dists):
-        # The indices of the target words. shape (batch_size)
-        targets = real[:, dec_step]
-        indices = tf.stack((batch_nums, targets), axis=1)  # shape (batch_size, 2)
-        # a = dist[:, 2009]
-        gold_probs = tf.gather_nd(dist, indices)  # shape (batch_size). prob of correct words on this step
-        losses = -tf.math.log(tf.clip_by_value(gold_probs, 1e-8, 1.0))   # limit the prediction distribution to 1e-8 to 1 (prevent inf loss value)
-        loss_per_step.append(losses)
+def pgn_log_loss_function(real, final_dists, padding_mask, global_batch_size=None):
+    # final_dists (batch_size, dec_steps, extended_vsize)
+    # pick out the probabilities of the gold target words for all steps at once, shape (batch_size, dec_steps)
+    gold_probs = tf.gather(final_dists, real, batch_dims=2)
+    return gold_probs_log_loss(gold_probs, padding_mask, global_batch_size)
+
+
+def gold_probs_log_loss(gold_probs, padding_mask, global_batch_size=None):
+    # gold_probs (batch_size, dec_steps), prob of correct words on each step
+    # limit the prediction distribution to 1e-8 to 1 (prevent inf loss value)
+    losses = -tf.math.log(tf.clip_by_value(gold_probs, 1e-8, 1.0))
     # Apply dec_padding_mask and get loss
-    _loss = _mask_and_avg(loss_per_step, padding_mask)
+    _loss = _mask_and_avg(losses, padding_mask, global_batch_size)
     return _loss
 
 
-def _mask_and_avg(values, padding_mask):
+def _mask_and_avg(values, padding_mask, global_batch_size=None):
     """Applies mask to values then returns overall average (a scalar)
 
     Args:
-      values: a list length max_dec_steps containing arrays shape (batch_size).
+      values: tensor shape (batch_size, max_dec_steps).
       padding_mask: tensor shape (batch_size, max_dec_steps) containing 1s and 0s.
+      global_batch_size: if not None, sum the per example values and divide by it instead of averaging
+        over this batch, so that summing the result over all replicas gives the global batch average.
 
     Returns:
       a scalar
     """
-    padding_mask = tf.cast(padding_mask, dtype=values[0].dtype)
+    padding_mask = tf.cast(padding_mask, dtype=values.dtype)
     dec_lens = tf.reduce_sum(padding_mask, axis=1)  # shape batch_size. float32
-    values_per_step = [v * padding_mask[:, dec_step] for dec_step, v in enumerate(values)]
-    values_per_ex = sum(values_per_step) / dec_lens  # shape (batch_size); normalized value for each batch member
+    values_per_ex = tf.reduce_sum(values * padding_mask, axis=1) / dec_lens  # normalized value for each batch member
+    if global_batch_size is not None:
+        return tf.reduce_sum(values_per_ex) / global_batch_size
     return tf.reduce_mean(values_per_ex)  # overall average
 
 
-def _coverage_loss(attn_dists, padding_mask):
+def _coverage_loss(attn_dists, padding_mask, global_batch_size=None):
     """Calculates the coverage loss from the attention distributions.
 
+    All decoder steps are computed at once, the graph size does not depend on max_dec_steps.
+
     Args:
-      attn_dists: The attention distributions for each decoder timestep. A list length max_dec_steps containing shape (batch_size, attn_length)
+      attn_dists: The attention distributions for each decoder timestep, shape (batch_size, max_dec_steps, attn_length)
       padding_mask: shape (batch_size, max_dec_steps).
+      global_batch_size: see _mask_and_avg.
 
     Returns:
       coverage_loss: scalar
     """
-    coverage = tf.zeros_like(attn_dists[0])  # shape (batch_size, attn_length). Initial coverage is zero.
-    # Coverage loss per decoder time step. Will be list length max_dec_steps containing shape (batch_size).
-    covlosses = []
-    for a in attn_dists:
-        covloss = tf.reduce_sum(tf.minimum(a, coverage), [1])  # calculate the coverage loss for this step
-        covlosses.append(covloss)
-        coverage += a  # update the coverage vector
-    coverage_loss = _mask_and_avg(covlosses, padding_mask)
+    if isinstance(attn_dists, (list, tuple)):
+        attn_dists = tf.stack(attn_dists, axis=1)
+    # coverage before each step is the sum of the attention of all previous steps, zero at the first step
+    coverage = tf.cumsum(attn_dists, axis=1, exclusive=True)
+    # Coverage loss per decoder time step, shape (batch_size, max_dec_steps)
+    covlosses = tf.reduce_sum(tf.minimum(attn_dists, coverage), axis=2)
+    coverage_loss = _mask_and_avg(covlosses, padding_mask, global_batch_size)
     return coverage_loss
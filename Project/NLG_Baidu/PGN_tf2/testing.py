@@ -1,8 +1,11 @@
+import time
+
 import tensorflow as tf
 from PGN_tf2.models.PGN import PGN
 from utils.batcher_utils import batcher
-from utils.embedding import Vocab
-from PGN_tf2.helpers.test_helper import beam_decode
+from utils.embedding import create_vocab
+from utils.checkpoint_utils import restore_weights
+from PGN_tf2.helpers.test_helper import beam_decode, batch_beam_decode
 from tqdm import tqdm
 import pandas as pd
 
@@ -10,29 +13,47 @@ import pandas as pd
 def test(params):
     global model, ckpt, checkpoint_dir
     assert params['mode'].lower() == 'test', "change training mode to 'test' or 'eval'"
-    assert params['beam_size'] == params['batch_size'], "Beam size must be same as batch_size"
+    if not params['batch_beam_decode']:
+        assert params['beam_size'] == params['batch_size'], "Beam size must be same as batch_size"
     assert params['model'] == 'PGN', 'Please change the model to PGN'
 
     print('Building the model....')
     model = PGN(params)
 
     print('Creating vocab.....')
-    vocab = Vocab(params['vocab_path'], params['vocab_size'])
+    vocab = create_vocab(params)
 
     print('Creating the batcher...')
     batch = batcher(vocab, params)
 
     print('Creating the checkpoint manager.......')
-    checkpoint_dir = '{}/checkpoint'.format(params['PGN_model_dir'])
-    ckpt = tf.train.Checkpoint(step=tf.Variable(0), PGN=model)
-    ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=5)
-    ckpt.restore(ckpt_manager.latest_checkpoint)
-    if ckpt_manager.latest_checkpoint:
+    if params['async_checkpoint']:
+        # AsyncCheckpointWriter保存的变量list
+        model.build_variables()
+        latest_checkpoint = restore_weights(model, '{}/async_checkpoint'.format(params['PGN_model_dir']),
+                                            use_ema=params['restore_ema'])
+    else:
+        checkpoint_dir = '{}/checkpoint'.format(params['PGN_model_dir'])
+        ckpt = tf.train.Checkpoint(step=tf.Variable(0), PGN=model)
+        ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=5)
+        ckpt.restore(ckpt_manager.latest_checkpoint)
+        latest_checkpoint = ckpt_manager.latest_checkpoint
+    if latest_checkpoint:
         print('Model restored')
     else:
         print('Initializing from scratch')
 
     result = []
+    if params['batch_beam_decode']:
+        # 每个batch放batch_size篇文章，解码整个测试集
+        start_time = time.time()
+        for b in tqdm(batch):
+            result.extend(batch_beam_decode(model, b, vocab, params))
+        elapsed = time.time() - start_time
+        print('decoded {} articles in {:.1f}s, {:.2f} articles/sec'.format(len(result), elapsed,
+                                                                        len(result) / elapsed))
+        return result
+
     test_step = 0
     for b in batch:
         if test_step < 10:
@@ -53,7 +74,7 @@ def test_and_save(params):
 
 def save_predict_result(result, params):
     test_df = pd.read_csv(params['test_df_dir'])
-    test_df = test_df.loc[:9]
+    test_df = test_df.loc[:len(result) - 1]
     test_df['Prediction'] = result
     test_df = test_df[['QID', 'Prediction']]
     print('Prediction result: ', test_df)
@@ -1,7 +1,9 @@
 import tensorflow as tf
 from PGN_tf2.models.PGN import PGN
 from utils.batcher_utils import batcher
-from utils.embedding import Vocab
+from utils.embedding import create_vocab
+from utils.checkpoint_utils import AsyncCheckpointWriter
+from utils.train_utils import get_strategy, strategy_scope
 from PGN_tf2.helpers.train_helper import train_model
 
 
@@ -10,18 +12,26 @@ def train(params):
     assert params["mode"].lower() == "train", "change training mode to 'train'"
     assert params['model'] == "PGN", "change model to PGN to train"
 
-    vocab = Vocab(params["vocab_path"], params["vocab_size"])
+    vocab = create_vocab(params)
     print('true vocab is ', vocab)
 
     print("Creating the batcher ...")
     batch = batcher(vocab, params)
     print("Building the model ...")
-    if params["model"] == "PGN":
-        model = PGN(params)
+    strategy = get_strategy(params)
+    with strategy_scope(strategy):
+        if params["model"] == "PGN":
+            model = PGN(params)
+        if strategy is not None:
+            # 所有变量都在strategy.scope()中创建
+            model.build_variables()
     # elif params["model"] == "PGN":
     #     model = PGN(params)
 
     print("Creating the checkpoint manager")
+    if params["async_checkpoint"]:
+        train_model(model, batch, params, _async_checkpoint_writer(model, params), vocab, strategy)
+        return
 
     if params["model"] == "PGN":
         checkpoint_dir = "{}/checkpoint".format(params["PGN_model_dir"])
@@ -36,7 +46,21 @@ def train(params):
         print("Initializing from scratch.")
 
     print("Starting the training ...")
-    train_model(model, batch, params, ckpt_manager, vocab)
+    train_model(model, batch, params, ckpt_manager, vocab, strategy)
+
+
+def _async_checkpoint_writer(model, params):
+    """
+    后台写checkpoint，只保存可训练的变量(和滑动平均)，保存在async_checkpoint目录
+    """
+    model.build_variables()
+    writer = AsyncCheckpointWriter(model, "{}/async_checkpoint".format(params["PGN_model_dir"]),
+                                   max_to_keep=5, ema_decay=params["ema_decay"])
+    if writer.restore():
+        print("Restored from {}".format(writer.latest_checkpoint))
+    else:
+        print("Initializing from scratch.")
+    return writer
 
 
 if __name__ == '__main__':
@@ -5,6 +5,10 @@
 #
 ######################################################
 
+import json
+import os
+from multiprocessing import Pool, cpu_count
+
 import numpy as np
 import pandas as pd
 import re
@@ -13,6 +17,14 @@ import jieba
 
 
 REMOVE_WORDS = ['|', '[', ']', '语音', '图片']
+USER_DICT_PATH = "C:\\workspace\\06_NLP\\02_src\\userDict.txt"
+# y分词后为空时写入的默认内容
+EMPTY_REPORT = "随时 联系"
+
+# 当前进程已经加载的用户词典
+_loaded_user_dict = None
+# 分词子进程中的停用词，由_init_worker设置
+_worker_stopwords = set()
 
 
 def read_stopwords(path):
@@ -31,9 +43,24 @@ def remove_words(words_list):
     return words_list
 
 
+def load_user_dict(user_dict_path=USER_DICT_PATH):
+    """
+    加载jieba用户词典，每个进程只加载一次
+    """
+    global _loaded_user_dict
+    if _loaded_user_dict == user_dict_path:
+        return
+    if user_dict_path and os.path.exists(user_dict_path):
+        jieba.load_userdict(user_dict_path)
+    else:
+        print('user dict {} not found, segment without it'.format(user_dict_path))
+    _loaded_user_dict = user_dict_path
+
+
 # 分词处理
 def segment(sentence, cut_type='word', pos=False):
-    jieba.load_userdict("C:\\workspace\\06_NLP\\02_src\\userDict.txt")
+    if _loaded_user_dict is None:
+        load_user_dict()
     if pos:
         if cut_type == 'word':
             word_pos_seq = posseg.lcut(sentence)
@@ -85,61 +112,107 @@ def parse_data(train_path, test_path):
     return train_x, train_y, test_x, test_y
 
 
-def save_data(data_1, data_2, data_3, data_path_1, data_path_2, data_path_3, stop_words_path):
+def clean_line(line, stopwords, is_target=False):
+    """
+    分词并去掉停用词，x还要去掉REMOVE_WORDS
+    :param is_target: 是否是y(Report)
+    :return: 空格拼接的分词结果；x为空时返回None(不是有效样本)，y为空时返回EMPTY_REPORT
+    """
+    seg_list = segment(line.strip(), cut_type='word')
+    if not is_target:
+        seg_list = remove_words(seg_list)
+    # 考虑stopwords
+    seg_list = [word for word in seg_list if word not in stopwords]
+    # 如果不为空，才是一个有效的样本
+    if len(seg_list) > 0:
+        return ' '.join(seg_list)
+    return EMPTY_REPORT if is_target else None
+
+
+def _init_worker(user_dict_path, stopwords):
+    # 每个子进程启动时加载一次用户词典和停用词
+    global _worker_stopwords
+    load_user_dict(user_dict_path)
+    _worker_stopwords = stopwords
+
+
+def _clean_chunk(args):
+    lines, is_target = args
+    # 不是string的行直接跳过
+    return [clean_line(line, _worker_stopwords, is_target) if isinstance(line, str) else None for line in lines]
+
+
+def _save_progress(progress_path, progress):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+def segment_to_file(pool, data, save_path, is_target, chunk_size=1000, resume=True):
+    """
+    用进程池按chunk分词，按原顺序边分词边写入save_path
+    每写完一个chunk在save_path.progress中记录进度，中断后重新运行会从记录的位置继续
+    :param pool: 已初始化(_init_worker)的进程池
+    :param data: 原始文本，list或者pandas Series
+    :param is_target: 是否是y(Report)
+    :return: 写入的行数
+    """
+    data = list(data)
+    num_chunks = (len(data) + chunk_size - 1) // chunk_size
+    progress_path = save_path + '.progress'
+    progress = {"num_rows": len(data), "chunk_size": chunk_size, "chunks_done": 0, "lines_written": 0, "offset": 0}
+    if resume and os.path.exists(progress_path) and os.path.exists(save_path):
+        with open(progress_path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        # 数据或chunk大小变了，之前的进度没有意义，重新开始
+        if saved["num_rows"] == progress["num_rows"] and saved["chunk_size"] == chunk_size:
+            progress = saved
+            print('resume {} from chunk {}/{}'.format(save_path, progress["chunks_done"], num_chunks))
+
+    tasks = ((data[i * chunk_size:(i + 1) * chunk_size], is_target)
+             for i in range(progress["chunks_done"], num_chunks))
+    # 二进制方式写入，offset是准确的字节位置，续跑时截掉最后一个没有记录进度的chunk
+    with open(save_path, 'r+b' if progress["offset"] else 'wb') as f:
+        f.seek(progress["offset"])
+        f.truncate()
+        for chunk_id, results in enumerate(pool.imap(_clean_chunk, tasks), progress["chunks_done"]):
+            lines = [line for line in results if line is not None]
+            if lines:
+                f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            f.flush()
+            progress["chunks_done"] = chunk_id + 1
+            progress["lines_written"] += len(lines)
+            progress["offset"] = f.tell()
+            _save_progress(progress_path, progress)
+
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    return progress["lines_written"]
+
+
+def save_data(data_1, data_2, data_3, data_path_1, data_path_2, data_path_3, stop_words_path,
+              user_dict_path=USER_DICT_PATH, num_workers=None, chunk_size=1000, resume=True):
+    """
+    多进程分词并保存train_x, train_y, test_x
+    :param num_workers: 进程数，默认为cpu核数
+    :param chunk_size: 每个任务包含的行数
+    :param resume: 是否从上次中断的位置继续
+    """
     stopwords = read_stopwords(stop_words_path)
 
-    # 存储训练用的x的部分。 data_path_1
-    with open(data_path_1, 'w', encoding='utf-8') as f1:
-        # 计数，用来检验x和y的长度是否相同
-        count_1 = 0
-        for line in data_1:
-            # 判断此行内容是否为string类型
-            if isinstance(line, str):
-                # 拿到每一行时，一般都加上strip函数，去除结尾的'\n'
-                seg_list = segment(line.strip(), cut_type='word')
-                seg_list = remove_words(seg_list)
-                # 考虑stopwords
-                seg_list = [word for word in seg_list if word not in stopwords]
-                # 如果不为空，才是一个有效的样本
-                if len(seg_list) > 0:
-                    seg_line = ' '.join(seg_list)
-                    f1.write('%s' % seg_line)
-                    f1.write('\n')
-                    count_1 += 1
+    with Pool(processes=num_workers or cpu_count(), initializer=_init_worker,
+              initargs=(user_dict_path, stopwords)) as pool:
+        # 存储训练用的x的部分。 data_path_1
+        count_1 = segment_to_file(pool, data_1, data_path_1, False, chunk_size, resume)
         print('train_x_length is ', count_1)
 
-    # 存储训练用的y的部分。 data_path_2
-    with open(data_path_2, 'w', encoding='utf-8') as f2:
-        count_2 = 0
-        for line in data_2:
-            if isinstance(line, str):
-                seg_list = segment(line.strip(), cut_type='word')
-                # seg_list = remove_words(seg_list)
-                seg_list = [word for word in seg_list if word not in stopwords]
-                if len(seg_list) > 0:
-                    seg_line = ' '.join(seg_list)
-                    f2.write('%s' % seg_line)
-                    f2.write('\n')
-                else:
-                    f2.write("随时 联系")
-                    f2.write('\n')
-                    # print('11111')
-                count_2 += 1
+        # 存储训练用的y的部分。 data_path_2，分词为空的写入EMPTY_REPORT
+        count_2 = segment_to_file(pool, data_2, data_path_2, True, chunk_size, resume)
         print('train_y_length is ', count_2)
 
-    # 存储Test用的y的部分。 data_path_3
-    with open(data_path_3, 'w', encoding='utf-8') as f3:
-        count_3 = 0
-        for line in data_3:
-            if isinstance(line, str):
-                seg_list = segment(line.strip(), cut_type='word')
-                seg_list = remove_words(seg_list)
-                seg_list = [word for word in seg_list if word not in stopwords]
-                if len(seg_list) > 0:
-                    seg_line = ' '.join(seg_list)
-                    f3.write('%s' % seg_line)
-                    f3.write('\n')
-                    count_3 += 1
+        # 存储Test用的x的部分。 data_path_3
+        count_3 = segment_to_file(pool, data_3, data_path_3, False, chunk_size, resume)
         print('test_y_length is ', count_3)
 
 
@@ -1,4 +1,7 @@
-from collections import defaultdict
+import math
+import os
+from collections import Counter, defaultdict
+from multiprocessing import Pool, cpu_count
 
 
 def save_word_dict(vocab, save_path):
@@ -8,20 +11,72 @@ def save_word_dict(vocab, save_path):
             f.write("%s\t%d\n" % (w, i))
 
 
-def read_data(path_1, path_2, path_3):
-    with open(path_1, 'r', encoding='utf-8') as f1, \
-            open(path_2, 'r', encoding='utf-8') as f2, \
-            open(path_3, 'r', encoding='utf-8') as f3:
-        words = []
-        for line in f1:
-            words += line.split(' ')
+def save_vocab(words, save_path):
+    """
+    按Vocab.load_vocab读取的格式保存词典，每行为"index\tword"
+    """
+    with open(save_path, 'w', encoding='utf-8') as f:
+        for i, w in enumerate(words):
+            f.write("%d\t%s\n" % (i, w))
+
 
-        for line in f2:
-            words += line.split(' ')
+def _file_ranges(paths, num_ranges):
+    # 把每个文件按字节切成num_ranges段，每个进程统计一段
+    ranges = []
+    for path in paths:
+        size = os.path.getsize(path)
+        step = max(1, math.ceil(size / num_ranges))
+        ranges += [(path, start, min(start + step, size)) for start in range(0, size, step)]
+    return ranges
+
+
+def _count_range(args):
+    """
+    统计文件中[start, end)字节范围内的词频，一行属于它第一个字节所在的范围
+    """
+    path, start, end = args
+    counter = Counter()
+    with open(path, 'rb') as f:
+        if start > 0:
+            # 跳到start之后的第一个行首，上一段会读完跨越start的那一行
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            words = [w.strip() for w in line.decode('utf-8').split(' ')]
+            counter.update(w for w in words if w)
+    return counter
 
-        for line in f3:
-            words += line.split(' ')
 
+def count_words(paths, num_workers=None):
+    """
+    多进程流式统计分词文件的词频，每个进程一个Counter，最后合并
+    内存只和不同词的数量有关，与语料大小无关
+    :param paths: 分词后的文件，词之间用空格分隔
+    :param num_workers: 进程数，默认为cpu核数
+    """
+    num_workers = num_workers or cpu_count()
+    counter = Counter()
+    with Pool(processes=num_workers) as pool:
+        for range_counter in pool.imap_unordered(_count_range, _file_ranges(paths, num_workers)):
+            counter.update(range_counter)
+    return counter
+
+
+def build_vocab_from_counter(counter, min_count=0, max_size=None):
+    """
+    按词频从高到低生成词表，词频相同时按词排序，保证结果稳定
+    :param counter: 词频
+    :param min_count: 词典最小频次
+    :param max_size: 词典最大词数
+    :return: list: words
+    """
+    items = sorted(counter.items(), key=lambda d: (-d[1], d[0]))
+    words = [w for w, count in items if count >= min_count]
+    if max_size:
+        words = words[:max_size]
     return words
 
 
@@ -65,8 +120,8 @@ def build_vocab(items, sort=True, min_count=0, lower=False):
 
 
 if __name__ == '__main__':
-    lines = read_data('../data/train_set.seg_x.txt',
-                      '../data/train_set.seg_y.txt',
-                      '../data/test_set.seg_x.txt')
-    vocab, reverse_vocab = build_vocab(lines)
-    save_word_dict(vocab, '../data/vocab.txt')
+    word_counter = count_words(['../data/train_set.seg_x.txt',
+                                '../data/train_set.seg_y.txt',
+                                '../data/test_set.seg_x.txt'])
+    vocab_words = build_vocab_from_counter(word_counter)
+    save_vocab(vocab_words, '../data/vocab.txt')
@@ -6,6 +6,11 @@ import seq2seq_tf2.training as seq2seq_training
 import seq2seq_tf2.testing as seq2seq_testing
 import PGN_tf2.training as PGN_training
 import PGN_tf2.testing as PGN_testing
+from utils.embedding import ArrayVocab, create_vocab
+from utils.shard_utils import compile_shards
+from utils.data_utils import save_embedding_matrix
+from utils.benchmark_utils import benchmark_batcher, benchmark_padding, benchmark_train_step, benchmark_vocab
+from utils.serve_utils import serve
 import pathlib
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -30,6 +35,8 @@ def main():
                         help="beam size for beam search decoding (must be equal to batch size in decode mode)",
                         type=int)
     parser.add_argument("--batch_size", default=6, help="batch size", type=int)
+    parser.add_argument("--bucket_boundaries", default=None, nargs='+', type=int,
+                        help="enc_len boundaries for length-bucketed training batches, e.g. 50 100 150")
 
     parser.add_argument("--vocab_size", default=30000, help="Vocabulary size", type=int)
     parser.add_argument("--embed_size", default=256, help="Words embeddings dimension", type=int)
@@ -48,6 +55,11 @@ def main():
                              "on tensorflow site for more details.",
                         type=float)
     parser.add_argument('--eps', default=1e-12, help='eps', type=float)
+    parser.add_argument("--loss_mode", default='final_dist',
+                        help="final_dist: loss from the full final distribution; "
+                             "target_gather: only compute the target word probability; "
+                             "sampled_softmax: target_gather with a sampled softmax for the generator part")
+    parser.add_argument("--num_sampled", default=1024, help="negative samples for sampled_softmax", type=int)
     parser.add_argument('--max_grad_norm', default=2.0, help='for gradient clipping', type=float)
     # path
     # /ckpt/checkpoint/checkpoint
@@ -62,10 +74,23 @@ def main():
     parser.add_argument("--test_seg_x_dir", default='./resource/output/test_set_x.txt',
                         help="test_seg_x_dir")
     parser.add_argument("--vocab_path", default='./resource/output/vocab.txt', help="Vocab path")
+    parser.add_argument("--array_vocab_path", default='./resource/output/vocab.npz',
+                        help="binary vocab written by compile mode, used when vocab_mode is array")
+    parser.add_argument("--vocab_mode", default='dict',
+                        help="dict: python dict vocab; array: numpy array vocab with batch encode/decode")
+    parser.add_argument("--embedding_matrix_path", default='./resource/output/embedding_matrix.npy',
+                        help="embedding matrix written by compile mode, memory mapped when it exists")
+    parser.add_argument("--embedding_dtype", default='float32', help="float32 or float16 embedding matrix file")
     parser.add_argument("--word2vec_output", default='./resource/output/w2v_vocab_metric.txt',
                         help="Vocab path")
     parser.add_argument("--test_save_dir", default='./resource/output/', help="test_save_dir")
     parser.add_argument("--test_df_dir", default='./resource/input/AutoMaster_TestSet.csv')
+    parser.add_argument("--stop_words_path", default='./resource/input/stop_words.txt',
+                        help="stop words used to segment the raw text in serve mode")
+    parser.add_argument("--user_dict_path", default='./resource/input/userDict.txt',
+                        help="jieba user dict used to segment the raw text in serve mode")
+    parser.add_argument("--shard_dir", default='./resource/output/shards',
+                        help="Folder of the compiled token id shards")
 
     # others
     parser.add_argument("--steps_per_epoch", default=300, help="max_train_steps", type=int)
@@ -73,14 +98,54 @@ def main():
     parser.add_argument("--max_steps", default=10000, help="Max number of iterations", type=int)
     parser.add_argument("--nums_to_test", default=10, help="Number of examples to test", type=int)
     parser.add_argument("--epochs", default=15, help="train epochs", type=int)
+    parser.add_argument("--metrics_dir", default='./resource/output/metrics',
+                        help="TensorBoard logs, train_metrics.csv and profiler traces of the train loop")
+    parser.add_argument("--metrics_every", default=50, help="write training throughput metrics every N steps",
+                        type=int)
+    parser.add_argument("--profile_start_step", default=10, help="first train step traced by tf.profiler", type=int)
+    parser.add_argument("--profile_steps", default=0, help="number of train steps traced by tf.profiler, 0 disables",
+                        type=int)
+    parser.add_argument("--shard_size", default=10000, help="Number of examples per compiled shard", type=int)
+    parser.add_argument("--benchmark_batches", default=50, help="Number of batches timed in benchmark mode",
+                        type=int)
+    parser.add_argument("--serve_host", default='127.0.0.1', help="serve mode listen address")
+    parser.add_argument("--serve_port", default=8000, help="serve mode listen port", type=int)
+    parser.add_argument("--serve_max_latency_ms", default=20,
+                        help="serve mode waits at most this long after the first request to fill a batch",
+                        type=float)
+    parser.add_argument("--serve_timeout", default=60, help="seconds a request waits for its summary", type=float)
+    parser.add_argument("--benchmark_target", default='batcher', help="batcher, padding, train_step or vocab")
 
     # mode
-    parser.add_argument("--mode", default='test', help="training, eval or test options")
+    parser.add_argument("--mode", default='test', help="training, eval, test, compile, benchmark or serve options")
+    parser.add_argument("--batcher_mode", default='generator',
+                        help="generator: parse the seg text files every epoch, "
+                             "graph: parse the seg text files with parallel tf ops, "
+                             "shards: stream the shards written by compile mode")
     parser.add_argument("--model", default='PGN', help="which model to be slected")
     parser.add_argument("--use_coverage", default=True, help="is_coverage")
     parser.add_argument("--greedy_decode", default=False, help="greedy_decoder")
+    parser.add_argument("--batch_beam_decode", default=False,
+                        help="beam search batch_size articles at once over the whole test set, "
+                             "beam_size does not need to equal batch_size")
     parser.add_argument("--transformer", default=False, help="transformer")
     parser.add_argument("--use_GPU", default=True, help="transformer")
+    parser.add_argument("--share_embedding", default=False, help="encoder and decoder share one embedding layer")
+    parser.add_argument("--use_tf_function", default=False,
+                        help="compile train_step with tf.function, input_signature comes from the batcher")
+    parser.add_argument("--distribute", default=None,
+                        help="mirrored: data parallel training on all local GPUs; "
+                             "multi_worker: data parallel training across the workers in TF_CONFIG. "
+                             "batch_size is the global batch size")
+    parser.add_argument("--async_checkpoint", default=False,
+                        help="save only the trainable weights on a background thread into <model_dir>/async_checkpoint, "
+                             "test/serve restore from there")
+    parser.add_argument("--ema_decay", default=0.0,
+                        help="with async_checkpoint, also save an exponential moving average of the weights", type=float)
+    parser.add_argument("--restore_ema", default=False, help="test/serve with the moving average weights")
+    parser.add_argument("--use_xla", default=False,
+                        help="jit compile the tf.function train_step with XLA, recompiles for every new "
+                             "encoder length / oov count")
 
     args = parser.parse_args()
     params = vars(args)
@@ -88,13 +153,45 @@ def main():
     if params['use_GPU']:
         print('*******Using GPU**************')
         gpus = tf.config.experimental.list_physical_devices(device_type='GPU')
-        if gpus:
+        if gpus and not params['distribute']:
             tf.config.experimental.set_visible_devices(devices=gpus[0], device_type='GPU')
             tf.config.experimental.set_memory_growth(gpus[0], enable=True)
+        elif gpus:
+            # 分布式训练使用所有GPU
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, enable=True)
     else:
         print('*******Using CPU**************')
         os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
+    if params["mode"] == "compile":
+        print('Compiling token id shards...')
+        vocab = create_vocab(params)
+        compile_shards(vocab, params)
+        print('Compiling array vocab...')
+        ArrayVocab(params["vocab_path"], params["vocab_size"]).save(params["array_vocab_path"])
+        print('Compiling embedding matrix...')
+        save_embedding_matrix(params, params["vocab_size"])
+        return
+
+    if params["mode"] == "benchmark":
+        print('Benchmarking the {}...'.format(params["benchmark_target"]))
+        vocab = create_vocab(params)
+        if params["benchmark_target"] == "batcher":
+            benchmark_batcher(vocab, dict(params, mode="train"), params["benchmark_batches"])
+        elif params["benchmark_target"] == "padding":
+            benchmark_padding(vocab, dict(params, mode="train"), params["benchmark_batches"])
+        elif params["benchmark_target"] == "train_step":
+            benchmark_train_step(vocab, dict(params, mode="train"), params["benchmark_batches"])
+        elif params["benchmark_target"] == "vocab":
+            benchmark_vocab(params, params["benchmark_batches"])
+        return
+
+    if params["mode"] == "serve":
+        print('Serving {}...'.format(params["model"]))
+        serve(params)
+        return
+
     if params['model'] == 'SequenceToSequence':
         if params["mode"] == "train":
             print('Using Seq2Seq to train...')
@@ -10,9 +10,10 @@ class BahdanauAttention(tf.keras.layers.Layer):
 
         #  model.keras.layers.Dense
 
-    def call(self, dec_hidden, enc_output):
+    def call(self, dec_hidden, enc_output, enc_pad_mask=None):
         # dec_hidden shape == (batch_size, hidden size)
         # enc_output (batch_size, enc_len, enc_units)
+        # enc_pad_mask (batch_size, enc_len)，不为None时pad位置的attention为0
 
         # hidden_with_time_axis shape == (batch_size, 1, dec_units)
         # we are doing this to perform addition to calculate the score
@@ -25,6 +26,10 @@ class BahdanauAttention(tf.keras.layers.Layer):
         score = self.V(tf.nn.tanh(
             self.W1(enc_output) + self.W2(hidden_with_time_axis)))
 
+        if enc_pad_mask is not None:
+            mask = tf.expand_dims(tf.cast(enc_pad_mask, dtype=score.dtype), axis=2)
+            score += (1.0 - mask) * -1e9
+
         # attention_weights (batch_size, enc_len, 1)
         attention_weights = tf.nn.softmax(score, axis=1)
 
@@ -40,12 +45,15 @@ class BahdanauAttention(tf.keras.layers.Layer):
 
 
 class Decoder(tf.keras.Model):
-    def __init__(self, vocab_size, embedding_dim, embedding_matrix, dec_units, batch_size):
+    def __init__(self, vocab_size, embedding_dim, embedding_matrix, dec_units, batch_size, embedding_layer=None):
         super(Decoder, self).__init__()
         self.batch_sz = batch_size
         self.dec_units = dec_units
-        self.embedding = tf.keras.layers.Embedding(vocab_size, embedding_dim, weights=[embedding_matrix],
-                                                   trainable=False)
+        # embedding_layer不为None时与encoder/decoder共用同一个Embedding层
+        if embedding_layer is None:
+            embedding_layer = tf.keras.layers.Embedding(vocab_size, embedding_dim, weights=[embedding_matrix],
+                                                        trainable=False)
+        self.embedding = embedding_layer
         self.gru = tf.keras.layers.GRU(self.dec_units,
                                        return_sequences=True,
                                        return_state=True,
@@ -2,7 +2,7 @@ import tensorflow as tf
 
 
 class Encoder(tf.keras.Model):
-    def __init__(self, vocab_size, embedding_dim, embedding_matrix, enc_units, batch_size):
+    def __init__(self, vocab_size, embedding_dim, embedding_matrix, enc_units, batch_size, embedding_layer=None):
         super(Encoder, self).__init__()
         self.batch_size = batch_size
         self.enc_units = enc_units
@@ -11,8 +11,11 @@ class Encoder(tf.keras.Model):
         if self.use_bi_gru:
             self.enc_units = self.enc_units // 2
 
-        self.embedding = tf.keras.layers.Embedding(vocab_size, embedding_dim, weights=[embedding_matrix],
-                                                   trainable=False)
+        # embedding_layer不为None时与encoder/decoder共用同一个Embedding层
+        if embedding_layer is None:
+            embedding_layer = tf.keras.layers.Embedding(vocab_size, embedding_dim, weights=[embedding_matrix],
+                                                        trainable=False)
+        self.embedding = embedding_layer
         self.gru = tf.keras.layers.GRU(self.enc_units,
                                        return_sequences=True,
                                        return_state=True,
@@ -20,22 +23,26 @@ class Encoder(tf.keras.Model):
 
         self.bi_gru = tf.keras.layers.Bidirectional(self.gru)
 
-    def call(self, enc_input):
+    def call(self, enc_input, enc_pad_mask=None):
         # (batch_size, enc_len, embedding_dim)
         enc_input_embedded = self.embedding(enc_input)
 
-        initial_state = tf.zeros((self.batch_size, self.enc_units))
+        # 按实际输入的batch大小初始化，分布式训练时每个replica的batch小于batch_size
+        initial_state = tf.zeros((tf.shape(enc_input)[0], self.enc_units))
+        # enc_pad_mask不为None时GRU跳过pad位置，enc_hidden与单独编码这篇文章时相同
+        mask = None if enc_pad_mask is None else tf.cast(enc_pad_mask, tf.bool)
 
         if self.use_bi_gru:
             # 是否使用双向GRU
             output, forward_state, backward_state = self.bi_gru(enc_input_embedded,
-                                                                initial_state=[initial_state, initial_state])
+                                                                initial_state=[initial_state, initial_state],
+                                                                mask=mask)
             print(output)
             enc_hidden = tf.keras.layers.concatenate([forward_state, backward_state], axis=-1)
 
         else:
             # 单向GRU
-            output, enc_hidden = self.gru(enc_input_embedded, initial_state=initial_state)
+            output, enc_hidden = self.gru(enc_input_embedded, initial_state=initial_state, mask=mask)
             print(output)
 
         return output, enc_hidden
@@ -1,5 +1,7 @@
+import numpy as np
 import tensorflow as tf
 from utils.batcher_utils import output_to_words
+from utils.beam_utils import BeamState, top_k_candidates
 
 
 def batch_greedy_decode(model, enc_data, vocab, params):
@@ -8,301 +10,73 @@ def batch_greedy_decode(model, enc_data, vocab, params):
     global outputs
     batch_data = enc_data[0]["enc_input"]
     batch_size = enc_data[0]["enc_input"].shape[0]
-    # 开辟结果存储list
-    predicts = [''] * batch_size
     inputs = tf.convert_to_tensor(batch_data)
 
-    enc_output, enc_hidden = model.encoder(inputs)
+    # 按encoder_pad_mask跳过pad，同一篇文章的结果不受batch中其它文章长度的影响
+    enc_pad_mask = enc_data[0]["encoder_pad_mask"]
+    enc_output, enc_hidden = model.encoder(inputs, enc_pad_mask)
     dec_hidden = enc_hidden
     # 这里解释下为什么要有一个batch_size,因为训练得时候是按照一个batch size扔进去得，所以得到得模型得输入结构也是如此，因此在测试得时候相当于将单个样本
     # 乘以batch size那么多遍，然后再得到结果，结果区list得第一个即可，当然理论上list得内容是一样得
-    dec_input = tf.constant([vocab.word_to_id('[START]')] * batch_size)
-    dec_input = tf.expand_dims(dec_input, axis=1)
+    start_index = vocab.word_to_id(vocab.START_TOKEN)
+    stop_index = vocab.word_to_id(vocab.STOP_TOKEN)
+    dec_input = tf.fill([batch_size, 1], start_index)
     # print('enc_output shape is :',enc_output.get_shape())
     # print('dec_hidden shape is :', dec_hidden.get_shape())
     # print('inputs shape is :', inputs.get_shape())
     # print('dec_input shape is :', dec_input.get_shape())
-    context_vector, _ = model.attention(dec_hidden, enc_output)
+    context_vector, _ = model.attention(dec_hidden, enc_output, enc_pad_mask)
 
+    predicted = []
     for t in range(params['max_dec_len']):
         # 单步预测
-        # final_dist (batch_size, 1, vocab_size+batch_oov_len)
+        # predictions (batch_size, vocab_size)
         predictions, dec_hidden = model.decoder(dec_input,
                                                 dec_hidden,
                                                 enc_output,
                                                 context_vector)
 
-        # id转换
-        predicted_ids = tf.argmax(predictions, axis=1).numpy()
-        for index, predicted_id in enumerate(predicted_ids):
-            predicts[index] += vocab.id_to_word(predicted_id) + ' '
-        # dec_input = tf.expand_dims(predicted_ids, 1)
-    results = []
-    for predict in predicts:
-        # 去掉句子前后空格
-        predict = predict.strip()
-        # 句子小于max len就结束了 截断
-        if '[STOP]' in predict:
-            # 截断stop
-            predict = predict[:predict.index('[STOP]')]
-        # 保存结果
-        results.append(predict)
-    return results
+        # 与训练时(SequenceToSequence.call)一样，用新的hidden重新计算attention，上一步的预测作为下一步的输入
+        predicted_ids = tf.argmax(predictions, axis=1, output_type=tf.int32)
+        predicted.append(predicted_ids.numpy())
+        dec_input = tf.expand_dims(predicted_ids, 1)
+        context_vector, _ = model.attention(dec_hidden, enc_output, enc_pad_mask)
 
-
-class Hypothesis:
-    """ Class designed to hold hypothesises throughout the beamSearch decoding """
-
-    def __init__(self, tokens, log_probs, state, attn_dists, p_gens):
-        # list of all the tokens from time 0 to the current time step t
-        self.tokens = tokens
-        # list of the log probabilities of the tokens of the tokens
-        self.log_probs = log_probs
-        # decoder state after the last token decoding
-        self.state = state
-        # attention dists of all the tokens
-        self.attn_dists = attn_dists
-        # generation probability of all the tokens
-        self.p_gens = p_gens
-        # self.coverage = coverage
-
-        # self.abstract = ""
-        # self.text = ""
-        # self.real_abstract = ""
-
-    def extend(self, token, log_prob, state, attn_dist, p_gen):
-        """Method to extend the current hypothesis by adding the next decoded token and all
-        the informations associated with it"""
-        return Hypothesis(tokens=self.tokens + [token],  # we add the decoded token
-                          log_probs=self.log_probs + [log_prob],  # we add the log prob of the decoded token
-                          state=state,  # we update the state
-                          attn_dists=self.attn_dists + [attn_dist],
-                          # we  add the attention dist of the decoded token
-                          p_gens=self.p_gens + [p_gen],  # we add the p_gen
-                          )
-
-    @property
-    def latest_token(self):
-        return self.tokens[-1]
-
-    @property
-    def tot_log_prob(self):
-        return sum(self.log_probs)
-
-    @property
-    def avg_log_prob(self):
-        return self.tot_log_prob / len(self.tokens)
+    # 句子小于max len就结束了 截断stop，整个id矩阵用vocab.decode_batch一次解码
+    predicted = np.stack(predicted, axis=1)
+    is_stop = predicted == stop_index
+    lengths = np.where(is_stop.any(axis=1), is_stop.argmax(axis=1), predicted.shape[1])
+    return [' '.join(words) for words in vocab.decode_batch(predicted, lengths=lengths)]
 
 
 def beam_decode(model, batch, vocab, params):
-    def decode_onestep(enc_inp, enc_outputs, dec_input, dec_state, enc_extended_inp,
-                       batch_oov_len, enc_pad_mask, use_coverage, prev_coverage):
-        """
-            Method to decode the output step by step (used for beamSearch decoding)
-            Args:
-                sess : tf.Session object
-                batch : current batch, shape = [beam_size, 1, vocab_size( + max_oov_len if pointer_gen)]
-                (for the beam search decoding, batch_size = beam_size)
-                enc_outputs : hiddens outputs computed by the encoder LSTM
-                dec_state : beam_size-many list of decoder previous state, LSTMStateTuple objects,
-                shape = [beam_size, 2, hidden_size]
-                dec_input : decoder_input, the previous decoded batch_size-many words, shape = [beam_size, embed_size]
-                cov_vec : beam_size-many list of previous coverage vector
-            Returns: A dictionary of the results of all the ops computations (see below for more details)
-        """
-        # print('enc_outputs is ', enc_outputs)
-        # print('dec_state is ', dec_state)
-        # print('enc_inp is ', enc_inp)
-        # print('enc_extended_inp is ', enc_extended_inp)
-        # print('dec_input is ', dec_input)
-        # print('batch_oov_len is ', batch_oov_len)
-        # print('enc_pad_mask is ', enc_pad_mask)
-        # print('prev_coverage is ', prev_coverage)
-        final_dists, dec_hidden, attentions, p_gens = model(enc_outputs,  # shape=(3, 115, 256)
-                                                            dec_state,  # shape=(3, 256)
-                                                            enc_inp,  # shape=(3, 115)
-                                                            enc_extended_inp,  # shape=(3, 115)
-                                                            dec_input,  # shape=(3, 1)
-                                                            batch_oov_len,  # shape=()
-                                                            enc_pad_mask,  # shape=(3, 115)
-                                                            use_coverage,
-                                                            prev_coverage)  # shape=(3, 115, 1)
-        # final_dists shape=(3, 1, 30000)
-        # print('final_dists is ', tf.squeeze(final_dists))
-        # print('dec_hidden is ', dec_hidden)
-        # print('attentions is ', attentions)
-        # print('coverages is ', coverages)
-        # print('p_gens id ', p_gens)
-        # top_k_probs shape=(3, 6)
-        # top_k_ids shape=(3, 6)
-        top_k_probs, top_k_ids = tf.nn.top_k(tf.squeeze(final_dists), k=params["beam_size"] * 2)
-        top_k_log_probs = tf.math.log(top_k_probs)
-        # print('top_k_probs is ', top_k_probs)
-        # print('top_k_ids is ', top_k_ids)
-        # print('top_k_log_probs is ', top_k_log_probs)
-        # dec_hidden shape = (3, 256)
-        # attentions, shape = (3, 115)
-        # p_gens shape = (3, 1)
-        # coverages,shape = (3, 115, 1)
-        results = {"dec_state": dec_hidden,
-                   "attention_vec": attentions,  # [batch_sz, max_len_x, 1]
-                   "top_k_ids": top_k_ids,
-                   "top_k_log_probs": top_k_log_probs,
-                   "p_gen": p_gens,
-                   }
-        return results
-
-    # end of the nested class
-
-    # We run the encoder once and then we use the results to decode each time step token
-    # state shape=(3, 256), enc_outputs shape=(3, 115, 256)
-    enc_outputs, state = model.encoder(batch[0]["enc_input"])
-    # print('enc_outputs is ', enc_outputs)
-    # Initial Hypothesises (beam_size many list)
-    # print('xxxxxxxx is ', batch[0]["enc_input"].shape[1])
-    # hyps = [Hypothesis(tokens=[vocab.word_to_id('[START]')],  # [2]
-    #                    # we initalize all the beam_size hypothesises with the token start
-    #                    log_probs=[0.0],  # Initial log prob = 0
-    #                    # state=state[0],
-    #                    state=state[0],  # shape=(256,)
-    #                    # initial dec_state (we will use only the first dec_state because they're initially the same)
-    #                    attn_dists=[],
-    #                    p_gens=[],  # we init the coverage vector to zero
-    #                    coverage=np.zeros([batch[0]["enc_input"].shape[1], 1], dtype=np.float32))
-    #         for _ in range(params['batch_size'])]  # batch_size == beam_size
-    # hyps = [Hypothesis(tokens=[vocab.word_to_id('[START]')],  # [2]
-    #                    # we initalize all the beam_size hypothesises with the token start
-    #                    log_probs=[0.0],  # Initial log prob = 0
-    #                    # state=state[0],
-    #                    state=state[0],  # shape=(256,)
-    #                    # initial dec_state (we will use only the first dec_state because they're initially the same)
-    #                    attn_dists=[],
-    #                    p_gens=[],  # we init the coverage vector to zero
-    #                    coverage=np.zeros([batch[0]["enc_input"].shape[1], 1], dtype=np.float32))
-    #         for _ in range(params['batch_size'])]  # batch_size == beam_size
-    hyps = [Hypothesis(tokens=[vocab.word_to_id('[START]')],
-                       log_probs=[0.0],
-                       state=state[0],
-                       p_gens=[],
-                       attn_dists=[]) for _ in range(params['batch_size'])]
-    # print('hyps', hyps)
-    results = []  # list to hold the top beam_size hypothesises
-    steps = 0  # initial step
-
-    while steps < params['max_dec_steps'] and len(results) < params['beam_size']:
-        # print('step is ', steps)
-        latest_tokens = [h.latest_token for h in hyps]  # latest token for each hypothesis , shape : [beam_size]
-        # print('latest_tokens is ', latest_tokens)
-        # we replace all the oov is by the unknown token
-        # print(latest_tokens)
-        latest_tokens = [t if t in range(params['vocab_size']) else vocab.word_to_id('[UNK]') for t in latest_tokens]
-        # latest_tokens = [t if t in vocab.id2word else vocab.word2id('[UNK]') for t in latest_tokens]
-        # print('latest_tokens is ', latest_tokens)
-        # we collect the last states for each hypothesis
-        # print(latest_tokens)
-        states = [h.state for h in hyps]
-        # print('states i s', states)
-        # prev_coverage = [h.coverage for h in hyps]  # list of coverage vectors (or None)
-        # print('prev_coverage_1 is ', prev_coverage)
-        # prev_coverage = tf.convert_to_tensor(prev_coverage)
-        # print('prev_coverage_2 is ', prev_coverage)
-
-        # we decode the top likely 2 x beam_size tokens tokens at time step t for each hypothesis
-        # model, batch, vocab, params
-        dec_input = tf.expand_dims(latest_tokens, axis=1)  # shape=(3, 1)
-        # print('dec_input is ', dec_input)
-        # print('step is ', steps)
-        # print('dec_input is ', dec_input)
-        # print('states is ', states)
-        dec_states = tf.stack(states, axis=0)
-        # print('dec_states is ', dec_states)
-        # print('batch[0][enc_input] is ', batch[0]['enc_input'])
-        # print('enc_outputs is ', enc_outputs)
-        # print('dec_input is ', dec_input)
-        # print('dec_states is ', dec_states)
-        # print('batch[0][extended_enc_input is ', batch[0]['extended_enc_input'])  # problem maybe
-        # print('batch[0][max_oov_len] is ', batch[0]['max_oov_len'])
-        # print('batch[0][sample_encoder_pad_mask is ', batch[0]['sample_encoder_pad_mask'])
-        # print('prev_coverage is ', prev_coverage)
-        returns = decode_onestep(batch[0]['enc_input'],  # shape=(3, 115)
-                                 enc_outputs,  # shape=(3, 115, 256)
-                                 dec_input,  # shape=(3, 1)
-                                 dec_states,  # shape=(3, 256)
-                                 batch[0]['extended_enc_input'],  # shape=(3, 115)
-                                 batch[0]['max_oov_len'],  # shape=()
-                                 batch[0]['sample_encoder_pad_mask'],  # shape=(3, 115)
-                                 params['is_coverage'],  # true
-                                 prev_coverage=None)  # shape=(3, 115, 1)
-        # print('returns["p_gen"] is ', returns["p_gen"])
-        # print(np.squeeze(returns["p_gen"]))
-        # np.squeeze(returns["p_gen"])
-        # print('returns is ', returns["p_gen"])
-        topk_ids, topk_log_probs, new_states, attn_dists, p_gens = returns['top_k_ids'], \
-                                                                   returns['top_k_log_probs'], \
-                                                                   returns['dec_state'], \
-                                                                   returns['attention_vec'], \
-                                                                   returns["p_gen"], \
- \
-            # print('topk_ids is ', topk_ids)
-        # print('topk_log_probs is ', topk_log_probs)
-        all_hyps = []
-        num_orig_hyps = 1 if steps == 0 else len(hyps)
-        num = 1
-        # print('num_orig_hyps is ', num_orig_hyps)
-        for i in range(num_orig_hyps):
-            # h, new_state, attn_dist, p_gen, coverage = hyps[i], new_states[i], attn_dists[i], p_gens[i],
-            # prev_coverages[i]
-            h, new_state, attn_dist, p_gen = hyps[i], new_states[i], attn_dists[i], p_gens[i]
-            # print('h is ', h)
-            # print('new_state is ', new_state) shape=(256,)
-            # print('attn_dist ids ', attn_dist) shape=(115,)
-            # print('p_gen is ', p_gen) 0.4332452
-            # print('coverage is ', coverage)shape=(115, 1),
-            num += 1
-            # print('num is ', num)
-            for j in range(params['beam_size'] * 2):
-                # we extend each hypothesis with each of the top k tokens
-                # (this gives 2 x beam_size new hypothesises for each of the beam_size old hypothesises)
-                # print('topk_ids is ', topk_ids) shape=(3, 6)
-                # print('token is ', topk_log_probs)
-                # print('topk_log_probs is ', topk_log_probs)shape=(3, 6)
-                # print(topk_ids[i, j].numpy())
-                # print('steps is ', steps)
-                # print(topk_log_probs[i, j].numpy())
-                # print('h is ', h.avg_log_prob)
-                # print(coverage)
-                new_hyp = h.extend(token=topk_ids[i, j].numpy(),
-                                   log_prob=topk_log_probs[i, j],
-                                   state=new_state,
-                                   attn_dist=attn_dist,
-                                   p_gen=p_gen,
-                                   )
-                all_hyps.append(new_hyp)
-        # in the following lines, we sort all the hypothesises, and select only the beam_size most likely hypothesises
-        hyps = []
-        sorted_hyps = sorted(all_hyps, key=lambda h: h.avg_log_prob, reverse=True)
-        for h in sorted_hyps:
-            if h.latest_token == vocab.word_to_id('[STOP]'):
-                if steps >= params['min_dec_steps']:
-                    results.append(h)
-            else:
-                # print(h.latest_token)
-                hyps.append(h)
-            if len(hyps) == params['beam_size'] or len(results) == params['beam_size']:
-                break
-        # print('hyps is ', hyps.)
-        # print('steps is ', steps)
-        steps += 1
-
-    if len(results) == 0:
-        results = hyps
-
-    # At the end of the loop we return the most likely hypothesis, which holds the most likely ouput sequence,
-    # given the input fed to the model
-    hyps_sorted = sorted(results, key=lambda h: h.avg_log_prob, reverse=True)
-    best_hyp = hyps_sorted[0]
-    # print('best_hyp.tokens is ', best_hyp.tokens)
-    best_hyp.abstract = " ".join(output_to_words(best_hyp.tokens, vocab, batch[0]["article_oovs"][0])[1:-1])
-    best_hyp.text = batch[0]["article"].numpy()[0].decode()
-    print('best_hyp is ', best_hyp.abstract)
-    return best_hyp
+    """
+    单篇文章的beam search，batch中是同一篇文章重复beam_size(== batch_size)次
+    假设保存在BeamState的数组中，每步只gather decoder的hidden
+    """
+    stop_index = vocab.word_to_id(vocab.STOP_TOKEN)
+    unk_index = vocab.word_to_id(vocab.UNKNOWN_TOKEN)
+
+    # encoder只运行一次，encoder和attention都按encoder_pad_mask跳过pad，与训练时相同
+    enc_pad_mask = batch[0]["encoder_pad_mask"]
+    enc_output, dec_hidden = model.encoder(batch[0]["enc_input"], enc_pad_mask)
+    beams = BeamState(1, params['beam_size'], params['max_dec_steps'], vocab.word_to_id(vocab.START_TOKEN))
+    while not beams.done:
+        dec_input = tf.expand_dims(beams.latest_tokens(params['vocab_size'], unk_index), axis=1)
+        # 与训练时一样，先用上一步的hidden计算context_vector
+        context_vector, _ = model.attention(dec_hidden, enc_output, enc_pad_mask)
+        predictions, dec_hidden = model.decoder(dec_input,
+                                                dec_hidden,
+                                                enc_output,
+                                                context_vector)
+        # seq2seq的decoder输出的是logits
+        cand_log_probs, cand_ids = top_k_candidates(tf.nn.log_softmax(predictions, axis=-1), beams.beam_size,
+                                                    log_dists=True)
+        rows = beams.advance(cand_log_probs, cand_ids, stop_index, params['min_dec_steps'])
+        dec_hidden = tf.gather(dec_hidden, rows)
+
+    # 去掉开始符和结束符
+    best_tokens = [t for t in beams.best_tokens(0, stop_index)[1:] if t != stop_index]
+    abstract = " ".join(output_to_words(best_tokens, vocab, batch[0]["article_oovs"][0]))
+    print('abstract: {}'.format(abstract))
+    return abstract
@@ -1,32 +1,44 @@
 import tensorflow as tf
 import time
 from seq2seq_tf2.models.losses import loss_function
+from utils.train_utils import compile_train_step, train_step_args, distribute_dataset, strategy_scope
+from utils.metrics_utils import TrainMetrics
+from utils.checkpoint_utils import AsyncCheckpointWriter
 import numpy as np
 
+# train_step依次需要的batch字段
+TRAIN_STEP_KEYS = ["enc_input", "dec_target", "encoder_pad_mask"]
 
-def train_model(model, dataset, params, ckpt_manager, vocab):
-    print(vocab)
+
+def get_optimizer(params):
+    return tf.keras.optimizers.Adagrad(params['learning_rate'],
+                                       initial_accumulator_value=params['adagrad_init_acc'],
+                                       clipnorm=params['max_grad_norm'],
+                                       epsilon=params['eps'])
+
+
+def make_train_step(model, optimizer, params, vocab, strategy=None):
+    """
+    返回按TRAIN_STEP_KEYS顺序接收参数的train_step，函数内不做打印，可以直接用tf.function编译
+    strategy不为None时train_step在每个replica上运行，loss按global batch size缩放
+    """
     start_index = vocab.word_to_id('<START>')
     pad_index = vocab.word_to_id('<PAD>')
+    global_batch_size = params['batch_size'] if strategy is not None else None
 
-    optimizer = tf.keras.optimizers.Adagrad(params['learning_rate'],
-                                            initial_accumulator_value=params['adagrad_init_acc'],
-                                            clipnorm=params['max_grad_norm'],
-                                            epsilon=params['eps'])
-
-    # @tf.function()
-    def train_step(enc_inp, dec_tar, pad_index):
+    def train_step(enc_inp, dec_tar, enc_pad_mask):
         with tf.GradientTape() as tape:
             # print('enc_inp shape is final for model :', enc_inp.get_shape())
-            print(enc_inp)
-            enc_output, enc_hidden = model.encoder(enc_inp)
+            # 与解码时一样，encoder和attention按encoder_pad_mask跳过pad
+            enc_output, enc_hidden = model.encoder(enc_inp, enc_pad_mask)
             # 第一个decoder输入 开始标签
             # dec_input (batch_size, 1)
             # dec_input = tf.expand_dims([start_index], 1)
-            dec_input = tf.expand_dims([start_index] * params["batch_size"], 1)
+            # 分布式训练时每个replica只有batch_size / num_replicas条样本
+            dec_input = tf.fill([tf.shape(enc_inp)[0], 1], start_index)
             dec_hidden = enc_hidden
-            predictions, _ = model(dec_input, dec_hidden, enc_output, dec_tar)
-            loss = loss_function(dec_tar, predictions, pad_index)
+            predictions, _ = model(dec_input, dec_hidden, enc_output, dec_tar, enc_pad_mask)
+            loss = loss_function(dec_tar, predictions, pad_index, global_batch_size)
 
         # 下面这三行是固定写法
         variables = model.trainable_variables
@@ -34,19 +46,34 @@ def train_model(model, dataset, params, ckpt_manager, vocab):
         optimizer.apply_gradients(zip(gradients, variables))
         return loss
 
+    return train_step
+
+
+def train_model(model, dataset, params, ckpt_manager, vocab, strategy=None):
+    print(vocab)
+
+    with strategy_scope(strategy):
+        optimizer = get_optimizer(params)
+    train_step = compile_train_step(make_train_step(model, optimizer, params, vocab, strategy), dataset,
+                                    TRAIN_STEP_KEYS, params, strategy)
+    metrics = TrainMetrics(params, params['model'])
+
     for epoch in range(params['epochs']):
         t0 = time.time()
         step = 0
         total_loss = 0
         # print(len(dataset.take(params['steps_per_epoch'])))
-        for step, batch in enumerate(dataset.take(params['steps_per_epoch'])):
+        epoch_dataset = distribute_dataset(dataset.take(params['steps_per_epoch']), strategy)
+        for step, batch in enumerate(metrics.timed(epoch_dataset, epoch + 1)):
             # 讲设你的样本数是1000，batch size10,一个epoch，我们一共有100次，200， 500， 40，20.
-            batch_loss = train_step(batch[0]["enc_input"],  # shape=(16, 200)
-                                    batch[1]["dec_target"], pad_index)  # shape=(16, 50)
+            batch_loss = float(train_step(*train_step_args(batch, TRAIN_STEP_KEYS)))
+            metrics.end_step(batch, batch_loss)
+            if isinstance(ckpt_manager, AsyncCheckpointWriter):
+                ckpt_manager.after_step()
             total_loss += batch_loss
             step += 1
             if step % 100 == 0:
-                print('Epoch {} Batch {} Loss {:.4f}'.format(epoch + 1, step, batch_loss.numpy()))
+                print('Epoch {} Batch {} Loss {:.4f}'.format(epoch + 1, step, batch_loss))
 
         if epoch % 1 == 0:
             ckpt_save_path = ckpt_manager.save()
@@ -56,5 +83,13 @@ def train_model(model, dataset, params, ckpt_manager, vocab):
             print('Time taken for 1 epoch {} sec\n'.format(time.time() - t0))
             # 学习率的衰减，按照训练的次数来更新学习率（tf1.x）
             lr = params['learning_rate'] * np.power(0.9, epoch + 1)
-            optimizer = tf.keras.optimizers.Adam(name='Adam', learning_rate=lr)
+            with strategy_scope(strategy):
+                optimizer = tf.keras.optimizers.Adam(name='Adam', learning_rate=lr)
             print("learning_rate=", optimizer.get_config()["learning_rate"])
+            # train_step绑定的是旧的optimizer，换optimizer后需要重新生成(use_tf_function时重新trace)
+            train_step = compile_train_step(make_train_step(model, optimizer, params, vocab, strategy), dataset,
+                                            TRAIN_STEP_KEYS, params, strategy)
+    metrics.close()
+    if isinstance(ckpt_manager, AsyncCheckpointWriter):
+        # 等待最后一个checkpoint写完
+        ckpt_manager.close()
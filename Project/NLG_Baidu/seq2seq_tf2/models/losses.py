@@ -4,9 +4,14 @@ loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, re
 
 
 # 定义损失函数
-def loss_function(real, pred, pad_index):
+def loss_function(real, pred, pad_index, global_batch_size=None):
+    """
+    :param global_batch_size: 分布式训练时所有replica的总batch size，replica间求和后等于global batch的平均值
+    """
     mask = tf.math.logical_not(tf.math.equal(real, pad_index))
     loss_ = loss_object(real, pred)
     mask = tf.cast(mask, dtype=loss_.dtype)  # 转换为和loss_类型相同的张量
     loss_ *= mask
+    if global_batch_size is not None:
+        return tf.reduce_sum(loss_) / tf.cast(global_batch_size * tf.shape(loss_)[1], loss_.dtype)
     return tf.reduce_mean(loss_)
@@ -10,11 +10,17 @@ class SequenceToSequence(tf.keras.Model):
         self.embedding_matrix = load_word2vec(params)
         self.params = params
         print(params["batch_size"])
+        # share_embedding时encoder和decoder共用一个Embedding层，embedding矩阵只保存一份
+        self.embedding = None
+        if params["share_embedding"]:
+            self.embedding = tf.keras.layers.Embedding(params["vocab_size"], params["embed_size"],
+                                                       weights=[self.embedding_matrix], trainable=False)
         self.encoder = encoder.Encoder(vocab_size=params["vocab_size"],
                                        embedding_dim=params["embed_size"],
                                        embedding_matrix=self.embedding_matrix,
                                        enc_units=params["enc_units"],
-                                       batch_size=params["batch_size"])
+                                       batch_size=params["batch_size"],
+                                       embedding_layer=self.embedding)
 
         self.attention = decoder.BahdanauAttention(units=params["attn_units"])
 
@@ -22,7 +28,18 @@ class SequenceToSequence(tf.keras.Model):
                                        embedding_dim=params["embed_size"],
                                        embedding_matrix=self.embedding_matrix,
                                        dec_units=params["dec_units"],
-                                       batch_size=params["batch_size"])
+                                       batch_size=params["batch_size"],
+                                       embedding_layer=self.embedding)
+
+    def build_variables(self):
+        """
+        用长度为1的输入运行encoder和一步decoder，创建与训练时相同的变量
+        按变量list恢复权重(utils.checkpoint_utils)之前调用
+        """
+        inp = tf.zeros([1, 1], dtype=tf.int32)
+        enc_output, enc_hidden = self.encoder(inp)
+        context_vector, _ = self.attention(enc_hidden, enc_output)
+        self.decoder(inp, enc_hidden, enc_output, context_vector)
 
     # def call_decoder_onestep(self, dec_input, dec_hidden, enc_output):
     #     # context_vector ()
@@ -36,11 +53,11 @@ class SequenceToSequence(tf.keras.Model):
     #                                     context_vector)
     #     return pred, dec_hidden, context_vector, attention_weights
 
-    def call(self, dec_input, dec_hidden, enc_output, dec_target):
+    def call(self, dec_input, dec_hidden, enc_output, dec_target, enc_pad_mask=None):
         predictions = []
         attentions = []
 
-        context_vector, _ = self.attention(dec_hidden, enc_output)
+        context_vector, _ = self.attention(dec_hidden, enc_output, enc_pad_mask)
 
         for t in range(dec_target.shape[1]):
             pred, dec_hidden = self.decoder(dec_input,
@@ -48,7 +65,7 @@ class SequenceToSequence(tf.keras.Model):
                                             enc_output,
                                             context_vector)
 
-            context_vector, attn = self.attention(dec_hidden, enc_output)
+            context_vector, attn = self.attention(dec_hidden, enc_output, enc_pad_mask)
             # using teacher forcing
             dec_input = tf.expand_dims(dec_target[:, t], 1)
             # for i in range(dec_input.shape[0]):
@@ -1,7 +1,8 @@
 import tensorflow as tf
 from seq2seq_tf2.models.seq2seq import SequenceToSequence
 from utils.batcher_utils import batcher
-from utils.embedding import Vocab
+from utils.embedding import create_vocab
+from utils.checkpoint_utils import restore_weights
 from seq2seq_tf2.helpers.test_helper import batch_greedy_decode
 from seq2seq_tf2.helpers.test_helper import beam_decode
 from tqdm import tqdm
@@ -17,18 +18,24 @@ def test(params):
         model = SequenceToSequence(params)
 
     print('Creating vocab.....')
-    vocab = Vocab(params['vocab_path'], params['vocab_size'])
+    vocab = create_vocab(params)
 
     print('Creating the batcher...')
     b = batcher(vocab, params)
 
     print('Creating the checkpoint manager.......')
     if params['model'] == 'SequenceToSequence':
-        checkpoint_dir = '{}/checkpoint'.format(params['seq2seq_model_dir'])
-        ckpt = tf.train.Checkpoint(step=tf.Variable(0), SequenceToSequence=model)
-        ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=5)
-
-        ckpt.restore(ckpt_manager.latest_checkpoint)
+        if params['async_checkpoint']:
+            # AsyncCheckpointWriter保存的变量list
+            model.build_variables()
+            restore_weights(model, '{}/async_checkpoint'.format(params['seq2seq_model_dir']),
+                            use_ema=params['restore_ema'])
+        else:
+            checkpoint_dir = '{}/checkpoint'.format(params['seq2seq_model_dir'])
+            ckpt = tf.train.Checkpoint(step=tf.Variable(0), SequenceToSequence=model)
+            ckpt_manager = tf.train.CheckpointManager(ckpt, checkpoint_dir, max_to_keep=5)
+
+            ckpt.restore(ckpt_manager.latest_checkpoint)
 
         print('Model restored')
         for batch in b:
@@ -2,7 +2,12 @@
 
 from PIL import Image, ImageEnhance
 import pytesseract
+import hashlib
+import json
+import os
+import re
 import time
+from multiprocessing import Pool, cpu_count
 
 # Install "Tess doc" before run those functions
 # Then add the bin path in the environment variables
@@ -38,16 +43,82 @@ def dict_create(file):
     return dic
 
 
-def sort_out(sentence):
-    sort_source = dict_create('sort.txt')
-    sentence_new = ''
-    for key in sort_source:
-        if key in sentence:
-            sentence = sentence.replace(key, sort_source[key])
-            sentence_new = sentence
-        else:
-            sentence_new = sentence
-    return sentence_new
+# {文件名: (编译好的正则, 替换表)}，每个替换文件只读一次
+_sort_tables = {}
+
+
+def load_sort_table(file='sort.txt'):
+    """
+    把替换表编译成一个正则，长的key优先匹配，一次扫描完成所有替换
+    """
+    if file not in _sort_tables:
+        dic = dict_create(file)
+        keys = sorted(dic, key=len, reverse=True)
+        pattern = re.compile('|'.join(re.escape(key) for key in keys)) if keys else None
+        _sort_tables[file] = (pattern, dic)
+    return _sort_tables[file]
+
+
+def sort_out(sentence, file='sort.txt'):
+    pattern, dic = load_sort_table(file)
+    if pattern is None:
+        return sentence
+    return pattern.sub(lambda m: dic[m.group(0)], sentence)
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _ocr_job(args):
+    folder, filename, resize_num, b = args
+    return pic_to_word(folder, filename, resize_num, b)
+
+
+def ocr_cache_key(digest, resize_num, b):
+    # 同一张图片换了resize_num/b之后识别结果不同，参数也放进key里
+    return '%s:%s:%s' % (digest, resize_num, b)
+
+
+def batch_pic_to_word(folder, resize_num, b, num_workers=None, cache_file=None, sort_file='sort.txt'):
+    """
+    用进程池识别文件夹下所有字幕图片，内容相同的图片只识别一次
+    :param cache_file: 识别结果的缓存(json，key是图片的sha1+resize_num+b)，下次运行时直接使用
+                       识别失败或结果为空的图片不写入缓存，下次运行时重新识别
+    :return: {文件名: sort_out之后的文字}
+    """
+    folder = os.path.join(folder, '')
+    filenames = sorted(name for name in os.listdir(folder)
+                       if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png'))
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'r', encoding='utf8') as f:
+            cache = json.load(f)
+
+    time1 = time.time()
+    keys = {name: ocr_cache_key(file_hash(folder + name), resize_num, b) for name in filenames}
+    # 每个没有缓存的key只识别第一张图片
+    todo = {}
+    for name in filenames:
+        if keys[name] not in cache and keys[name] not in todo:
+            todo[keys[name]] = name
+    jobs = [(folder, name, resize_num, b) for name in todo.values()]
+    results = {key: cache[key] for key in set(keys.values()) if key in cache}
+    if jobs:
+        with Pool(num_workers or cpu_count()) as pool:
+            contents = pool.map(_ocr_job, jobs)
+        results.update(zip(todo.keys(), contents))
+        cache.update((key, content) for key, content in zip(todo.keys(), contents) if content.strip())
+    time2 = time.time()
+
+    if cache_file:
+        with open(cache_file, 'w', encoding='utf8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+    print('%d images (%d ocr, %d cached or duplicate) in %.1f s, %.2f images/sec' % (
+        len(filenames), len(jobs), len(filenames) - len(jobs), time2 - time1,
+        len(filenames) / max(time2 - time1, 1e-6)))
+    return {name: sort_out(results[keys[name]], sort_file) for name in filenames}
 
 
 if __name__ == '__main__':
@@ -58,3 +129,5 @@ if __name__ == '__main__':
     content = pic_to_word(filepath, filename, resize_num, b)
     op = sort_out(content)
     print(op)
+    # 识别整个文件夹
+    # print(batch_pic_to_word(filepath, resize_num, b, cache_file='ocr_cache.json'))
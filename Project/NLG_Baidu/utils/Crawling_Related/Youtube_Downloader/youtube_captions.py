@@ -3,6 +3,8 @@ from PIL import Image
 import numpy as np
 import os
 import datetime
+import time
+from multiprocessing import Pool, cpu_count
 
 # Plz install ffmpeg.exe before call those functions. Just open source code
 # can be found from github, but Below is the link that provide it already
@@ -39,12 +41,88 @@ def ciao(filename, skip_f):
     input('Plz check and modify the ROI size')
 
 
+# 每SAMPLE_STEP帧取一帧，字幕区域是B通道的ROI_ROWS行
+SAMPLE_STEP = 10
+ROI_ROWS = slice(620, 660)
+# 每次对多少个ROI一起计算cal_stderr
+ROI_BATCH = 64
+# 每段至少包含的采样帧数，段太短时seek的开销比跳过的解码更大
+MIN_RANGE_SAMPLES = 100
+
+
+def subtitle_roi(frame):
+    img = frame[:, :, 0]
+    img = img[ROI_ROWS, :]
+    _, img = cv2.threshold(img, 190, 255, cv2.THRESH_BINARY_INV)
+    # _, img = cv2.threshold(img, 250, 255, cv2.THRESH_TRUNC)
+    return img
+
+
+def cal_stderr_batch(imgs, imgos=None):
+    """
+    对[N, H, W]的一组ROI计算cal_stderr，保持uint8的运算(溢出回绕)，结果与逐个计算相同
+    """
+    imgs = np.asarray(imgs)
+    if imgos is not None:
+        imgs = imgs - np.asarray(imgos)
+    per_size = imgs[0].size
+    return (imgs ** 2).reshape(len(imgs), -1).sum(axis=1) / per_size * 100
+
+
+def sample_range(args):
+    """
+    读取一段视频中的采样帧，跳过的帧只grab不解码
+    第k个采样帧是skip_frames + SAMPLE_STEP * k + SAMPLE_STEP - 1，与export_subtitle顺序读取时相同
+    :param args: (video_filename, skip_frames, first_sample, num_samples)，num_samples为None时读到视频结束
+    :return: 非空白的采样帧[(curr_frame, packbits后的ROI)], 最后的curr_frame, 是否读到了视频结束
+    """
+    video_filename, skip_frames, first_sample, num_samples = args
+    videoCap = cv2.VideoCapture(video_filename)
+    curr_frame = skip_frames + SAMPLE_STEP * first_sample
+    if curr_frame > 0:
+        videoCap.set(cv2.CAP_PROP_POS_FRAMES, curr_frame)
+    samples = []
+    frames, rois = [], []
+    finished = False
+    count = 0
+    while num_samples is None or count < num_samples:
+        for j in range(SAMPLE_STEP - 1):
+            videoCap.grab()
+        curr_frame += SAMPLE_STEP
+        success, frame = videoCap.read()
+        if frame is None:
+            finished = True
+            break
+        frames.append(curr_frame)
+        rois.append(subtitle_roi(frame))
+        count += 1
+        if len(rois) == ROI_BATCH:
+            samples.extend(_keep_subtitles(frames, rois))
+            frames, rois = [], []
+    videoCap.release()
+    samples.extend(_keep_subtitles(frames, rois))
+    return samples, curr_frame, finished
+
+
+def _keep_subtitles(frames, rois):
+    # 去掉没有字幕的帧，二值图按bit压缩后再传回主进程
+    if not rois:
+        return []
+    keep = cal_stderr_batch(np.stack(rois)) >= 1
+    return [(f, np.packbits(roi > 0, axis=-1)) for f, roi, k in zip(frames, rois, keep) if k]
+
+
 # Main
 class Pic_ROI():
-    def __init__(self, video_filename, skip_frames):
+    def __init__(self, video_filename, skip_frames, num_workers=1, num_ranges=None):
+        """
+        :param num_workers: 大于1时把视频按时间分成num_ranges段，用进程池并行读取
+        :param num_ranges: 默认为num_workers的4倍
+        """
         self.video_filename = video_filename
         self.skip_frames = skip_frames
-        pass
+        self.num_workers = num_workers
+        self.num_ranges = num_ranges or num_workers * 4
 
     def format_time(self, second):
         hours = second // 3600
@@ -71,38 +149,61 @@ class Pic_ROI():
         except Exception:
             print('export subtitle at %s error' % timeline)
 
+    def sample_ranges(self, total_frames):
+        # 按采样帧的序号平均分段，最后一段读到视频结束，不依赖CAP_PROP_FRAME_COUNT是否准确
+        total_samples = max(0, (total_frames - self.skip_frames) // SAMPLE_STEP)
+        num_ranges = max(1, min(self.num_ranges, total_samples // MIN_RANGE_SAMPLES))
+        bounds = np.linspace(0, total_samples, num_ranges + 1).astype(int)
+        ranges = [(self.video_filename, self.skip_frames, int(bounds[i]), int(bounds[i + 1] - bounds[i]))
+                  for i in range(num_ranges - 1)]
+        ranges.append((self.video_filename, self.skip_frames, int(bounds[-2]), None))
+        return ranges
+
+    def iter_samples(self, total_frames, width):
+        """
+        按顺序产出所有非空白的(curr_frame, ROI)，最后产出(curr_frame, None)表示视频结束
+        """
+        if self.num_workers <= 1:
+            ranges = [(self.video_filename, self.skip_frames, 0, None)]
+            results = map(sample_range, ranges)
+        else:
+            pool = Pool(self.num_workers)
+            # imap保持各段的顺序，前面的段处理完就可以开始合并
+            results = pool.imap(sample_range, self.sample_ranges(total_frames))
+        curr_frame = self.skip_frames
+        try:
+            for samples, curr_frame, finished in results:
+                for frame_idx, bits in samples:
+                    yield frame_idx, np.unpackbits(bits, axis=-1, count=width) * np.uint8(255)
+                if finished:
+                    # 帧数估计偏大时后面的段都是空的
+                    break
+        finally:
+            if self.num_workers > 1:
+                pool.terminate()
+        yield curr_frame, None
+
     def export_subtitle(self):
         ex_folder = os.path.splitext(self.video_filename)[0]
         if not os.path.exists(ex_folder):
             os.mkdir(ex_folder)
         videoCap = cv2.VideoCapture(self.video_filename)
-        for i in range(self.skip_frames):
-            videoCap.read()
+        fps = videoCap.get(cv2.CAP_PROP_FPS)
+        total_frames = int(videoCap.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(videoCap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        videoCap.release()
+        start_time = time.time()
         start_frame = self.skip_frames
         curr_frame = self.skip_frames
-        fps = videoCap.get(cv2.CAP_PROP_FPS)
-        success = True
         subtitle_img = None
         last_img = None
         img_count = 0
-        while success:
-            for j in range(9):
-                videoCap.read()
-                curr_frame += 1
-            success, frame = videoCap.read()
-            curr_frame += 1
-            if frame is None:
+        # 各段的采样帧按顺序合并，字幕跨越分段边界时与顺序读取的结果相同
+        for curr_frame, img in self.iter_samples(total_frames, width):
+            if img is None:
                 print('video: %s finish at %d frame.' % (self.video_filename, curr_frame))
                 break
 
-            img = frame[:, :, 0]
-            img = img[620:660, :]
-            _, img = cv2.threshold(img, 190, 255, cv2.THRESH_BINARY_INV)
-            # _, img = cv2.threshold(img, 250, 255, cv2.THRESH_TRUNC)
-
-            if self.cal_stderr(img) < 1:
-                continue
-
             if img_count == 0:
                 subtitle_img = img
                 print('video: %s add subtitle at %d frame.' % (self.video_filename, curr_frame))
@@ -122,7 +223,9 @@ class Pic_ROI():
         if img_count > 0:
             subtitle_img = Image.fromarray(subtitle_img)
             self.save_image(ex_folder, subtitle_img, int(start_frame / fps), int(curr_frame / fps))
-        print('video: %s export subtitle finish!' % self.video_filename)
+        elapsed = time.time() - start_time
+        print('video: %s export subtitle finish! %.1f frames/sec' % (
+            self.video_filename, (curr_frame - self.skip_frames) / max(elapsed, 1e-6)))
 
     def run(self):
         self.export_subtitle()
@@ -131,5 +234,5 @@ class Pic_ROI():
 if __name__ == "__main__":
     video_filename = 'video/test.mp4'
     # ciao(video_filename, 900)
-    pr = Pic_ROI(video_filename, 900)
+    pr = Pic_ROI(video_filename, 900, num_workers=cpu_count())
     pr.run()
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 SENTENCE_START = '<s>'
@@ -108,6 +109,105 @@ def get_enc_inp_targ_seqs(sequence, max_len, start_id, stop_id):
     return inp
 
 
+def build_train_example(article, abstract, vocab, params, max_enc_len, max_dec_len):
+    """
+    把一条分词后的article/abstract转换成训练用的样本
+    :param article: 空格分隔的article
+    :param abstract: 空格分隔的abstract
+    :return: batcher使用的样本dict
+    """
+    start_decoding = vocab.word_to_id(vocab.START_TOKEN)
+    stop_decoding = vocab.word_to_id(vocab.STOP_TOKEN)
+
+    article_words = article.split()[:max_enc_len]
+
+    enc_input = [vocab.word_to_id(w) for w in article_words]
+    enc_input_extend_vocab, article_oovs = article_to_ids(article_words, vocab)
+    # print('RRRROC: ',enc_input_extend_vocab)
+    # add start and stop flag
+    enc_input = get_enc_inp_targ_seqs(enc_input, max_enc_len, start_decoding, stop_decoding)
+    enc_input_extend_vocab = get_enc_inp_targ_seqs(enc_input_extend_vocab,
+                                                   max_enc_len, start_decoding,
+                                                   stop_decoding)
+
+    # mark长度
+    enc_len = len(enc_input)
+    # 添加mark标记
+    encoder_pad_mask = [1 for _ in range(enc_len)]
+    # print('mask: ', encoder_pad_mask)
+    abstract_words = abstract.split()
+
+    abs_ids = [vocab.word_to_id(w) for w in abstract_words]
+    dec_input, target = get_dec_inp_targ_seqs(abs_ids, max_dec_len, start_decoding, stop_decoding)
+
+    if params['model'] == 'PGN':
+        abs_ids_extend_vocab = abstract_to_ids(abstract_words, vocab, article_oovs)
+        _, target = get_dec_inp_targ_seqs(abs_ids_extend_vocab, max_dec_len, start_decoding, stop_decoding)
+
+    # mark长度
+    dec_len = len(target)
+    # 添加mark标记
+    decoder_pad_mask = [1 for _ in range(dec_len)]
+
+    output = {
+        "enc_len": enc_len,
+        "enc_input": enc_input,
+        "enc_input_extend_vocab": enc_input_extend_vocab,
+        "article_oovs": article_oovs,
+        "dec_input": dec_input,
+        "target": target,
+        "dec_len": dec_len,
+        "article": article,
+        "abstract": abstract,
+        "abstract_sents": abstract,
+        "decoder_pad_mask": decoder_pad_mask,
+        "encoder_pad_mask": encoder_pad_mask
+    }
+    return output
+
+
+def build_test_example(article, vocab, params, max_enc_len):
+    """
+    把一条分词后的article转换成测试用的样本(没有abstract)
+    :param article: 空格分隔的article
+    :return: batcher使用的样本dict
+    """
+    article_words = article.split()[:max_enc_len]
+    enc_len = len(article_words)
+
+    enc_input = [vocab.word_to_id(w) for w in article_words]
+    enc_input_extend_vocab, article_oovs = article_to_ids(article_words, vocab)
+
+    # 添加mark标记
+    encoder_pad_mask = [1 for _ in range(enc_len)]
+
+    output = {
+        "enc_len": enc_len,
+        "enc_input": enc_input,
+        "enc_input_extend_vocab": enc_input_extend_vocab,
+        "article_oovs": article_oovs,
+        "dec_input": [],
+        "target": [],
+        "dec_len": params['max_dec_len'],
+        "article": article,
+        "abstract": '',
+        "abstract_sents": '',
+        "decoder_pad_mask": [],
+        "encoder_pad_mask": encoder_pad_mask
+    }
+    return output
+
+
+def num_repeats(params, mode, batch_size):
+    """
+    eval/test时每条样本重复batch_size次，让单篇的beam_decode能用一个batch放下所有beam；
+    batch_beam_decode一次解码多篇article，不需要重复
+    """
+    if mode == "train" or (mode == "test" and params["batch_beam_decode"]):
+        return 1
+    return batch_size
+
+
 def example_generator(params, vocab, max_enc_len, max_dec_len, mode, batch_size):
     if mode == "train" or mode == 'eval':
         if mode == "train":
@@ -123,91 +223,226 @@ def example_generator(params, vocab, max_enc_len, max_dec_len, mode, batch_size)
             article = raw_record[0].numpy().decode("utf-8")
             abstract = raw_record[1].numpy().decode("utf-8")
 
-            start_decoding = vocab.word_to_id(vocab.START_TOKEN)
-            stop_decoding = vocab.word_to_id(vocab.STOP_TOKEN)
-
-            article_words = article.split()[:max_enc_len]
-
-            enc_input = [vocab.word_to_id(w) for w in article_words]
-            enc_input_extend_vocab, article_oovs = article_to_ids(article_words, vocab)
-            # print('RRRROC: ',enc_input_extend_vocab)
-            # add start and stop flag
-            enc_input = get_enc_inp_targ_seqs(enc_input, max_enc_len, start_decoding, stop_decoding)
-            enc_input_extend_vocab = get_enc_inp_targ_seqs(enc_input_extend_vocab,
-                                                           max_enc_len, start_decoding,
-                                                           stop_decoding)
-
-            # mark长度
-            enc_len = len(enc_input)
-            # 添加mark标记
-            encoder_pad_mask = [1 for _ in range(enc_len)]
-            # print('mask: ', encoder_pad_mask)
-            abstract = raw_record[1].numpy().decode("utf-8")
-            abstract_words = abstract.split()
-
-            abs_ids = [vocab.word_to_id(w) for w in abstract_words]
-            dec_input, target = get_dec_inp_targ_seqs(abs_ids, max_dec_len, start_decoding, stop_decoding)
-
-            if params['model'] == 'PGN':
-                abs_ids_extend_vocab = abstract_to_ids(abstract_words, vocab, article_oovs)
-                _, target = get_dec_inp_targ_seqs(abs_ids_extend_vocab, max_dec_len, start_decoding, stop_decoding)
-
-            # mark长度
-            dec_len = len(target)
-            # 添加mark标记
-            decoder_pad_mask = [1 for _ in range(dec_len)]
-
-            output = {
-                "enc_len": enc_len,
-                "enc_input": enc_input,
-                "enc_input_extend_vocab": enc_input_extend_vocab,
-                "article_oovs": article_oovs,
-                "dec_input": dec_input,
-                "target": target,
-                "dec_len": dec_len,
-                "article": article,
-                "abstract": abstract,
-                "abstract_sents": abstract,
-                "decoder_pad_mask": decoder_pad_mask,
-                "encoder_pad_mask": encoder_pad_mask
-            }
-            if mode == "eval":
-                for _ in range(batch_size):
-                    yield output
-            else:
-                # print('output: ', output)
+            output = build_train_example(article, abstract, vocab, params, max_enc_len, max_dec_len)
+            for _ in range(num_repeats(params, mode, batch_size)):
                 yield output
     else:
         train_dataset = tf.data.TextLineDataset(params["test_seg_x_dir"])
         for raw_record in train_dataset:
             article = raw_record.numpy().decode("utf-8")
-            article_words = article.split()[:max_enc_len]
-            enc_len = len(article_words)
-
-            enc_input = [vocab.word_to_id(w) for w in article_words]
-            enc_input_extend_vocab, article_oovs = article_to_ids(article_words, vocab)
-
-            # 添加mark标记
-            encoder_pad_mask = [1 for _ in range(enc_len)]
-
-            output = {
-                "enc_len": enc_len,
-                "enc_input": enc_input,
-                "enc_input_extend_vocab": enc_input_extend_vocab,
-                "article_oovs": article_oovs,
-                "dec_input": [],
-                "target": [],
-                "dec_len": params['max_dec_len'],
-                "article": article,
-                "abstract": '',
-                "abstract_sents": '',
-                "decoder_pad_mask": [],
-                "encoder_pad_mask": encoder_pad_mask
-            }
-            for _ in range(batch_size):
+
+            output = build_test_example(article, vocab, params, max_enc_len)
+            for _ in range(num_repeats(params, mode, batch_size)):
                 yield output
 
 
+def graph_example_dataset(params, vocab, max_enc_len, max_dec_len, mode, batch_size):
+    """
+    与example_generator输出相同的样本dict，但全部用tf op实现(查表、切分、截断、加start/stop)，
+    可以在tf.data里并行map，不受GIL限制
+    """
+    keys = list(vocab.word2id.keys())
+    values = [vocab.word2id[k] for k in keys]
+    table = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(tf.constant(keys), tf.constant(values, dtype=tf.int32)),
+        default_value=vocab.word_to_id(vocab.UNKNOWN_TOKEN))
+    unk_id = vocab.word_to_id(vocab.UNKNOWN_TOKEN)
+    start_id = vocab.word_to_id(vocab.START_TOKEN)
+    stop_id = vocab.word_to_id(vocab.STOP_TOKEN)
+    vocab_size = vocab.size()
+
+    def article_to_ids_graph(article_words):
+        # 与article_to_ids相同，oov按照在article中第一次出现的顺序编号
+        ids = table.lookup(article_words)
+        is_oov = tf.equal(ids, unk_id)
+        article_oovs, oov_idx = tf.unique(tf.boolean_mask(article_words, is_oov))
+        ids_extend_vocab = tf.tensor_scatter_nd_update(ids, tf.where(is_oov), vocab_size + oov_idx)
+        return ids, ids_extend_vocab, article_oovs
+
+    def abstract_to_ids_graph(abstract_words, abs_ids, article_oovs):
+        # 与abstract_to_ids相同，在article中出现过的oov映射到临时id，否则保持UNK
+        # 末尾补一个空字符串，避免article没有oov时argmax的维度为0
+        candidates = tf.concat([article_oovs, [""]], axis=0)
+        matches = tf.equal(tf.expand_dims(abstract_words, 1), tf.expand_dims(candidates, 0))
+        in_article = tf.logical_and(tf.equal(abs_ids, unk_id), tf.reduce_any(matches, axis=1))
+        oov_pos = tf.argmax(tf.cast(matches, tf.int32), axis=1, output_type=tf.int32)
+        return tf.where(in_article, vocab_size + oov_pos, abs_ids)
+
+    def train_map(article, abstract):
+        article_words = tf.strings.split(article)[:max_enc_len]
+        enc_input, enc_input_extend_vocab, article_oovs = article_to_ids_graph(article_words)
+        # 等价于get_enc_inp_targ_seqs: 加上start/stop后截断到max_enc_len
+        enc_input = tf.concat([[start_id], enc_input, [stop_id]], axis=0)[:max_enc_len]
+        enc_input_extend_vocab = tf.concat([[start_id], enc_input_extend_vocab, [stop_id]], axis=0)[:max_enc_len]
+        enc_len = tf.shape(enc_input)[0]
+
+        abstract_words = tf.strings.split(abstract)
+        abs_ids = table.lookup(abstract_words)
+        # 等价于get_dec_inp_targ_seqs
+        dec_input = tf.concat([[start_id], abs_ids, [stop_id]], axis=0)[:max_dec_len]
+        if params['model'] == 'PGN':
+            abs_ids = abstract_to_ids_graph(abstract_words, abs_ids, article_oovs)
+        target = tf.concat([abs_ids, [stop_id]], axis=0)[:max_dec_len]
+        dec_len = tf.shape(target)[0]
+
+        return {
+            "enc_len": enc_len,
+            "enc_input": enc_input,
+            "enc_input_extend_vocab": enc_input_extend_vocab,
+            "article_oovs": article_oovs,
+            "dec_input": dec_input,
+            "target": target,
+            "dec_len": dec_len,
+            "article": article,
+            "abstract": abstract,
+            "abstract_sents": abstract,
+            "decoder_pad_mask": tf.ones([dec_len], dtype=tf.int32),
+            "encoder_pad_mask": tf.ones([enc_len], dtype=tf.int32)
+        }
+
+    def test_map(article):
+        article_words = tf.strings.split(article)[:max_enc_len]
+        enc_input, enc_input_extend_vocab, article_oovs = article_to_ids_graph(article_words)
+        enc_len = tf.shape(enc_input)[0]
+        return {
+            "enc_len": enc_len,
+            "enc_input": enc_input,
+            "enc_input_extend_vocab": enc_input_extend_vocab,
+            "article_oovs": article_oovs,
+            "dec_input": tf.zeros([0], dtype=tf.int32),
+            "target": tf.zeros([0], dtype=tf.int32),
+            "dec_len": tf.constant(params['max_dec_len'], dtype=tf.int32),
+            "article": article,
+            "abstract": tf.constant(''),
+            "abstract_sents": tf.constant(''),
+            "decoder_pad_mask": tf.zeros([0], dtype=tf.int32),
+            "encoder_pad_mask": tf.ones([enc_len], dtype=tf.int32)
+        }
+
+    if mode == "train" or mode == "eval":
+        prefix = "train" if mode == "train" else "val"
+        dataset = tf.data.Dataset.zip((tf.data.TextLineDataset(params["{}_seg_x_dir".format(prefix)]),
+                                       tf.data.TextLineDataset(params["{}_seg_y_dir".format(prefix)])))
+        dataset = dataset.map(train_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    else:
+        dataset = tf.data.TextLineDataset(params["test_seg_x_dir"])
+        dataset = dataset.map(test_map, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    repeats = num_repeats(params, mode, batch_size)
+    if repeats > 1:
+        # 与example_generator一样，eval/test时每条样本重复batch_size次
+        dataset = dataset.flat_map(lambda x: tf.data.Dataset.from_tensors(x).repeat(repeats))
+    return dataset
+
+
+def padded_batch_and_split(dataset, vocab, max_dec_len, batch_size, bucket_boundaries=None, drop_remainder=True):
+    """
+    把样本dict组成batch，并拆分成encoder/decoder两部分
+    :param bucket_boundaries: enc_len的分桶边界，例如[50, 100, 150]。为None时按顺序组batch
+    :param drop_remainder: 是否丢弃最后不满batch_size的batch
+    """
+    padded_shapes = {"enc_len": [],
+                     "enc_input": [None],
+                     "enc_input_extend_vocab": [None],
+                     "article_oovs": [None],
+                     "dec_input": [max_dec_len],
+                     "target": [max_dec_len],
+                     "dec_len": [],
+                     "article": [],
+                     "abstract": [],
+                     "abstract_sents": [],
+                     "decoder_pad_mask": [max_dec_len],
+                     "encoder_pad_mask": [None]
+                     }
+    padding_values = {"enc_len": -1,
+                      "enc_input": vocab.word2id[vocab.PAD_TOKEN],
+                      "enc_input_extend_vocab": vocab.word2id[vocab.PAD_TOKEN],
+                      "article_oovs": b'',
+                      "dec_input": vocab.word2id[vocab.PAD_TOKEN],
+                      "target": vocab.word2id[vocab.PAD_TOKEN],
+                      "dec_len": -1,
+                      "article": b"",
+                      "abstract": b"",
+                      "abstract_sents": b'',
+                      "decoder_pad_mask": 0,
+                      "encoder_pad_mask": 0
+                      }
+    if bucket_boundaries:
+        # 长度相近的样本放到同一个batch里，encoder只需要pad到桶内最长的样本
+        # decoder仍然pad到max_dec_len，保证PGN按dec_input.shape[1]展开的步数不变
+        dataset = dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+            element_length_func=lambda entry: entry["enc_len"],
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+            padded_shapes=padded_shapes,
+            padding_values=padding_values,
+            drop_remainder=drop_remainder))
+    else:
+        dataset = dataset.padded_batch(batch_size,
+                                       padded_shapes=padded_shapes,
+                                       padding_values=padding_values,
+                                       drop_remainder=drop_remainder)
+
+    def update(entry):
+        return ({"enc_input": entry["enc_input"],
+                 "extended_enc_input": entry["enc_input_extend_vocab"],
+                 "article_oovs": entry["article_oovs"],
+                 "enc_len": entry["enc_len"],
+                 "article": entry["article"],
+                 "max_oov_len": tf.shape(entry["article_oovs"])[1],
+                 "encoder_pad_mask": entry["encoder_pad_mask"]},
+
+                {"dec_input": entry["dec_input"],
+                 "dec_target": entry["target"],
+                 "dec_len": entry["dec_len"],
+                 "abstract": entry["abstract"],
+                 "decoder_pad_mask": entry["decoder_pad_mask"]})
+
+    dataset = dataset.map(update)
+    return dataset
+
+
+def _bucket_boundaries(params, mode):
+    # eval/test时同一条样本会重复batch_size次组成一个batch，不能分桶
+    return params["bucket_boundaries"] if mode == "train" else None
+
+
+def _drop_remainder(params, mode):
+    # batch_beam_decode要解码完整的测试集，保留最后一个不满的batch
+    return not (mode == "test" and params["batch_beam_decode"])
+
+
+def encoder_batch(examples, vocab):
+    """
+    不经过tf.data，直接把build_test_example生成的样本pad成一个batch的encoder部分
+    字段和padding值与padded_batch_and_split的encoder部分相同，用于在线推理
+    :param examples: 样本dict list
+    :return: (enc_batch, {})，与batcher产出的batch结构一致
+    """
+    pad_id = vocab.word2id[vocab.PAD_TOKEN]
+    num_examples = len(examples)
+    max_enc_len = max(e["enc_len"] for e in examples)
+    max_oov_len = max(len(e["article_oovs"]) for e in examples)
+    enc_input = np.full([num_examples, max_enc_len], pad_id, dtype=np.int32)
+    extended_enc_input = np.full([num_examples, max_enc_len], pad_id, dtype=np.int32)
+    encoder_pad_mask = np.zeros([num_examples, max_enc_len], dtype=np.int32)
+    article_oovs = np.full([num_examples, max_oov_len], b'', dtype=object)
+    for i, e in enumerate(examples):
+        enc_input[i, :e["enc_len"]] = e["enc_input"]
+        extended_enc_input[i, :e["enc_len"]] = e["enc_input_extend_vocab"]
+        encoder_pad_mask[i, :e["enc_len"]] = e["encoder_pad_mask"]
+        article_oovs[i, :len(e["article_oovs"])] = [w.encode('utf-8') if isinstance(w, str) else w
+                                                    for w in e["article_oovs"]]
+    enc_batch = {"enc_input": tf.constant(enc_input),
+                 "extended_enc_input": tf.constant(extended_enc_input),
+                 "article_oovs": tf.constant(article_oovs, dtype=tf.string, shape=[num_examples, max_oov_len]),
+                 "enc_len": tf.constant([e["enc_len"] for e in examples], dtype=tf.int32),
+                 "article": tf.constant([e["article"] for e in examples], dtype=tf.string),
+                 "max_oov_len": tf.constant(max_oov_len, dtype=tf.int32),
+                 "encoder_pad_mask": tf.constant(encoder_pad_mask)}
+    return enc_batch, {}
+
+
 def batch_generator(generator, params, vocab, max_enc_len, max_dec_len, batch_size, mode):
     dataset = tf.data.Dataset.from_generator(
         lambda: generator(params, vocab, max_enc_len, max_dec_len, mode, batch_size),
@@ -239,56 +474,38 @@ def batch_generator(generator, params, vocab, max_enc_len, max_dec_len, batch_si
             "decoder_pad_mask": [None],
             "encoder_pad_mask": [None]
         })
+    return padded_batch_and_split(dataset, vocab, max_dec_len, batch_size, _bucket_boundaries(params, mode),
+                                  _drop_remainder(params, mode))
 
-    dataset = dataset.padded_batch(batch_size,
-                                   padded_shapes=({"enc_len": [],
-                                                   "enc_input": [None],
-                                                   "enc_input_extend_vocab": [None],
-                                                   "article_oovs": [None],
-                                                   "dec_input": [max_dec_len],
-                                                   "target": [max_dec_len],
-                                                   "dec_len": [],
-                                                   "article": [],
-                                                   "abstract": [],
-                                                   "abstract_sents": [],
-                                                   "decoder_pad_mask": [max_dec_len],
-                                                   "encoder_pad_mask": [None]
-                                                   }),
-                                   padding_values={"enc_len": -1,
-                                                   "enc_input": vocab.word2id[vocab.PAD_TOKEN],
-                                                   "enc_input_extend_vocab": vocab.word2id[vocab.PAD_TOKEN],
-                                                   "article_oovs": b'',
-                                                   "dec_input": vocab.word2id[vocab.PAD_TOKEN],
-                                                   "target": vocab.word2id[vocab.PAD_TOKEN],
-                                                   "dec_len": -1,
-                                                   "article": b"",
-                                                   "abstract": b"",
-                                                   "abstract_sents": b'',
-                                                   "decoder_pad_mask": 0,
-                                                   "encoder_pad_mask": 0
-                                                   },
-                                   drop_remainder=True)
 
-    def update(entry):
-        return ({"enc_input": entry["enc_input"],
-                 "extended_enc_input": entry["enc_input_extend_vocab"],
-                 "article_oovs": entry["article_oovs"],
-                 "enc_len": entry["enc_len"],
-                 "article": entry["article"],
-                 "max_oov_len": tf.shape(entry["article_oovs"])[1],
-                 "encoder_pad_mask": entry["encoder_pad_mask"]},
-
-                {"dec_input": entry["dec_input"],
-                 "dec_target": entry["target"],
-                 "dec_len": entry["dec_len"],
-                 "abstract": entry["abstract"],
-                 "decoder_pad_mask": entry["decoder_pad_mask"]})
-
-    dataset = dataset.map(update)
-    return dataset
+def graph_batch_generator(params, vocab, max_enc_len, max_dec_len, batch_size, mode):
+    dataset = graph_example_dataset(params, vocab, max_enc_len, max_dec_len, mode, batch_size)
+    dataset = padded_batch_and_split(dataset, vocab, max_dec_len, batch_size, _bucket_boundaries(params, mode),
+                                     _drop_remainder(params, mode))
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
 
 def batcher(vocab, params):
+    if params["batcher_mode"] == "graph":
+        return graph_batch_generator(params,
+                                     vocab,
+                                     params["max_enc_len"],
+                                     params["max_dec_len"],
+                                     params["batch_size"],
+                                     params["mode"])
+    if params["batcher_mode"] == "shards":
+        # 从预编译的token id分片中读取，不再逐词查词典
+        from utils.shard_utils import shard_example_dataset
+        dataset = shard_example_dataset(params,
+                                        vocab,
+                                        params["max_enc_len"],
+                                        params["max_dec_len"],
+                                        params["mode"],
+                                        params["batch_size"])
+        dataset = padded_batch_and_split(dataset, vocab, params["max_dec_len"], params["batch_size"],
+                                         _bucket_boundaries(params, params["mode"]),
+                                         _drop_remainder(params, params["mode"]))
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
     dataset = batch_generator(example_generator,
                               params,
                               vocab,
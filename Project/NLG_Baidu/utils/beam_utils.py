@@ -0,0 +1,139 @@
+import numpy as np
+import tensorflow as tf
+
+
+def top_k_candidates(step_dists, beam_size, log_dists=False):
+    """
+    每个假设只取概率最高的2 * beam_size个候选，log只对这些候选计算
+    同分时id小的在前(tf.nn.top_k)，与对整行稳定排序的结果相同
+    :param step_dists: [num_articles * beam_size, extended_vsize] decoder输出的概率(log_dists=True时为log概率)
+    :return: 候选的log概率和id，都是[num_articles * beam_size, 2 * beam_size]的numpy数组
+    """
+    k = min(beam_size * 2, int(step_dists.shape[-1]))
+    values, ids = tf.nn.top_k(step_dists, k=k)
+    values = values.numpy()
+    if not log_dists:
+        with np.errstate(divide='ignore'):
+            values = np.log(values)
+    return values, ids.numpy()
+
+
+class BeamState:
+    """
+    beam search的假设集合，num_articles篇文章 x beam_size个假设，全部保存在预分配的数组里
+    每一步只写入新token和父节点下标，需要完整序列时再回溯，所以每步的开销不随已解码长度增长
+    第n篇文章的第k个假设对应第n * beam_size + k行，与decoder状态的行顺序一致
+    """
+
+    def __init__(self, num_articles, beam_size, max_steps, start_index):
+        """
+        :param num_articles: 同时解码的文章数
+        :param beam_size: 每篇文章保留的假设数
+        :param max_steps: 最大解码步数
+        :param start_index: 开始符id
+        """
+        self.num_articles = num_articles
+        self.beam_size = beam_size
+        self.max_steps = max_steps
+        num_rows = num_articles * beam_size
+
+        # tokens[t, row] 是第row行假设在第t步的token，parents[t, row]是它在第t-1步的行号
+        self.tokens = np.zeros([max_steps + 1, num_rows], dtype=np.int32)
+        self.tokens[0] = start_index
+        self.parents = np.zeros([max_steps + 1, num_rows], dtype=np.int32)
+
+        # 第0步所有beam都一样，只保留第一个beam，避免top k选出重复的假设
+        self.log_probs = np.full([num_articles, beam_size], -np.inf, dtype=np.float32)
+        self.log_probs[:, 0] = 0.0
+        # 当前所有假设的长度都是steps + 1(包含开始符)
+        self.steps = 0
+
+        # 每篇文章结束的假设: 平均log概率、长度、结束所在的步数和行号
+        self.finished_scores = np.full([num_articles, beam_size], -np.inf, dtype=np.float32)
+        self.finished_lengths = np.zeros([num_articles, beam_size], dtype=np.int32)
+        self.finished_steps = np.zeros([num_articles, beam_size], dtype=np.int32)
+        self.finished_rows = np.zeros([num_articles, beam_size], dtype=np.int32)
+        self.num_finished = np.zeros([num_articles], dtype=np.int32)
+
+    @property
+    def done(self):
+        return self.steps >= self.max_steps or bool(np.all(self.num_finished >= self.beam_size))
+
+    def latest_tokens(self, vocab_size, unk_index):
+        # 扩展词表中的oov id不能作为decoder的输入，替换成unknown token
+        latest = self.tokens[self.steps]
+        return np.where(latest < vocab_size, latest, unk_index)
+
+    def advance(self, cand_log_probs, cand_ids, stop_index, min_dec_steps):
+        """
+        用当前步每个假设的候选扩展所有假设，每篇文章保留beam_size个未结束的假设
+        每篇文章的top 2K一定在各假设自己的top 2K之中，所以只需传入每行的top 2K(见top_k_candidates)
+        :param cand_log_probs: [num_articles * beam_size, num_cands] 按概率降序的候选log概率
+        :param cand_ids: [num_articles * beam_size, num_cands] 候选在扩展词表中的id
+        :param stop_index: 结束符id
+        :param min_dec_steps: 少于该步数遇到结束符的假设直接丢弃
+        :return: 新假设对应的旧行号，用来gather decoder的hidden/coverage等状态
+        """
+        num_articles, beam_size = self.num_articles, self.beam_size
+        num_cands = cand_ids.shape[-1]
+
+        # [N * K, C] -> [N, K * C]，在每篇文章的K * C个候选中选top 2K，同分时靠前的beam/id优先
+        total_log_probs = (self.log_probs.reshape([-1, 1]) + cand_log_probs).reshape([num_articles, -1])
+        top_k_ids = np.argsort(-total_log_probs, axis=1, kind='stable')[:, :beam_size * 2]
+        top_k_log_probs = np.take_along_axis(total_log_probs, top_k_ids, axis=1)
+        parents = top_k_ids // num_cands + np.arange(num_articles)[:, None] * beam_size
+        new_tokens = np.take_along_axis(cand_ids.reshape([num_articles, -1]), top_k_ids, axis=1)
+
+        # 按概率顺序，每篇文章保留前beam_size个未结束的候选
+        is_stop = new_tokens == stop_index
+        is_valid = np.isfinite(top_k_log_probs)
+        is_live = ~is_stop & is_valid
+        live_count = np.cumsum(is_live, axis=1)
+        keep_live = is_live & (live_count <= beam_size)
+
+        if self.steps >= min_dec_steps:
+            # 排在第beam_size个未结束候选之前的结束符，长度符合预期，加入结果集
+            live_before = live_count - is_live
+            for n, j in zip(*np.nonzero(is_stop & is_valid & (live_before < beam_size))):
+                slot = self.num_finished[n]
+                if slot >= beam_size:
+                    continue
+                # 长度包含开始符和结束符
+                length = self.steps + 2
+                self.finished_scores[n, slot] = top_k_log_probs[n, j] / length
+                self.finished_lengths[n, slot] = length
+                self.finished_steps[n, slot] = self.steps
+                self.finished_rows[n, slot] = parents[n, j]
+                self.num_finished[n] += 1
+
+        # 保留的候选排到前面，不满beam_size的位置概率置为-inf
+        order = np.argsort(~keep_live, axis=1, kind='stable')[:, :beam_size]
+        selected = np.take_along_axis(keep_live, order, axis=1)
+        self.log_probs = np.where(selected, np.take_along_axis(top_k_log_probs, order, axis=1),
+                                  -np.inf).astype(np.float32)
+        rows = np.take_along_axis(parents, order, axis=1).reshape(-1)
+
+        self.steps += 1
+        self.tokens[self.steps] = np.take_along_axis(new_tokens, order, axis=1).reshape(-1)
+        self.parents[self.steps] = rows
+        return rows
+
+    def _backtrack(self, step, row):
+        # 从第step步的第row行沿parents回溯出完整的token序列
+        tokens = np.zeros([step + 1], dtype=np.int32)
+        for t in range(step, -1, -1):
+            tokens[t] = self.tokens[t, row]
+            row = self.parents[t, row]
+        return tokens
+
+    def best_tokens(self, n, stop_index):
+        """
+        第n篇文章平均log概率最高的假设，没有结束的假设时从当前的beam中选
+        """
+        num_finished = self.num_finished[n]
+        if num_finished > 0:
+            best = int(np.argmax(self.finished_scores[n, :num_finished]))
+            tokens = self._backtrack(self.finished_steps[n, best], self.finished_rows[n, best])
+            return list(tokens) + [stop_index]
+        best = int(np.argmax(self.log_probs[n]))
+        return list(self._backtrack(self.steps, n * self.beam_size + best))
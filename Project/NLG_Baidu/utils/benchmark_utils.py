@@ -0,0 +1,186 @@
+import os
+import time
+
+import numpy as np
+
+import tensorflow as tf
+
+from utils.batcher_utils import batcher, article_to_ids
+from utils.embedding import Vocab, ArrayVocab
+from utils.train_utils import compile_train_step, train_step_args
+
+
+def benchmark_dataset(dataset, num_batches, batch_size, warmup_batches=1):
+    """
+    统计dataset每秒能产出多少条样本
+    :param dataset: batcher返回的dataset
+    :param num_batches: 计时的batch数
+    :param batch_size: 每个batch的样本数
+    :param warmup_batches: 不计时的预热batch数(建表、打开文件等)
+    :return: examples/sec
+    """
+    iterator = iter(dataset)
+    for _ in range(warmup_batches):
+        next(iterator)
+
+    count = 0
+    start_time = time.time()
+    for _ in range(num_batches):
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        count += 1
+    elapsed = time.time() - start_time
+    return count * batch_size / elapsed if elapsed > 0 else 0.0
+
+
+def benchmark_batcher(vocab, params, num_batches=50):
+    """
+    对比各个batcher_mode的吞吐，shards模式只有在compile之后才参与对比
+    """
+    batcher_modes = ["generator", "graph"]
+    if os.path.exists(os.path.join(params["shard_dir"], params["mode"], "meta.json")):
+        batcher_modes.append("shards")
+
+    results = {}
+    for batcher_mode in batcher_modes:
+        bench_params = dict(params, batcher_mode=batcher_mode)
+        dataset = batcher(vocab, bench_params)
+        results[batcher_mode] = benchmark_dataset(dataset, num_batches, params["batch_size"])
+        print('batcher_mode {:<10} {:.1f} examples/sec'.format(batcher_mode, results[batcher_mode]))
+    return results
+
+
+def padding_report(dataset, num_batches):
+    """
+    统计batch中真实token占比，pad越多GRU在pad上浪费的计算越多
+    :return: dict, encoder/decoder的pad占比
+    """
+    enc_real = enc_total = dec_real = dec_total = 0
+    for enc_batch, dec_batch in dataset.take(num_batches):
+        enc_mask = enc_batch["encoder_pad_mask"].numpy()
+        dec_mask = dec_batch["decoder_pad_mask"].numpy()
+        enc_real += enc_mask.sum()
+        enc_total += enc_mask.size
+        dec_real += dec_mask.sum()
+        dec_total += dec_mask.size
+    return {"encoder_padding": 1 - enc_real / max(enc_total, 1),
+            "decoder_padding": 1 - dec_real / max(dec_total, 1)}
+
+
+def benchmark_padding(vocab, params, num_batches=50):
+    """
+    对比不分桶和按bucket_boundaries分桶时的pad占比
+    """
+    results = {}
+    for name, boundaries in [("no_bucket", None), ("bucket", params["bucket_boundaries"])]:
+        if name == "bucket" and not boundaries:
+            print('bucket_boundaries is not set, skip bucket padding report')
+            continue
+        dataset = batcher(vocab, dict(params, bucket_boundaries=boundaries))
+        results[name] = padding_report(dataset, num_batches)
+        print('{:<10} encoder padding {:.2%} decoder padding {:.2%}'.format(name,
+                                                                           results[name]["encoder_padding"],
+                                                                           results[name]["decoder_padding"]))
+    return results
+
+
+def _build_train_step(params, vocab, dataset):
+    # 按模型构建一个新的model和train_step，避免各模式之间共享optimizer状态
+    if params["model"] == "PGN":
+        from PGN_tf2.models.PGN import PGN
+        from PGN_tf2.helpers import train_helper
+        model = PGN(params)
+        train_step = train_helper.make_train_step(model, train_helper.get_optimizer(params), params)
+    else:
+        from seq2seq_tf2.models.seq2seq import SequenceToSequence
+        from seq2seq_tf2.helpers import train_helper
+        model = SequenceToSequence(params)
+        train_step = train_helper.make_train_step(model, train_helper.get_optimizer(params), params, vocab)
+    keys = train_helper.TRAIN_STEP_KEYS
+    return compile_train_step(train_step, dataset, keys, params), keys
+
+
+def _run_train_step(train_step, batch, keys):
+    # 取出loss的值，保证计时包含了这一步的全部计算
+    return float(tf.nest.flatten(train_step(*train_step_args(batch, keys)))[0])
+
+
+def benchmark_train_step(vocab, params, num_batches=50):
+    """
+    对比eager、tf.function以及tf.function + XLA下train_step的steps/sec
+    第一个step包含trace/编译时间，不计入
+    """
+    dataset = batcher(vocab, params)
+    run_modes = [("eager", False, False), ("tf_function", True, False), ("tf_function_xla", True, True)]
+
+    results = {}
+    for name, use_tf_function, use_xla in run_modes:
+        bench_params = dict(params, use_tf_function=use_tf_function, use_xla=use_xla)
+        train_step, keys = _build_train_step(bench_params, vocab, dataset)
+        batches = iter(dataset)
+        _run_train_step(train_step, next(batches), keys)
+
+        count = 0
+        start_time = time.time()
+        for batch in batches:
+            if count == num_batches:
+                break
+            _run_train_step(train_step, batch, keys)
+            count += 1
+        elapsed = time.time() - start_time
+        results[name] = count / elapsed if elapsed > 0 else 0.0
+        print('{:<16} {:.2f} steps/sec'.format(name, results[name]))
+    return results
+
+
+def benchmark_vocab(params, num_batches=50):
+    """
+    分别对比dict词典逐词查找和ArrayVocab整batch编码、解码的速度
+    使用train_seg_x_dir的前num_batches * batch_size篇文章
+    """
+    batch_size = params["batch_size"]
+    batches = []
+    with open(params["train_seg_x_dir"], 'r', encoding='utf-8') as f:
+        batch = []
+        for line in f:
+            batch.append(line.split()[:params["max_enc_len"]])
+            if len(batch) == batch_size:
+                batches.append(batch)
+                batch = []
+                if len(batches) == num_batches:
+                    break
+    num_words = sum(len(words) for batch in batches for words in batch)
+
+    dict_vocab = Vocab(params["vocab_path"], params["vocab_size"])
+    array_vocab = ArrayVocab(params["vocab_path"], params["vocab_size"])
+
+    results = {}
+    # 编码：batcher使用的逐词article_to_ids和ArrayVocab.encode_batch
+    start_time = time.time()
+    encoded = [[article_to_ids(words, dict_vocab) for words in batch] for batch in batches]
+    results["encode_dict"] = num_words / (time.time() - start_time)
+
+    start_time = time.time()
+    for batch in batches:
+        array_vocab.encode_batch(batch, extend_oov=True)
+    results["encode_array"] = num_words / (time.time() - start_time)
+
+    # 解码：同样的扩展词表id矩阵和article oov
+    id_batches = []
+    for batch in encoded:
+        lengths = [len(ids) for ids, _ in batch]
+        id_matrix = np.zeros([len(batch), max(lengths)], dtype=np.int64)
+        for n, (ids, _) in enumerate(batch):
+            id_matrix[n, :len(ids)] = ids
+        id_batches.append((id_matrix, [oovs for _, oovs in batch], lengths))
+    for name, vocab in (("decode_dict", dict_vocab), ("decode_array", array_vocab)):
+        start_time = time.time()
+        for id_matrix, batch_oovs, lengths in id_batches:
+            vocab.decode_batch(id_matrix, batch_oovs, lengths=lengths)
+        results[name] = num_words / (time.time() - start_time)
+
+    for name, words_per_sec in results.items():
+        print('vocab {:<12} {:.0f} words/sec'.format(name, words_per_sec))
+    return results
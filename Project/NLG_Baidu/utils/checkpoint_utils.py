@@ -0,0 +1,142 @@
+import os
+import queue
+import threading
+
+import tensorflow as tf
+
+
+class AsyncCheckpointWriter:
+    """
+    在后台线程写checkpoint，训练线程只需要把变量复制到快照变量中
+    只保存trainable_variables，不可训练的embedding矩阵(可以从word2vec重新载入)不写入checkpoint
+    ema_decay > 0时同时维护权重的指数滑动平均，解码时可以用restore_weights(use_ema=True)载入
+
+    checkpoint中保存的是变量list，恢复前模型的变量必须已经创建(build_variables)
+    """
+
+    def __init__(self, model, checkpoint_dir, max_to_keep=5, ema_decay=0.0):
+        self.variables = model.trainable_variables
+        self.ema_decay = ema_decay
+        # 快照变量，写checkpoint期间训练可以继续更新模型的变量
+        self.snapshots = [tf.Variable(v, trainable=False) for v in self.variables]
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        objects = {"step": self.step, "weights": self.snapshots}
+        self.ema_variables = None
+        if ema_decay > 0:
+            self.ema_variables = [tf.Variable(v, trainable=False) for v in self.variables]
+            self.ema_snapshots = [tf.Variable(v, trainable=False) for v in self.variables]
+            objects["ema_weights"] = self.ema_snapshots
+        self.ckpt = tf.train.Checkpoint(**objects)
+        self.manager = tf.train.CheckpointManager(self.ckpt, checkpoint_dir, max_to_keep=max_to_keep)
+        self.latest_checkpoint = self.manager.latest_checkpoint
+
+        self.requests = queue.Queue()
+        self.error = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            number = self.requests.get()
+            try:
+                if number is not None:
+                    path = self.manager.save(checkpoint_number=number)
+                    print('async checkpoint saved to {}'.format(path))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.requests.task_done()
+            if number is None:
+                return
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    @tf.function
+    def _update_ema(self):
+        for ema, v in zip(self.ema_variables, self.variables):
+            ema.assign(self.ema_decay * ema + (1 - self.ema_decay) * v)
+
+    def after_step(self):
+        """
+        每个训练step之后调用，更新滑动平均
+        """
+        if self.ema_variables is not None:
+            self._update_ema()
+
+    def save(self, checkpoint_number=None):
+        """
+        复制当前变量后立即返回，与CheckpointManager.save的用法相同
+        上一次的写入还没有完成时先等待，避免覆盖正在写的快照
+        :return: checkpoint的路径前缀(后台写完后才存在)
+        """
+        self.requests.join()
+        self._check_error()
+        if checkpoint_number is None:
+            checkpoint_number = int(self.step) + 1
+        for snapshot, v in zip(self.snapshots, self.variables):
+            snapshot.assign(v)
+        if self.ema_variables is not None:
+            for snapshot, ema in zip(self.ema_snapshots, self.ema_variables):
+                snapshot.assign(ema)
+        self.step.assign(checkpoint_number)
+        self.requests.put(checkpoint_number)
+        return os.path.join(self.manager.directory, 'ckpt-{}'.format(checkpoint_number))
+
+    def restore(self):
+        """
+        从最新的checkpoint继续训练，恢复权重和滑动平均
+        """
+        if not self.latest_checkpoint:
+            return None
+        self.ckpt.restore(self.latest_checkpoint).expect_partial().assert_existing_objects_matched()
+        for v, snapshot in zip(self.variables, self.snapshots):
+            v.assign(snapshot)
+        if self.ema_variables is not None:
+            # 之前没有保存滑动平均时从当前权重开始
+            source = self.ema_snapshots if _has_ema(self.latest_checkpoint) else self.snapshots
+            for ema, snapshot in zip(self.ema_variables, source):
+                ema.assign(snapshot)
+        return self.latest_checkpoint
+
+    def close(self):
+        """
+        等待所有checkpoint写完
+        """
+        self.requests.put(None)
+        self.requests.join()
+        self.worker.join()
+        self._check_error()
+
+
+def _num_saved(checkpoint_path, key):
+    # weights/0/.ATTRIBUTES/VARIABLE_VALUE, weights/1/...
+    return len([name for name, _ in tf.train.list_variables(checkpoint_path) if name.startswith(key + '/')])
+
+
+def _has_ema(checkpoint_path):
+    return _num_saved(checkpoint_path, 'ema_weights') > 0
+
+
+def restore_weights(model, checkpoint_dir, use_ema=False):
+    """
+    把AsyncCheckpointWriter写的最新checkpoint载入模型，模型的变量需要已经创建
+    :param use_ema: 载入滑动平均的权重
+    :return: 载入的checkpoint路径，没有checkpoint时为None
+    """
+    latest = tf.train.latest_checkpoint(checkpoint_dir)
+    if not latest:
+        return None
+    if use_ema and not _has_ema(latest):
+        raise ValueError('{} has no ema weights, train with --ema_decay to save them'.format(latest))
+    key = "ema_weights" if use_ema else "weights"
+    num_saved = _num_saved(latest, key)
+    if num_saved != len(model.trainable_variables):
+        raise ValueError('{} has {} weights but the model has {} trainable variables, '
+                         'call build_variables() first and check the model params'.format(
+                             latest, num_saved, len(model.trainable_variables)))
+    ckpt = tf.train.Checkpoint(**{key: model.trainable_variables})
+    ckpt.restore(latest).expect_partial().assert_existing_objects_matched()
+    return latest
@@ -17,12 +17,30 @@ def load_pkl(pkl_path):
 def load_word2vec(params, max_vocab_size=30000):
     """
     load pretrain word2vec weight matrix
+    优先读取compile生成的embedding矩阵文件(memory map)，不存在时再从pkl字典逐行构建
     :param vocab_size:
-    :return:
+    :return: float32 embedding matrix [max_vocab_size, embed_size]
     """
+    matrix_path = params.get('embedding_matrix_path')
+    if matrix_path and os.path.exists(matrix_path):
+        embedding_matrix = load_embedding_matrix(matrix_path)
+        if embedding_matrix.shape[0] < max_vocab_size or embedding_matrix.shape[1] != params['embed_size']:
+            raise ValueError('Embedding matrix {} has shape {}, but current params need ({}, {}). '
+                             'Please run compile mode again.'.format(matrix_path, embedding_matrix.shape,
+                                                                     max_vocab_size, params['embed_size']))
+        embedding_matrix = embedding_matrix[:max_vocab_size]
+        # float16存储的矩阵转换成float32，float32直接使用memory map，不额外拷贝
+        return embedding_matrix if embedding_matrix.dtype == np.float32 else embedding_matrix.astype(np.float32)
+
     word2vec_dict = load_pkl(params['word2vec_output'])
-    vocab_dict = open(params['vocab_path'], encoding='utf-8').readlines()
-    embedding_matrix = np.zeros((max_vocab_size, params['embed_size']))
+    return build_embedding_matrix(word2vec_dict, max_vocab_size, params['embed_size'])
+
+
+def build_embedding_matrix(word2vec_dict, max_vocab_size, embed_size, dtype=np.float32):
+    """
+    把word2vec_build.build生成的 {index: vector} 字典转换成连续的矩阵
+    """
+    embedding_matrix = np.zeros((max_vocab_size, embed_size), dtype=dtype)
 
     for i in range(max_vocab_size):
         embedding_matrix[i] = word2vec_dict[i]
@@ -45,6 +63,24 @@ def load_word2vec(params, max_vocab_size=30000):
     return embedding_matrix
 
 
+def save_embedding_matrix(params, max_vocab_size=30000):
+    """
+    把pkl字典转换成.npy矩阵文件，.npy的header中保存了shape(vocab size, dim)和dtype
+    :param params: 需要word2vec_output, embedding_matrix_path, embed_size, embedding_dtype
+    """
+    word2vec_dict = load_pkl(params['word2vec_output'])
+    embedding_matrix = build_embedding_matrix(word2vec_dict, max_vocab_size, params['embed_size'],
+                                              dtype=np.dtype(params['embedding_dtype']))
+    np.save(params['embedding_matrix_path'], embedding_matrix)
+    print("save embedding matrix {} {} to {} ok.".format(embedding_matrix.shape, embedding_matrix.dtype,
+                                                         params['embedding_matrix_path']))
+
+
+def load_embedding_matrix(matrix_path):
+    # mmap_mode='r'，只有真正用到的部分才会从磁盘载入，多个进程可以共享page cache
+    return np.load(matrix_path, mmap_mode='r')
+
+
 def dump_pkl(vocab, pkl_path, overwrite=True):
     """
     存储文件
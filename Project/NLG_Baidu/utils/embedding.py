@@ -1,3 +1,7 @@
+import os
+
+import numpy as np
+
 import utils.data_process.Word2vec_build as wb
 import utils.data_process.Vocab_build as vb
 import utils.data_process.Data_Clean as dc
@@ -47,6 +51,153 @@ class Vocab:
     def size(self):
         return self.count
 
+    def decode_batch(self, id_matrix, batch_oovs=None, lengths=None, skip_ids=()):
+        """
+        把id矩阵转换成词list，逐个id查id2word，>= vocab_size的id到对应样本的oov词中查找
+        :param id_matrix: [N, T] id矩阵(可以包含扩展词表的id)
+        :param batch_oovs: 每条样本的article oov词list(str或bytes)，为None时没有扩展id
+        :param lengths: 每条样本的有效长度，为None时使用全部T个id
+        :param skip_ids: 不输出的id(例如开始符/结束符)
+        :return: N个词list，超出该样本oov范围的扩展id不输出
+        """
+        vocab_size = self.size()
+        results = []
+        for n, ids in enumerate(np.asarray(id_matrix).tolist()):
+            oovs = _oov_words(batch_oovs[n]) if batch_oovs is not None else []
+            words = []
+            for i in ids[:lengths[n]] if lengths is not None else ids:
+                if i in skip_ids:
+                    continue
+                if 0 <= i < vocab_size:
+                    words.append(self.id_to_word(i))
+                elif 0 <= i - vocab_size < len(oovs):
+                    words.append(oovs[i - vocab_size])
+            results.append(words)
+        return results
+
+
+def _oov_words(oovs):
+    # batch中的article_oovs是bytes
+    return [oov.decode() if isinstance(oov, bytes) else oov for oov in oovs]
+
+
+class ArrayVocab(Vocab):
+    """
+    基于numpy数组的词典
+    words是按id排列的词数组，decode_batch对整个id矩阵做一次数组下标查找(包括article oov扩展id)
+    encode_batch的词->id仍然是dict查找，只有补齐和oov编号用数组操作，放到example_generator里整体并不比
+    逐词的article_to_ids快，所以batcher的编码仍然走dict的路径
+    word2id/id2word仍然保留，逐个词调用的接口与Vocab相同
+    """
+
+    def load_vocab(self, vocab_file, vocab_max_size=None):
+        if vocab_file.endswith('.npz'):
+            # save()保存的二进制词典
+            data = np.load(vocab_file)
+            words = data['words']
+            if vocab_max_size:
+                words = words[:vocab_max_size]
+        else:
+            word2id, _ = super(ArrayVocab, self).load_vocab(vocab_file, vocab_max_size)
+            words = np.array(sorted(word2id, key=word2id.get))
+        self.words = words
+        # object数组下标查找直接得到python str，decode_batch不需要再转换
+        self.word_objects = words.astype(object)
+        word2id = {w: i for i, w in enumerate(words.tolist())}
+        id2word = dict(enumerate(words.tolist()))
+        return word2id, id2word
+
+    def save(self, save_path):
+        # 单个.npz文件
+        np.savez(save_path, words=self.words)
+        print("save vocab {} words to {} ok.".format(len(self.words), save_path))
+
+    def encode(self, tokens):
+        """
+        把词list一次转换成int32的id数组，不在词表中的词为UNK
+        """
+        get = self.word2id.get
+        unk = self.unknown_token_index
+        return np.fromiter((get(w, unk) for w in tokens), dtype=np.int32, count=len(tokens))
+
+    def encode_batch(self, batch_tokens, extend_oov=False):
+        """
+        编码一个batch的词list，补齐和oov编号都在拼接后的一维数组上完成
+        :param batch_tokens: N个词list
+        :param extend_oov: 是否同时返回article oov扩展词表的id(与article_to_ids一致)
+        :return: ids [N, max_len] 用PAD补齐的int32矩阵, lengths [N]；
+                 extend_oov时再返回extended_ids [N, max_len]和每条样本的oov词list
+        """
+        num_rows = len(batch_tokens)
+        lengths = np.array([len(tokens) for tokens in batch_tokens], dtype=np.int32)
+        flat_tokens = [w for tokens in batch_tokens for w in tokens]
+        flat_ids = self.encode(flat_tokens)
+        max_len = int(lengths.max()) if num_rows else 0
+        rows = np.repeat(np.arange(num_rows), lengths)
+        cols = np.arange(len(flat_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        ids = np.full([num_rows, max_len], self.pad_token_index, dtype=np.int32)
+        ids[rows, cols] = flat_ids
+        if not extend_oov:
+            return ids, lengths
+
+        extended_ids = ids.copy()
+        batch_oovs = [[] for _ in range(num_rows)]
+        oov_pos = np.nonzero(flat_ids == self.unknown_token_index)[0]
+        if len(oov_pos) == 0:
+            return ids, lengths, extended_ids, batch_oovs
+        # (样本, oov词)组合去重，first是组合第一次出现的位置，按行优先顺序排列后同一样本的组合是连续的
+        oov_words = np.array([flat_tokens[i] for i in oov_pos], dtype=str)
+        uniq_words, word_idx = np.unique(oov_words, return_inverse=True)
+        oov_rows = rows[oov_pos]
+        keys = oov_rows * len(uniq_words) + word_idx
+        uniq_keys, first, key_idx = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first, kind='stable')
+        key_rows = uniq_keys[order] // len(uniq_words)
+        # 每个样本内按第一次出现的顺序编号为vocab_size + i
+        rank = np.empty(len(order), dtype=np.int32)
+        rank[order] = np.arange(len(order)) - np.searchsorted(key_rows, key_rows)
+        extended_ids[oov_rows, cols[oov_pos]] = self.size() + rank[key_idx.reshape(-1)]
+        for n, w in zip(key_rows.tolist(), uniq_words[uniq_keys[order] % len(uniq_words)].tolist()):
+            batch_oovs[n].append(w)
+        return ids, lengths, extended_ids, batch_oovs
+
+    def decode_batch(self, id_matrix, batch_oovs=None, lengths=None, skip_ids=()):
+        """
+        与Vocab.decode_batch相同，词表和batch内所有oov词拼成一个查找表，整个id矩阵一次下标查找
+        """
+        id_matrix = np.asarray(id_matrix, dtype=np.int64)
+        num_rows, max_len = id_matrix.shape
+        vocab_size = self.size()
+        valid = np.ones(id_matrix.shape, dtype=bool)
+        if lengths is not None:
+            valid &= np.arange(max_len)[None, :] < np.asarray(lengths)[:, None]
+        for skip_id in skip_ids:
+            valid &= id_matrix != skip_id
+
+        # 第n条样本的第k个oov在查找表中的位置是vocab_size + oov_start[n] + k
+        oovs = [_oov_words(row) for row in batch_oovs] if batch_oovs is not None else [[]] * num_rows
+        num_oovs = np.array([len(row) for row in oovs], dtype=np.int64)
+        oov_start = np.cumsum(num_oovs) - num_oovs
+        table = np.concatenate([self.word_objects, np.array([w for row in oovs for w in row] + [''], dtype=object)])
+        in_vocab = (id_matrix >= 0) & (id_matrix < vocab_size)
+        oov_idx = id_matrix - vocab_size
+        in_oovs = (oov_idx >= 0) & (oov_idx < num_oovs[:, None])
+        valid &= in_vocab | in_oovs
+        index = np.where(in_vocab, id_matrix, np.where(in_oovs, vocab_size + oov_start[:, None] + oov_idx, -1))
+        words = table[index]
+        return [words[n][valid[n]].tolist() for n in range(num_rows)]
+
+
+def create_vocab(params):
+    """
+    按vocab_mode创建词典，array模式优先读取compile生成的二进制词典
+    """
+    if params["vocab_mode"] == "array":
+        if os.path.exists(params["array_vocab_path"]):
+            return ArrayVocab(params["array_vocab_path"], params["vocab_size"])
+        return ArrayVocab(params["vocab_path"], params["vocab_size"])
+    return Vocab(params["vocab_path"], params["vocab_size"])
+
 
 if __name__ == '__main__':
     # 读取文件路径
@@ -0,0 +1,169 @@
+import csv
+import os
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# 每metrics_every步写一行
+CSV_FIELDS = ["step", "epoch", "loss", "examples_per_sec", "tokens_per_sec",
+              "wait_ms", "compute_ms", "wait_fraction", "step_ms_p50", "step_ms_p90", "step_ms_max",
+              "host_rss_mb", "device_mem_mb", "device_peak_mem_mb"]
+
+
+def host_rss_mb():
+    # Linux下ru_maxrss单位是KB，是进程到目前为止的最大常驻内存
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def device_memory_mb():
+    """
+    第一块GPU当前和峰值的显存占用，没有GPU时返回(0, 0)
+    """
+    if not tf.config.list_physical_devices('GPU'):
+        return 0.0, 0.0
+    info = tf.config.experimental.get_memory_info('GPU:0')
+    return info['current'] / 2 ** 20, info['peak'] / 2 ** 20
+
+
+def batch_sizes(batch):
+    """
+    :param batch: batcher产出的(enc_batch, dec_batch)，或者distribute_dataset拆分后的batch
+    :return: 样本数, encoder+decoder中非PAD的token数
+    """
+    enc_batch, dec_batch = batch
+    num_examples = sum(int(x.shape[0]) for x in _local_values(enc_batch["enc_input"]))
+    num_tokens = sum(int(tf.reduce_sum(x)) for x in _local_values(enc_batch["encoder_pad_mask"]) +
+                     _local_values(dec_batch["decoder_pad_mask"]))
+    return num_examples, num_tokens
+
+
+def _local_values(value):
+    # 分布式训练时batch中的每个字段是各个replica的PerReplica值
+    if isinstance(value, tf.distribute.DistributedValues):
+        return tuple(value.values)
+    return (value,)
+
+
+class TrainMetrics:
+    """
+    训练吞吐统计，每metrics_every步把窗口内的平均值写入TensorBoard和CSV
+    wait是从dataset取下一个batch的时间，compute是train_step加上取loss值(等待计算完成)的时间
+    profile_steps > 0时，从profile_start_step开始用tf.profiler记录profile_steps步
+    """
+
+    def __init__(self, params, model_name):
+        self.every = params["metrics_every"]
+        self.log_dir = os.path.join(params["metrics_dir"], model_name)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.writer = tf.summary.create_file_writer(self.log_dir)
+        csv_path = os.path.join(self.log_dir, 'train_metrics.csv')
+        new_file = not os.path.exists(csv_path)
+        self.csv_file = open(csv_path, 'a', encoding='utf-8', newline='')
+        self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=CSV_FIELDS)
+        if new_file:
+            self.csv_writer.writeheader()
+
+        self.profile_start = params["profile_start_step"]
+        self.profile_stop = params["profile_start_step"] + params["profile_steps"]
+        self.profiling = False
+
+        self.global_step = 0
+        self.epoch = 0
+        self._reset_window()
+        self._ready_time = None
+
+    def _reset_window(self):
+        self.wait_times = []
+        self.compute_times = []
+        self.num_examples = 0
+        self.num_tokens = 0
+        self.losses = []
+
+    def timed(self, dataset, epoch=0):
+        """
+        遍历dataset，记录每个batch的等待时间
+        """
+        self.epoch = epoch
+        iterator = iter(dataset)
+        while True:
+            start_time = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._ready_time = time.time()
+            self.wait_times.append(self._ready_time - start_time)
+            self._maybe_profile()
+            yield batch
+
+    def _maybe_profile(self):
+        if self.profile_stop <= self.profile_start:
+            return
+        if self.global_step == self.profile_start and not self.profiling:
+            tf.profiler.experimental.start(self.log_dir)
+            self.profiling = True
+            print('profiler started at step {}, trace saved to {}'.format(self.global_step, self.log_dir))
+        elif self.global_step == self.profile_stop and self.profiling:
+            self._stop_profiler()
+
+    def _stop_profiler(self):
+        tf.profiler.experimental.stop()
+        self.profiling = False
+        print('profiler stopped at step {}'.format(self.global_step))
+
+    def end_step(self, batch, loss):
+        """
+        train_step的loss已经取到python float后调用
+        """
+        self.compute_times.append(time.time() - self._ready_time)
+        num_examples, num_tokens = batch_sizes(batch)
+        self.num_examples += num_examples
+        self.num_tokens += num_tokens
+        self.losses.append(loss)
+        self.global_step += 1
+        if len(self.compute_times) >= self.every:
+            self.flush()
+
+    def flush(self):
+        if not self.compute_times:
+            return
+        wait_times = np.array(self.wait_times[:len(self.compute_times)])
+        compute_times = np.array(self.compute_times)
+        step_times = wait_times + compute_times
+        total_time = step_times.sum()
+        device_mem, device_peak_mem = device_memory_mb()
+        row = {"step": self.global_step,
+               "epoch": self.epoch,
+               "loss": float(np.mean(self.losses)),
+               "examples_per_sec": self.num_examples / total_time,
+               "tokens_per_sec": self.num_tokens / total_time,
+               "wait_ms": wait_times.mean() * 1000,
+               "compute_ms": compute_times.mean() * 1000,
+               "wait_fraction": wait_times.sum() / total_time,
+               "step_ms_p50": np.percentile(step_times, 50) * 1000,
+               "step_ms_p90": np.percentile(step_times, 90) * 1000,
+               "step_ms_max": step_times.max() * 1000,
+               "host_rss_mb": host_rss_mb(),
+               "device_mem_mb": device_mem,
+               "device_peak_mem_mb": device_peak_mem}
+
+        with self.writer.as_default():
+            for name in CSV_FIELDS[2:]:
+                tf.summary.scalar('train/' + name, row[name], step=self.global_step)
+            tf.summary.histogram('train/step_ms', step_times * 1000, step=self.global_step)
+            tf.summary.histogram('train/wait_ms', wait_times * 1000, step=self.global_step)
+        self.writer.flush()
+        self.csv_writer.writerow({k: round(v, 4) if isinstance(v, float) else v for k, v in row.items()})
+        self.csv_file.flush()
+        print('step {} {:.1f} examples/sec {:.0f} tokens/sec, wait {:.1f}ms compute {:.1f}ms'.format(
+            self.global_step, row["examples_per_sec"], row["tokens_per_sec"], row["wait_ms"], row["compute_ms"]))
+        self._reset_window()
+
+    def close(self):
+        self.flush()
+        if self.profiling:
+            self._stop_profiler()
+        self.writer.close()
+        self.csv_file.close()
@@ -0,0 +1,246 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import tensorflow as tf
+
+from dataprocess.data_clean import clean_line, load_user_dict, read_stopwords
+from utils.batcher_utils import build_test_example, encoder_batch
+from utils.checkpoint_utils import restore_weights
+from utils.embedding import create_vocab
+
+
+def load_model(params):
+    """
+    创建模型并恢复最新的checkpoint，与testing.py中的做法相同
+    """
+    if params['model'] == 'PGN':
+        from PGN_tf2.models.PGN import PGN
+        model = PGN(params)
+        model_dir = params['PGN_model_dir']
+        ckpt = tf.train.Checkpoint(step=tf.Variable(0), PGN=model)
+    else:
+        from seq2seq_tf2.models.seq2seq import SequenceToSequence
+        model = SequenceToSequence(params)
+        model_dir = params['seq2seq_model_dir']
+        ckpt = tf.train.Checkpoint(step=tf.Variable(0), SequenceToSequence=model)
+    if params['async_checkpoint']:
+        model.build_variables()
+        latest_checkpoint = restore_weights(model, '{}/async_checkpoint'.format(model_dir),
+                                            use_ema=params['restore_ema'])
+    else:
+        ckpt_manager = tf.train.CheckpointManager(ckpt, '{}/checkpoint'.format(model_dir), max_to_keep=5)
+        ckpt.restore(ckpt_manager.latest_checkpoint)
+        latest_checkpoint = ckpt_manager.latest_checkpoint
+    if latest_checkpoint:
+        print('Model restored from {}'.format(latest_checkpoint))
+    else:
+        print('Initializing from scratch')
+    return model
+
+
+class Summarizer:
+    """
+    常驻内存的模型+词典，把一组原始文本分词后组成一个batch解码
+    """
+
+    def __init__(self, params, model=None, vocab=None):
+        self.params = params
+        self.vocab = vocab if vocab is not None else create_vocab(params)
+        self.model = model if model is not None else load_model(params)
+        load_user_dict(params["user_dict_path"])
+        self.stopwords = read_stopwords(params["stop_words_path"])
+
+    def segment(self, text):
+        # 与data_clean生成train/test_x时的处理相同，分词为空时返回None
+        return clean_line(text, self.stopwords)
+
+    def summarize_batch(self, texts):
+        """
+        :param texts: 原始文本list，长度不超过batch_size
+        :return: 摘要list，分词后为空的文本摘要为空字符串
+        """
+        articles = [self.segment(text) for text in texts]
+        valid = [i for i, article in enumerate(articles) if article]
+        results = [''] * len(texts)
+        if not valid:
+            return results
+        examples = [build_test_example(articles[i], self.vocab, self.params, self.params["max_enc_len"])
+                    for i in valid]
+        batch = encoder_batch(examples, self.vocab)
+        if self.params['model'] == 'PGN':
+            from PGN_tf2.helpers.test_helper import batch_beam_decode
+            summaries = batch_beam_decode(self.model, batch, self.vocab, self.params)
+        else:
+            from seq2seq_tf2.helpers.test_helper import batch_greedy_decode
+            summaries = batch_greedy_decode(self.model, batch, self.vocab, self.params)
+        for i, summary in zip(valid, summaries):
+            results[i] = summary
+        return results
+
+
+class LatencyStats:
+    """
+    线程安全的延迟和吞吐统计，延迟只保留最近window个请求
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.start_time = time.time()
+
+    def record_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.num_requests += len(latencies)
+            self.num_batches += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64)
+            batch_sizes = np.array(self.batch_sizes, dtype=np.float64)
+            num_requests, num_batches = self.num_requests, self.num_batches
+        elapsed = time.time() - self.start_time
+        stats = {"requests": num_requests,
+                 "batches": num_batches,
+                 "uptime_sec": round(elapsed, 1),
+                 "throughput_per_sec": round(num_requests / elapsed, 3) if elapsed > 0 else 0.0,
+                 "mean_batch_size": round(float(batch_sizes.mean()), 2) if len(batch_sizes) else 0.0}
+        if len(latencies):
+            p50, p99 = np.percentile(latencies, [50, 99])
+            stats.update({"latency_p50_ms": round(p50 * 1000, 1), "latency_p99_ms": round(p99 * 1000, 1)})
+        return stats
+
+
+class DynamicBatcher:
+    """
+    把并发的请求合并成batch：拿到第一个请求后最多再等max_latency秒，batch满了立即解码
+    模型只在一个后台线程中运行，HTTP线程通过Future等待结果
+    解码时encoder和attention都按encoder_pad_mask跳过pad，同一个请求的摘要与同一batch里的其它请求无关
+    """
+
+    def __init__(self, summarizer, batch_size, max_latency, stats=None):
+        self.summarizer = summarizer
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.stats = stats if stats is not None else LatencyStats()
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, text):
+        future = Future()
+        self.requests.put((text, future, time.time()))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for text, _, _ in batch]
+            try:
+                summaries = self.summarizer.summarize_batch(texts)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end_time = time.time()
+            for (_, future, _), summary in zip(batch, summaries):
+                future.set_result(summary)
+            self.stats.record_batch([end_time - start_time for _, _, start_time in batch])
+
+
+def make_handler(batcher, timeout):
+    class SummarizeHandler(BaseHTTPRequestHandler):
+        """
+        POST /summarize {"text": "..."} 或 {"texts": ["...", ...]}
+        GET /stats 返回延迟和吞吐统计
+        """
+
+        def _send_json(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(200, batcher.stats.snapshot())
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != '/summarize':
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                texts = body["texts"] if "texts" in body else [body["text"]]
+                # texts是字符串时不能逐字符入队
+                if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                    raise TypeError('"texts" must be a list of strings and "text" a string')
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": "invalid request: {}".format(e)})
+                return
+            # 多条文本分别入队，可以和其他请求的文本合并到同一个batch
+            futures = [batcher.submit(text) for text in texts]
+            try:
+                summaries = [future.result(timeout=timeout) for future in futures]
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+                return
+            if "texts" in body:
+                self._send_json(200, {"summaries": summaries})
+            else:
+                self._send_json(200, {"summary": summaries[0]})
+
+        def log_message(self, format, *args):
+            # 不逐个请求打印日志，用/stats查看
+            pass
+
+    return SummarizeHandler
+
+
+def serve(params):
+    """
+    启动常驻的摘要服务，模型和词典只加载一次
+    """
+    params = dict(params, mode="test")
+    summarizer = Summarizer(params)
+    batcher = DynamicBatcher(summarizer, params["batch_size"], params["serve_max_latency_ms"] / 1000.0)
+    handler = make_handler(batcher, params["serve_timeout"])
+    server = ThreadingHTTPServer((params["serve_host"], params["serve_port"]), handler)
+    print('Serving {} on http://{}:{} (batch_size {}, max latency {}ms)'.format(
+        params["model"], params["serve_host"], params["serve_port"], params["batch_size"],
+        params["serve_max_latency_ms"]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('stats: {}'.format(batcher.stats.snapshot()))
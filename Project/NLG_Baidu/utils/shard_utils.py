@@ -0,0 +1,241 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from utils.batcher_utils import build_train_example, build_test_example, num_repeats
+
+# 每个分片目录里保存的数组文件
+SHARD_FIELDS = ["enc_input", "enc_input_extend_vocab", "enc_offsets",
+                "dec_input", "dec_input_offsets", "target", "dec_offsets",
+                "oov_bytes", "oov_offsets", "oov_index",
+                "article_bytes", "article_offsets",
+                "abstract_bytes", "abstract_offsets"]
+
+
+def _mode_dir(params, mode):
+    return os.path.join(params["shard_dir"], mode)
+
+
+def _read_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _flat_int32(seqs):
+    if not seqs:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate([np.asarray(s, dtype=np.int32) for s in seqs])
+
+
+def _flat_bytes(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, _offsets([len(b) for b in encoded])
+
+
+def _write_shard(shard_path, examples):
+    """
+    把一组样本写成扁平的int32数组+offset索引
+    :param shard_path: 分片目录
+    :param examples: build_train_example/build_test_example生成的样本list
+    """
+    os.makedirs(shard_path, exist_ok=True)
+    oovs = [w for e in examples for w in e["article_oovs"]]
+    oov_bytes, oov_offsets = _flat_bytes(oovs)
+    article_bytes, article_offsets = _flat_bytes([e["article"] for e in examples])
+    abstract_bytes, abstract_offsets = _flat_bytes([e["abstract"] for e in examples])
+    arrays = {
+        "enc_input": _flat_int32([e["enc_input"] for e in examples]),
+        "enc_input_extend_vocab": _flat_int32([e["enc_input_extend_vocab"] for e in examples]),
+        "enc_offsets": _offsets([len(e["enc_input"]) for e in examples]),
+        "dec_input": _flat_int32([e["dec_input"] for e in examples]),
+        # dec_input可能比target多一个stop，所以单独保存offset
+        "dec_input_offsets": _offsets([len(e["dec_input"]) for e in examples]),
+        "target": _flat_int32([e["target"] for e in examples]),
+        "dec_offsets": _offsets([len(e["target"]) for e in examples]),
+        "oov_bytes": oov_bytes,
+        "oov_offsets": oov_offsets,
+        "oov_index": _offsets([len(e["article_oovs"]) for e in examples]),
+        "article_bytes": article_bytes,
+        "article_offsets": article_offsets,
+        "abstract_bytes": abstract_bytes,
+        "abstract_offsets": abstract_offsets,
+    }
+    for name in SHARD_FIELDS:
+        np.save(os.path.join(shard_path, name + '.npy'), arrays[name])
+
+
+def compile_shards(vocab, params, modes=("train", "eval", "test")):
+    """
+    离线把分词后的文本转换成token id分片，训练时直接memory map读取
+    :param vocab: 词典
+    :param params: 参数，需要shard_dir和shard_size
+    :param modes: 需要编译的数据集，没有设置val_seg_x_dir/val_seg_y_dir时跳过eval
+    """
+    max_enc_len = params["max_enc_len"]
+    max_dec_len = params["max_dec_len"]
+    for mode in modes:
+        if mode == "eval" and not (params.get("val_seg_x_dir") and params.get("val_seg_y_dir")):
+            print('skip compiling eval shards: val_seg_x_dir/val_seg_y_dir is not set')
+            continue
+        if mode == "test":
+            records = ((article, None) for article in _read_lines(params["test_seg_x_dir"]))
+        else:
+            prefix = "train" if mode == "train" else "val"
+            records = zip(_read_lines(params["{}_seg_x_dir".format(prefix)]),
+                          _read_lines(params["{}_seg_y_dir".format(prefix)]))
+
+        out_dir = _mode_dir(params, mode)
+        os.makedirs(out_dir, exist_ok=True)
+        num_examples = 0
+        num_shards = 0
+        examples = []
+        for article, abstract in records:
+            if mode == "test":
+                examples.append(build_test_example(article, vocab, params, max_enc_len))
+            else:
+                examples.append(build_train_example(article, abstract, vocab, params, max_enc_len, max_dec_len))
+            if len(examples) == params["shard_size"]:
+                _write_shard(os.path.join(out_dir, "shard-{:05d}".format(num_shards)), examples)
+                num_examples += len(examples)
+                num_shards += 1
+                examples = []
+        if examples:
+            _write_shard(os.path.join(out_dir, "shard-{:05d}".format(num_shards)), examples)
+            num_examples += len(examples)
+            num_shards += 1
+
+        meta = {"mode": mode,
+                "num_examples": num_examples,
+                "num_shards": num_shards,
+                "max_enc_len": max_enc_len,
+                "max_dec_len": max_dec_len,
+                "vocab_size": vocab.size(),
+                "model": params["model"]}
+        with open(os.path.join(out_dir, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+        print('compile {} shards: {} examples in {} shards, saved to {}'.format(mode, num_examples, num_shards,
+                                                                               out_dir))
+
+
+def load_shard_meta(params, mode, vocab):
+    meta_path = os.path.join(_mode_dir(params, mode), "meta.json")
+    if not os.path.exists(meta_path):
+        raise ValueError('No {} shards found in {}. Please run compile mode first '
+                         '(eval shards need val_seg_x_dir/val_seg_y_dir).'.format(mode, meta_path))
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    expected = {"max_enc_len": params["max_enc_len"],
+                "max_dec_len": params["max_dec_len"],
+                "vocab_size": vocab.size(),
+                "model": params["model"]}
+    for key, value in expected.items():
+        if meta[key] != value:
+            raise ValueError('Shards in {} were compiled with {}={}, but current params use {}. '
+                             'Please run compile mode again.'.format(meta_path, key, meta[key], value))
+    return meta
+
+
+def load_shard(shard_path):
+    # mmap_mode='r'，只有真正读到的部分才会从磁盘载入
+    return {name: np.load(os.path.join(shard_path, name + '.npy'), mmap_mode='r') for name in SHARD_FIELDS}
+
+
+# 字符串拼接后的字节数组，读入时转换成一个scalar字符串
+_BYTES_FIELDS = {"oov_bytes", "article_bytes", "abstract_bytes"}
+# token id数组，其余的offset/index都是int64
+_ID_FIELDS = {"enc_input", "enc_input_extend_vocab", "dec_input", "target"}
+
+
+def _field_dtype(name):
+    if name in _BYTES_FIELDS:
+        return tf.string
+    return tf.int32 if name in _ID_FIELDS else tf.int64
+
+
+def _load_shard_arrays(shard_path):
+    # 迭代到这个分片时才从memory map读入，同一时间只有正在读的分片在内存里
+    shard = load_shard(shard_path.decode('utf-8'))
+    return [shard[name].tobytes() if name in _BYTES_FIELDS else np.asarray(shard[name]) for name in SHARD_FIELDS]
+
+
+def _strings(data, offsets):
+    # 所有字符串拼在一个scalar里，用substr一次切出来
+    return tf.strings.substr(data, offsets[:-1], offsets[1:] - offsets[:-1])
+
+
+def _shard_dataset(shard_path):
+    """
+    一个分片的样本dataset，分片的数组在迭代到时才读入，每条样本按offset从扁平数组中切片
+    """
+    arrays = tf.numpy_function(_load_shard_arrays, [shard_path], [_field_dtype(name) for name in SHARD_FIELDS])
+    shard = dict()
+    for name, array in zip(SHARD_FIELDS, arrays):
+        array.set_shape([] if name in _BYTES_FIELDS else [None])
+        shard[name] = array
+    oovs = _strings(shard["oov_bytes"], shard["oov_offsets"])
+    articles = _strings(shard["article_bytes"], shard["article_offsets"])
+    abstracts = _strings(shard["abstract_bytes"], shard["abstract_offsets"])
+
+    def _slice(values, offsets, i):
+        return values[offsets[i]:offsets[i + 1]]
+
+    def get_example(i):
+        return {
+            "enc_input": _slice(shard["enc_input"], shard["enc_offsets"], i),
+            "enc_input_extend_vocab": _slice(shard["enc_input_extend_vocab"], shard["enc_offsets"], i),
+            "article_oovs": _slice(oovs, shard["oov_index"], i),
+            "dec_input": _slice(shard["dec_input"], shard["dec_input_offsets"], i),
+            "target": _slice(shard["target"], shard["dec_offsets"], i),
+            "article": articles[i],
+            "abstract": abstracts[i],
+            "abstract_sents": abstracts[i],
+        }
+
+    return tf.data.Dataset.range(tf.size(articles, out_type=tf.int64)).map(get_example)
+
+
+def shard_example_dataset(params, vocab, max_enc_len, max_dec_len, mode, batch_size):
+    """
+    与example_generator输出相同的样本dict，从预编译的分片中流式读取:
+    分片路径的dataset上interleave每个分片的读取，分片按顺序读入，样本顺序与example_generator相同
+    除了每个分片一次的读入以外全部是tf.data的op，不经过python generator
+    """
+    meta = load_shard_meta(params, mode, vocab)
+    mode_dir = _mode_dir(params, mode)
+    if meta["num_shards"] == 0:
+        raise ValueError('Shards in {} are empty.'.format(mode_dir))
+    shard_paths = [os.path.join(mode_dir, "shard-{:05d}".format(shard_id)) for shard_id in range(meta["num_shards"])]
+    # cycle_length=1保持分片顺序，num_parallel_calls让后面的分片在后台提前读入
+    dataset = tf.data.Dataset.from_tensor_slices(shard_paths).interleave(
+        _shard_dataset, cycle_length=1, num_parallel_calls=tf.data.experimental.AUTOTUNE, deterministic=True)
+
+    def add_lengths(entry):
+        enc_len = tf.shape(entry["enc_input"])[0]
+        if mode == "test":
+            dec_len = tf.constant(max_dec_len, dtype=tf.int32)
+            decoder_pad_mask = tf.zeros([0], dtype=tf.int32)
+        else:
+            dec_len = tf.shape(entry["target"])[0]
+            decoder_pad_mask = tf.ones([dec_len], dtype=tf.int32)
+        entry.update({"enc_len": enc_len,
+                      "dec_len": dec_len,
+                      "decoder_pad_mask": decoder_pad_mask,
+                      "encoder_pad_mask": tf.ones([enc_len], dtype=tf.int32)})
+        return entry
+
+    dataset = dataset.map(add_lengths, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    repeats = num_repeats(params, mode, batch_size)
+    if repeats > 1:
+        # 与example_generator一样，eval/test时每条样本重复batch_size次
+        dataset = dataset.flat_map(lambda x: tf.data.Dataset.from_tensors(x).repeat(repeats))
+    return dataset
@@ -0,0 +1,103 @@
+import contextlib
+
+import tensorflow as tf
+
+
+def train_step_args(batch, keys):
+    """
+    按train_step的参数顺序从batch中取出输入
+    :param batch: batcher产出的(enc_batch, dec_batch)
+    :param keys: train_step依次需要的字段名
+    """
+    enc_batch, dec_batch = batch
+    inputs = dict(enc_batch, **dec_batch)
+    return [inputs[key] for key in keys]
+
+
+def get_strategy(params):
+    """
+    distribute为mirrored时在本机所有GPU上做数据并行，multi_worker时按TF_CONFIG在多个进程/机器上做数据并行
+    :return: tf.distribute.Strategy，不做分布式训练时为None
+    """
+    if not params["distribute"]:
+        return None
+    if params["distribute"] == "mirrored":
+        strategy = tf.distribute.MirroredStrategy()
+    elif params["distribute"] == "multi_worker":
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    else:
+        raise ValueError('unknown distribute {}, use mirrored or multi_worker'.format(params["distribute"]))
+    assert params["batch_size"] % strategy.num_replicas_in_sync == 0, \
+        "batch_size {} is the global batch size and must be divisible by the {} replicas".format(
+            params["batch_size"], strategy.num_replicas_in_sync)
+    print('Training on {} replicas, {} examples per replica'.format(
+        strategy.num_replicas_in_sync, params["batch_size"] // strategy.num_replicas_in_sync))
+    return strategy
+
+
+def strategy_scope(strategy):
+    # 模型和optimizer的变量需要在strategy.scope()中创建
+    return strategy.scope() if strategy is not None else contextlib.nullcontext()
+
+
+def distribute_dataset(dataset, strategy):
+    """
+    把batcher产出的global batch拆分到各个replica
+    from_generator的dataset没有文件可以分片，多个worker之间按样本分片
+    """
+    if strategy is None:
+        return dataset
+
+    def batch_scalars(enc_batch, dec_batch):
+        # 标量字段(如max_oov_len)不能拆分到replica，复制成[batch_size]随batch一起拆分，compile_train_step中再取回标量
+        batch_size = tf.shape(enc_batch["enc_input"])[0]
+
+        def expand(x):
+            return tf.fill([batch_size], x) if x.shape.rank == 0 else x
+
+        return tf.nest.map_structure(expand, enc_batch), tf.nest.map_structure(expand, dec_batch)
+
+    dataset = dataset.map(batch_scalars)
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    return strategy.experimental_distribute_dataset(dataset.with_options(options))
+
+
+def compile_train_step(train_step, dataset, keys, params, strategy=None):
+    """
+    use_tf_function时用tf.function编译train_step
+    input_signature取自dataset.element_spec，encoder长度维是None，不同长度的batch不会重新trace
+    strategy不为None时每个replica运行一次train_step，返回值在replica间求和，
+    train_step中的loss需要按global batch size缩放；分布式训练总是用tf.function编译
+    :param train_step: 按keys顺序接收参数的训练函数
+    :param dataset: batcher返回的dataset
+    :param keys: train_step依次需要的字段名
+    :param params: 参数，需要use_tf_function和use_xla
+    :param strategy: get_strategy返回的分布式策略
+    """
+    # optimizer在replica间的梯度聚合不能放进XLA，分布式训练时不使用use_xla
+    jit_compile = params["use_xla"] and strategy is None
+    if strategy is not None:
+        enc_spec, dec_spec = dataset.element_spec
+        specs = dict(enc_spec, **dec_spec)
+        scalar_args = [i for i, key in enumerate(keys) if specs[key].shape.rank == 0]
+        replica_step = train_step
+
+        def replica_fn(*args):
+            # distribute_dataset把标量复制成了[per_replica_batch_size]
+            args = [arg[0] if i in scalar_args else arg for i, arg in enumerate(args)]
+            return replica_step(*args)
+
+        def train_step(*args):
+            per_replica = strategy.run(replica_fn, args=args)
+            return tf.nest.map_structure(lambda x: strategy.reduce(tf.distribute.ReduceOp.SUM, x, axis=None),
+                                         per_replica)
+
+        dataset = distribute_dataset(dataset, strategy)
+    elif not params["use_tf_function"]:
+        return train_step
+    enc_spec, dec_spec = dataset.element_spec
+    specs = dict(enc_spec, **dec_spec)
+    input_signature = [specs[key] for key in keys]
+    # XLA按具体shape编译，encoder长度变化时会重新编译，配合bucket_boundaries使用效果更好
+    return tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
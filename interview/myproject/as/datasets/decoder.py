@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+import time
 from collections import OrderedDict
 from functools import partial
 from typing import Any, Dict, List, Optional, Tuple, Union
@@ -5,9 +9,10 @@ from typing import Any, Dict, List, Optional, Tuple, Union
 import psutil
 import tensorflow as tf
 import tensorflow_datasets as tfds
-from omegaconf import DictConfig
+from omegaconf import DictConfig, ListConfig, OmegaConf
 from packaging import version
 
+from .decoder.batch_dataaug import random_batch_da_params
 from .decoder.dataaug_params import DataaugParamHolder
 from .decoder.disparity import DisparityDecoder
 from .decoder.environment import EnvironmentDecoder
@@ -29,9 +34,47 @@ def model_type_to_decoder(model_type: str):
     }
     return _DECODER_TBL[model_type]
 
+def _save_dataset(dataset, path, compression, shard_func):
+    # tf2.10以降はDataset.saveを使う
+    # tf2.10之后使用Dataset.save
+    if version.parse(tf.__version__) < version.parse("2.3.0"):
+        raise RuntimeError("pre-decoded cache requires tensorflow>=2.3.0")
+    elif version.parse(tf.__version__) < version.parse("2.10.0"):
+        tf.data.experimental.save(dataset, path, compression=compression, shard_func=shard_func)
+    else:
+        dataset.save(path, compression=compression, shard_func=shard_func)
+
+
+def _plain_config(value):
+    # DictConfig/ListConfigを含むconfigをjson化できるdict/listに変換する
+    # 把包含DictConfig/ListConfig的config转换为可以json化的dict/list
+    if isinstance(value, (DictConfig, ListConfig)):
+        value = OmegaConf.to_container(value, resolve=True)
+    if isinstance(value, dict):
+        return {str(k): _plain_config(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain_config(v) for v in value]
+    return value
+
+
+def _load_dataset(path, element_spec, compression, reader_func):
+    if version.parse(tf.__version__) < version.parse("2.10.0"):
+        return tf.data.experimental.load(path, element_spec, compression=compression, reader_func=reader_func)
+    else:
+        return tf.data.Dataset.load(path, element_spec, compression=compression, reader_func=reader_func)
+
+
 class DatasetDecoder:
     SHUFFLE_BUFFER_DIV = 4  # シャッフル用バッファサイズ決め用
     SHUFFLE_BUFFER_TH = 10000  # シャッフル用バッファ閾値
+    # pre-decodedキャッシュの形式、_pre_data_augmentationの処理(コード)を変更したら上げる
+    # configの変更はキャッシュのパスに含まれるハッシュで区別される
+    # pre-decoded缓存的格式版本，修改_pre_data_augmentation的处理(代码)后需要增加
+    # config的变更通过缓存路径中的哈希区分
+    PRE_DECODED_CACHE_VERSION = 1
+    PRE_DECODED_NUM_SHARDS = 16  # キャッシュのファイル分割数
+    PRE_DECODED_COMPRESSION = "GZIP"
+    PRE_DECODED_COMPLETE_FILE = "_COMPLETE"
 
     def __init__(
         self,
@@ -119,13 +162,22 @@ class DatasetDecoder:
 
         return samples
 
-    def _preprocess_on_image(self, samples):
+    def _pre_data_augmentation(self, samples):
+        # DA前の決定的な処理(decode/label変換)のみ適用、pre-decodedキャッシュの作成用
+        # 只应用DA之前的确定性处理(decode/label转换)，用于生成pre-decoded缓存
+        for task_name in self.input_names + self.output_names:
+            decoder = self.decoder_dict[task_name]
+            samples[task_name] = decoder._pre_data_augmentation(samples[task_name])
+
+        return samples
+
+    def _preprocess_on_image(self, samples, pre_decoded=False):
         # batch化前のデータにDA処理適用
         # 在batch化之前对数据应用DA处理
         da_params = samples.pop("da_params")
         for task_name in self.input_names + self.output_names:
             decoder = self.decoder_dict[task_name]
-            samples[task_name] = decoder.preprocess_on_image(samples[task_name], da_params)
+            samples[task_name] = decoder.preprocess_on_image(samples[task_name], da_params, pre_decoded=pre_decoded)
 
         return samples
 
@@ -138,6 +190,49 @@ class DatasetDecoder:
 
         return samples
 
+    def _preprocess_on_device_batch(self, samples, da_config, for_training_dataaug):
+        # batch化後のデータにまとめてDA適用、サンプル毎のパラメタはtensorで持つ
+        # 在batch化之后统一应用DA，每个样本的参数用tensor表示
+        # DA後はサンプル毎のDAと同じく_preprocess_on_batchを適用する("dataset"/"device"共通)
+        # DA之后与逐样本DA一样应用_preprocess_on_batch("dataset"/"device"共通)
+        batch_size = tf.shape(samples[self.input_names[0]])[0]
+        da_params = random_batch_da_params(
+            batch_size, self.dataset_size, self.model_input_size, da_config, for_training_dataaug
+        )
+        for task_name in self.input_names + self.output_names:
+            decoder = self.decoder_dict[task_name]
+            samples[task_name] = decoder.preprocess_on_device_batch(samples[task_name], da_params)
+
+        return self._preprocess_on_batch(samples, batch_size)
+
+    def batch_dataaug_fn(
+        self,
+        dataaug_config: Optional[Union[Dict[str, Any], DictConfig]] = None,
+        for_training_dataaug: bool = False,
+    ):
+        """get_data(batch_dataaug="device")の出力(model_inputs, model_labels)にDAを適用する関数
+        (对get_data(batch_dataaug="device")的输出(model_inputs, model_labels)应用DA的函数)
+        モデルのtrain_step内で呼ぶとDAがdevice上で実行される
+        対応するtypeは入力画像/semseg/debris/YOLO、それ以外のタスクが含まれる場合はValueError
+        (支持的type为输入图像/semseg/debris/YOLO，包含其他任务时抛出ValueError)
+        YOLOのclass_3dはflip時にcorner class idを入れ替えない(サンプル毎のDAとの違い)
+        (YOLO的class_3d在flip时不交换corner class id(与逐样本DA的区别))
+        """
+        dataaug_config = dict() if dataaug_config is None else dict(dataaug_config)
+
+        @tf.function
+        def _fn(model_inputs, model_labels):
+            if isinstance(model_inputs, tuple):
+                model_inputs = OrderedDict(zip(self.input_names, model_inputs))
+                inputs_to_tuple = True
+            else:
+                inputs_to_tuple = False
+            samples = dict(model_inputs, **model_labels)
+            samples = self._preprocess_on_device_batch(samples, dataaug_config, for_training_dataaug)
+            return self._split_in_out(samples, inputs_to_tuple=inputs_to_tuple)
+
+        return _fn
+
     def _split_in_out(self, samples, with_metadata=False, inputs_to_tuple=False):
         # モデルのinput/label/metadataで分割
         # 按模型的input/label/metadata进行分割
@@ -155,6 +250,113 @@ class DatasetDecoder:
         else:
             return model_inputs, model_labels
 
+    def _pre_decoded_config_hash(self) -> str:
+        # _pre_data_augmentationの結果を左右する各タスクのdecoder設定(label変換等)のハッシュ
+        # 影响_pre_data_augmentation结果的各任务decoder设置(label转换等)的哈希
+        config = dict()
+        for task_name in sorted(self.input_names + self.output_names):
+            decoder = self.decoder_dict[task_name]
+            config[task_name] = {
+                "decoder": type(decoder).__name__,
+                "ds_preproc_args": _plain_config(decoder.ds_preproc_args),
+                "model_config": _plain_config(decoder.model_config),
+                "kwargs": _plain_config(decoder.kwargs),
+            }
+        serialized = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha1(serialized.encode("utf-8")).hexdigest()[:16]
+
+    def _pre_decoded_cache_path(self, cache_dir: str, split_name: str) -> str:
+        # データセットのversion/split/タスク/decoder設定毎に別のディレクトリにする
+        # 按数据集的version/split/任务/decoder设置分别保存到不同的目录
+        split_dir = split_name.replace("[", "_").replace("]", "").replace(":", "-").replace("%", "pct")
+        tasks_dir = "-".join(sorted(self.input_names + self.output_names))
+        return os.path.join(
+            cache_dir,
+            self.info.name,
+            str(self.info.version),
+            split_dir,
+            tasks_dir,
+            "v{}-{}".format(self.PRE_DECODED_CACHE_VERSION, self._pre_decoded_config_hash()),
+        )
+
+    def _pre_decoded_source(self, split_name: str) -> tf.data.Dataset:
+        # キャッシュに書き込む内容、shuffleせずにpre-DAまで適用してindexを付ける
+        # 写入缓存的内容，不shuffle，应用到pre-DA为止并加上index
+        if version.parse(tf.__version__) < version.parse("2.4.0"):
+            num_parallel_calls = tf.data.experimental.AUTOTUNE
+        else:
+            num_parallel_calls = tf.data.AUTOTUNE
+        dataset = self.ds_builder.load(split_name, shuffle_files=False)
+        dataset = dataset.map(self._pre_data_augmentation, num_parallel_calls=num_parallel_calls)
+        return dataset.enumerate()
+
+    def build_pre_decoded_cache(
+        self,
+        split_name: str,
+        cache_dir: str,
+        num_shards: Optional[int] = None,
+        overwrite: bool = False,
+    ) -> str:
+        """decode/_pre_data_augmentation済みのsplitを圧縮・分割して保存する
+        (将应用了decode/_pre_data_augmentation的split压缩、分片保存)
+        学習時はget_data(pre_decoded_cache_dir=...)でランダムなDAのみオンラインで適用される
+        """
+        path = self._pre_decoded_cache_path(cache_dir, split_name)
+        complete_file = os.path.join(path, self.PRE_DECODED_COMPLETE_FILE)
+        if tf.io.gfile.exists(complete_file) and not overwrite:
+            return path
+        if tf.io.gfile.exists(path):
+            # 途中で止まったキャッシュは作り直す
+            # 中途停止的缓存重新生成
+            tf.io.gfile.rmtree(path)
+
+        num_shards = self.PRE_DECODED_NUM_SHARDS if num_shards is None else num_shards
+        start_time = time.time()
+        _save_dataset(
+            self._pre_decoded_source(split_name),
+            path,
+            compression=self.PRE_DECODED_COMPRESSION,
+            shard_func=lambda index, samples: index % num_shards,
+        )
+        with tf.io.gfile.GFile(complete_file, "w") as f:
+            f.write("{}\n".format(num_shards))
+        print("pre-decoded cache of '{}' saved to {} ({:.1f} s)".format(split_name, path, time.time() - start_time))
+
+        return path
+
+    def _load_pre_decoded(
+        self,
+        split_name: str,
+        cache_dir: str,
+        shuffle: bool,
+        shuffle_seed: Optional[int],
+    ) -> tf.data.Dataset:
+        # キャッシュがなければ作成してから読み込む
+        # 如果没有缓存，先生成再读取
+        path = self.build_pre_decoded_cache(split_name, cache_dir)
+        with tf.io.gfile.GFile(os.path.join(path, self.PRE_DECODED_COMPLETE_FILE), "r") as f:
+            num_shards = int(f.read().strip())
+
+        def reader_func(datasets):
+            # shuffle時はshardの読み込み順もシャッフル
+            # shuffle时shard的读取顺序也打乱
+            if shuffle:
+                datasets = datasets.shuffle(num_shards, seed=shuffle_seed)
+            return datasets.interleave(
+                lambda x: x,
+                cycle_length=num_shards,
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=not shuffle,
+            )
+
+        dataset = _load_dataset(
+            path,
+            self._pre_decoded_source(split_name).element_spec,
+            compression=self.PRE_DECODED_COMPRESSION,
+            reader_func=reader_func,
+        )
+        return dataset.map(lambda index, samples: samples)
+
     def get_data(
         self,
         split_name: str,
@@ -168,22 +370,34 @@ class DatasetDecoder:
         with_split_info: bool = False,
         with_metadata: bool = False,
         inputs_to_tuple: bool = False,
+        pre_decoded_cache_dir: Optional[str] = None,
+        batch_dataaug: Optional[str] = None,
     ) -> Union[tf.data.Dataset, Tuple[tf.data.Dataset, tfds.core.SplitInfo]]:
         # 指定されたsplitの読み出し/DA適用
         # 读取指定的split/应用DA
+        # pre_decoded_cache_dir指定時はdecode/_pre_data_augmentation済みのキャッシュを読み込み、ランダムなDAのみ適用
+        # 指定pre_decoded_cache_dir时读取已decode/_pre_data_augmentation的缓存，只应用随机的DA
+        # batch_dataaug="dataset"はbatch化後にまとめてDA適用、"device"はDAを適用せずに返す(batch_dataaug_fnで適用)
+        # batch_dataaug="dataset"在batch化之后统一应用DA，"device"不应用DA直接返回(用batch_dataaug_fn应用)
         dataaug_config = dict() if dataaug_config is None else dataaug_config
+        pre_decoded = pre_decoded_cache_dir is not None
+        if batch_dataaug not in (None, "dataset", "device"):
+            raise ValueError("batch_dataaug must be None, 'dataset' or 'device': {}".format(batch_dataaug))
 
         # データロード
         # 数据加载
-        dataset = self.ds_builder.load(
-            split_name,
-            shuffle_files=shuffle,
-            read_config=tfds.ReadConfig(
-                try_autocache=use_cache,
-                shuffle_seed=shuffle_seed,
-                shuffle_reshuffle_each_iteration=shuffle,
+        if pre_decoded:
+            dataset = self._load_pre_decoded(split_name, pre_decoded_cache_dir, shuffle, shuffle_seed)
+        else:
+            dataset = self.ds_builder.load(
+                split_name,
+                shuffle_files=shuffle,
+                read_config=tfds.ReadConfig(
+                    try_autocache=use_cache,
+                    shuffle_seed=shuffle_seed,
+                    shuffle_reshuffle_each_iteration=shuffle,
+                )
             )
-        )
 
         split_info = self.info.splits[split_name]
 
@@ -215,7 +429,7 @@ class DatasetDecoder:
         get_da_param_fn = partial(
             self._get_da_param, da_config=dataaug_config, for_training_dataaug=for_training_dataaug
         )
-        preprocess_on_image_fn = self._preprocess_on_image
+        preprocess_on_image_fn = partial(self._preprocess_on_image, pre_decoded=pre_decoded)
         preprocess_on_batch_fn = partial(self._preprocess_on_batch, batch_size=batch_size)
         split_in_out_fn = partial(self._split_in_out, with_metadata=with_metadata, inputs_to_tuple=inputs_to_tuple)
 
@@ -224,16 +438,64 @@ class DatasetDecoder:
         else:
             num_parallel_calls = tf.data.AUTOTUNE
 
-        dataset = (
-            dataset.map(get_da_param_fn, num_parallel_calls=num_parallel_calls)
-            .prefetch(num_parallel_calls)
-            .map(preprocess_on_image_fn, num_parallel_calls=num_parallel_calls)
-            .batch(batch_size)
-            .map(preprocess_on_batch_fn, num_parallel_calls=num_parallel_calls)
-            .map(split_in_out_fn, num_parallel_calls=num_parallel_calls)
-        )
+        if batch_dataaug is not None:
+            # サンプル毎にはDA前の決定的な処理のみ
+            # 每个样本只做DA之前的确定性处理
+            if not pre_decoded:
+                dataset = dataset.map(self._pre_data_augmentation, num_parallel_calls=num_parallel_calls)
+            dataset = dataset.batch(batch_size)
+            if batch_dataaug == "dataset":
+                device_batch_fn = partial(
+                    self._preprocess_on_device_batch,
+                    da_config=dataaug_config,
+                    for_training_dataaug=for_training_dataaug,
+                )
+                dataset = dataset.map(device_batch_fn, num_parallel_calls=num_parallel_calls)
+            dataset = dataset.map(split_in_out_fn, num_parallel_calls=num_parallel_calls)
+        else:
+            dataset = (
+                dataset.map(get_da_param_fn, num_parallel_calls=num_parallel_calls)
+                .prefetch(num_parallel_calls)
+                .map(preprocess_on_image_fn, num_parallel_calls=num_parallel_calls)
+                .batch(batch_size)
+                .map(preprocess_on_batch_fn, num_parallel_calls=num_parallel_calls)
+                .map(split_in_out_fn, num_parallel_calls=num_parallel_calls)
+            )
 
         if with_split_info:
             return dataset, split_info
         else:
             return dataset
+
+
+def benchmark_get_data(
+    decoder: DatasetDecoder,
+    split_name: str,
+    batch_size: int,
+    num_batches: int = 100,
+    warmup_batches: int = 5,
+    **get_data_kwargs,
+) -> float:
+    """get_dataの読み出し速度(images/sec)を計測する
+    (测量get_data的读取速度(images/sec))
+    pre_decoded_cache_dirの有無で比較する、キャッシュ作成時間は含まない
+    """
+    if get_data_kwargs.get("pre_decoded_cache_dir") is not None:
+        decoder.build_pre_decoded_cache(split_name, get_data_kwargs["pre_decoded_cache_dir"])
+    dataset = decoder.get_data(split_name, batch_size, repeat=True, **get_data_kwargs)
+    iterator = iter(dataset)
+    for _ in range(warmup_batches):
+        next(iterator)
+
+    start_time = time.time()
+    for _ in range(num_batches):
+        next(iterator)
+    elapsed = time.time() - start_time
+    images_per_sec = num_batches * batch_size / elapsed
+    print(
+        "get_data('{}', pre_decoded={}): {:.1f} images/sec".format(
+            split_name, get_data_kwargs.get("pre_decoded_cache_dir") is not None, images_per_sec
+        )
+    )
+
+    return images_per_sec
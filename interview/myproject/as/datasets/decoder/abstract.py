@@ -15,8 +15,15 @@ from ..utils.preproc_params import (
     SharpnessPrm,
 )
 
+from . import batch_dataaug
+from .batch_dataaug import BatchDataaugParams
 from .dataaug_params import DataaugParamHolder
 
+# 画素値がクラスIDのラベル画像、batch DAではaffine warpのみ(nearest)を適用する
+LABEL_MAP_TYPES = ("semseg", "debris")
+# batch DAで入力画像として扱うtype、入力のImageDecoderのmodel_configにはtypeがない
+IMAGE_TYPES = (None, "image")
+
 class AbstractDecoder(metaclass=ABCMeta):
     def __init__(self, task_name, ds_preproc_args, model_config, **kwargs):
         self.task_name = task_name
@@ -131,8 +138,11 @@ class AbstractDecoder(metaclass=ABCMeta):
         self,
         sample: Union[tf.Tensor, Dict[str, tf.Tensor]],
         da_params: DataaugParamHolder,
+        pre_decoded: bool = False,
     ) -> Union[tf.Tensor, Dict[str, tf.Tensor]]:
-        sample = self._pre_data_augmentation(sample)
+        # pre_decoded=Trueの場合、_pre_data_augmentationはキャッシュ作成時に適用済み
+        if not pre_decoded:
+            sample = self._pre_data_augmentation(sample)
         sample = self._brightness(sample, da_params.brightness)
         sample = self._sharpness_or_blur(sample, da_params.sharpness)
         sample = self._noise(sample, da_params.noise)
@@ -145,3 +155,26 @@ class AbstractDecoder(metaclass=ABCMeta):
         sample = self._horizontal_flip(sample, da_params.flip)
 
         return sample
+
+    # batch化後の画像前処理、tf.data.mapでもdevice上のtrain_stepでも実行可能
+    # 入力画像はbrightness/sharpness/noise/cutout + affine warp、ラベル画像はaffine warpのみ(範囲外はignore_label)
+    # _pre_data_augmentationはbatch化前に適用済みの想定
+    # YOLOはoverrideでbboxを変換する(flip時にclass_3dのcorner class idは入れ替えない)
+    # 上記以外のtype(disp/env/SSD等)は未対応のためValueError
+    def preprocess_on_device_batch(
+        self,
+        batch: Union[tf.Tensor, Dict[str, tf.Tensor]],
+        batch_da_params: BatchDataaugParams,
+    ) -> Union[tf.Tensor, Dict[str, tf.Tensor]]:
+        model_type = self.model_config.get("type", None)
+        if model_type in LABEL_MAP_TYPES:
+            return batch_dataaug.augment_label_batch(
+                batch, batch_da_params, ignore_label=self.ds_preproc_args.get("ignore_label", 255)
+            )
+        if model_type in IMAGE_TYPES:
+            return batch_dataaug.augment_image_batch(
+                batch, batch_da_params, mean_pixel=self.ds_preproc_args.get("mean_pixel", 0.0)
+            )
+        raise ValueError(
+            "batch dataaug is not supported for task '{}' (type '{}')".format(self.task_name, model_type)
+        )
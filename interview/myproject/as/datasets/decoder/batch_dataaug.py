@@ -0,0 +1,403 @@
+import math
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+
+import tensorflow as tf
+from packaging import version
+
+# batch化後にまとめて適用するDA
+# 在batch化之后统一应用的DA
+# サンプル毎のパラメタを[B]のtensorで持ち、scale/rotate/crop/padding/flipは1回のaffine warpにまとめる
+# 每个样本的参数用[B]的tensor表示，scale/rotate/crop/padding/flip合并为一次affine warp
+# tf.data.mapの中でもモデルのtrain_step(device上)の中でも実行できる
+# 可以在tf.data.map中执行，也可以在模型的train_step(device上)中执行
+
+# ぼかし用3x3カーネル(PIL ImageFilter.SMOOTHと同じ)
+# 模糊用的3x3卷积核(与PIL ImageFilter.SMOOTH相同)
+_SMOOTH_KERNEL = [[1.0, 1.0, 1.0], [1.0, 5.0, 1.0], [1.0, 1.0, 1.0]]
+
+
+class BatchDataaugParams(NamedTuple):
+    brightness: tf.Tensor  # [B] 加算する輝度値(value_rangeの幅に対する比)
+    sharpness: tf.Tensor  # [B] 1.0で変化なし、1.0より大きいとsharpness、小さいとぼかし
+    noise_stddev: tf.Tensor  # [B] ガウシアンノイズの標準偏差
+    cutout: tf.Tensor  # [B, 4] 入力画像の相対座標(ymin, xmin, ymax, xmax)、面積0の場合cutoutなし
+    matrix: tf.Tensor  # [B, 3, 3] 入力画像->出力画像の画素座標のaffine行列
+    input_shape: Tuple[int, int]  # (h, w)
+    output_shape: Tuple[int, int]  # (h, w)
+
+
+def _uniform(batch_size, minval, maxval):
+    return tf.random.uniform([batch_size], minval, maxval, dtype=tf.float32)
+
+
+def _with_prob(batch_size, value, identity, prob):
+    # probの確率でvalue、それ以外はidentity
+    # 以prob的概率使用value，否则使用identity
+    apply = tf.random.uniform([batch_size], 0.0, 1.0) < prob
+    return tf.where(apply, value, tf.cast(identity, value.dtype) * tf.ones_like(value))
+
+
+# da_configのキーと各キーが持つ項目(DataaugParamHolderと同じスキーマ)
+# da_config的键和各键包含的项目(与DataaugParamHolder相同的schema)
+_RANGE_KEYS = ("min", "max", "step")
+_DA_CONFIG_KEYS = {
+    "probability": None,
+    "scale": _RANGE_KEYS,
+    "brightness": _RANGE_KEYS,
+    "sharpness": _RANGE_KEYS,
+    "noise": _RANGE_KEYS,
+    "angle": _RANGE_KEYS,
+    "cutout": ("width", "height"),
+    "flip": ("prob",),
+    # default_positionはサンプル毎のcrop用、batch DAでは使わない
+    # default_position用于逐样本的crop，batch DA中不使用
+    "crop": ("position", "default_position"),
+    "padding": ("position",),
+}
+# probabilityの対象になるDA(flip以外)
+# probability作用的DA(flip以外)
+_PROB_DA_NAMES = ("scale", "brightness", "sharpness", "noise", "angle", "cutout")
+_POSITIONS = ("LEFT_TOP", "CENTER", "RANDOM")
+
+
+def _check_keys(name, cfg, known_keys):
+    unknown = sorted(set(cfg.keys()) - set(known_keys))
+    if unknown:
+        raise ValueError("unknown key(s) in data augmentation config '{}': {}".format(name, unknown))
+
+
+def _sample_range(batch_size, name, cfg):
+    # {min, max, step}からサンプル毎の値を決める、step>0の場合はmin + step * nの格子上の値
+    # 从{min, max, step}决定每个样本的值，step>0时取min + step * n格点上的值
+    cfg = dict(cfg)
+    _check_keys(name, cfg, _RANGE_KEYS)
+    minval = float(cfg["min"])
+    maxval = float(cfg["max"])
+    step = float(cfg.get("step", 0.0) or 0.0)
+    if maxval <= minval:
+        return tf.fill([batch_size], minval)
+    if step <= 0.0:
+        return _uniform(batch_size, minval, maxval)
+    num_steps = int(math.floor((maxval - minval) / step + 1e-6)) + 1
+    index = tf.random.uniform([batch_size], 0, num_steps, dtype=tf.int32)
+    return minval + step * tf.cast(index, tf.float32)
+
+
+def _position_shift(batch_size, position, in_size, out_size, scale):
+    # scale後の画像を出力画像のどこに置くか(入力画像中心の出力画像中心からのずれ)
+    # scale后的图像放在输出图像的什么位置(输入图像中心相对于输出图像中心的偏移)
+    diff = in_size * scale - out_size
+    if position == "LEFT_TOP":
+        return diff / 2.0
+    if position == "RANDOM":
+        return _uniform(batch_size, -1.0, 1.0) * tf.abs(diff) / 2.0
+    return tf.zeros([batch_size], tf.float32)
+
+
+def random_batch_da_params(
+    batch_size: Union[int, tf.Tensor],
+    input_shape: Tuple[int, int],
+    output_shape: Tuple[int, int],
+    da_config: Dict[str, Any],
+    for_training_dataaug: bool = True,
+) -> BatchDataaugParams:
+    """batch内の各サンプルのDAパラメタを乱数で決める
+    (随机决定batch内每个样本的DA参数)
+    da_configはhyperparameterのDA設定(DataaugParamHolderと同じ項目)、知らないキーはValueError
+        probability: flip以外のDAの適用確率、0.0以上では1つのDAを選んで適用、0.0未満では全て適用
+        scale/brightness/sharpness/noise/angle: {min, max, step}
+            brightnessは値域に対する比、sharpnessは0で変化なし/正でsharpness/負でぼかし、angleは度
+        cutout: {width: {min, max, step}, height: {min, max, step}} 画像サイズに対する比
+        flip: {prob}
+        crop/padding: {position} LEFT_TOP/CENTER/RANDOM、Noneは中央
+    省略した項目のDAは適用しない
+    for_training_dataaug=Falseの場合はcrop/paddingの位置のみ使う(RANDOMは中央)
+    """
+    da_config = dict(da_config)
+    _check_keys("da", da_config, _DA_CONFIG_KEYS.keys())
+    sub_configs = dict()
+    for name, known_keys in _DA_CONFIG_KEYS.items():
+        if known_keys is None or da_config.get(name, None) is None:
+            continue
+        sub_configs[name] = dict(da_config[name])
+        _check_keys(name, sub_configs[name], known_keys)
+    positions = dict()
+    for name in ("crop", "padding"):
+        position = sub_configs.get(name, dict()).get("position", None)
+        position = "CENTER" if position is None else str(position)
+        if position not in _POSITIONS:
+            raise ValueError("{}.position must be one of {}: {}".format(name, _POSITIONS, position))
+        if position == "RANDOM" and not for_training_dataaug:
+            position = "CENTER"
+        positions[name] = position
+    if not for_training_dataaug:
+        sub_configs = dict()
+
+    in_h, in_w = input_shape
+    out_h, out_w = output_shape
+    zeros = tf.zeros([batch_size], tf.float32)
+    ones = tf.ones([batch_size], tf.float32)
+
+    # probability>=0.0の場合はサンプル毎に1つのDAを選んでprobabilityの確率で適用
+    # probability>=0.0时每个样本选择1个DA并以probability的概率应用
+    enabled = [name for name in _PROB_DA_NAMES if name in sub_configs]
+    probability = da_config.get("probability", None)
+    probability = 1.0 if probability is None else float(probability)
+    if probability < 0.0 or len(enabled) == 0:
+        applied = {name: tf.ones([batch_size], tf.bool) for name in enabled}
+    else:
+        choice = tf.random.uniform([batch_size], 0, len(enabled), dtype=tf.int32)
+        apply = tf.random.uniform([batch_size], 0.0, 1.0) < probability
+        applied = {name: tf.logical_and(apply, tf.equal(choice, i)) for i, name in enumerate(enabled)}
+
+    def _value(name, identity):
+        if name not in sub_configs:
+            return identity * ones
+        value = _sample_range(batch_size, name, sub_configs[name])
+        return tf.where(applied[name], value, identity * ones)
+
+    brightness = _value("brightness", 0.0)
+    # 0で係数1.0、正はsharpness(1 + s)、負はぼかし(1 / (1 - s))
+    # 0时系数为1.0，正为sharpness(1 + s)，负为模糊(1 / (1 - s))
+    sharpness = _value("sharpness", 0.0)
+    sharpness = tf.where(sharpness >= 0.0, 1.0 + sharpness, 1.0 / (1.0 - sharpness))
+    noise_stddev = _value("noise", 0.0)
+    scale = _value("scale", 1.0)
+    radian = _value("angle", 0.0) * (math.pi / 180.0)
+
+    cutout = tf.zeros([batch_size, 4], tf.float32)
+    if "cutout" in sub_configs:
+        cfg = sub_configs["cutout"]
+        size_w = _sample_range(batch_size, "cutout.width", cfg["width"]) if "width" in cfg else zeros
+        size_h = _sample_range(batch_size, "cutout.height", cfg["height"]) if "height" in cfg else zeros
+        size_w = tf.clip_by_value(size_w, 0.0, 1.0)
+        size_h = tf.where(applied["cutout"], tf.clip_by_value(size_h, 0.0, 1.0), zeros)
+        ymin = _uniform(batch_size, 0.0, 1.0) * (1.0 - size_h)
+        xmin = _uniform(batch_size, 0.0, 1.0) * (1.0 - size_w)
+        cutout = tf.stack([ymin, xmin, ymin + size_h, xmin + size_w], axis=-1)
+
+    # scale後の画像が出力サイズより大きい軸はcrop、小さい軸はpaddingの位置に従う
+    # scale后的图像比输出尺寸大的轴按crop的位置，小的轴按padding的位置
+    def _shift(in_size, out_size):
+        crop_shift = _position_shift(batch_size, positions["crop"], in_size, out_size, scale)
+        padding_shift = _position_shift(batch_size, positions["padding"], in_size, out_size, scale)
+        return tf.where(in_size * scale > out_size, crop_shift, padding_shift)
+
+    shift_x = _shift(in_w, out_w)
+    shift_y = _shift(in_h, out_h)
+
+    flip = tf.zeros([batch_size], tf.bool)
+    if "flip" in sub_configs:
+        flip = tf.random.uniform([batch_size], 0.0, 1.0) < float(sub_configs["flip"].get("prob", 0.0))
+
+    matrix = affine_matrix(scale, radian, shift_x, shift_y, flip, input_shape, output_shape)
+
+    return BatchDataaugParams(
+        brightness=brightness,
+        sharpness=sharpness,
+        noise_stddev=noise_stddev,
+        cutout=cutout,
+        matrix=matrix,
+        input_shape=(in_h, in_w),
+        output_shape=(out_h, out_w),
+    )
+
+
+def affine_matrix(scale, radian, shift_x, shift_y, flip, input_shape, output_shape):
+    """入力画像の中心を出力画像の中心+shiftに合わせるscale/rotate/flipのaffine行列
+    (使输入图像中心对齐输出图像中心+shift的scale/rotate/flip的affine矩阵)
+    画素座標は画素中心が整数(ImageProjectiveTransformと同じ)
+    return: [B, 3, 3]
+    """
+    in_h, in_w = input_shape
+    out_h, out_w = output_shape
+    in_cx, in_cy = (in_w - 1) / 2.0, (in_h - 1) / 2.0
+    out_cx, out_cy = (out_w - 1) / 2.0, (out_h - 1) / 2.0
+
+    cos = scale * tf.cos(radian)
+    sin = scale * tf.sin(radian)
+    tx = out_cx + shift_x - (cos * in_cx - sin * in_cy)
+    ty = out_cy + shift_y - (sin * in_cx + cos * in_cy)
+    # 水平flip: x -> (out_w - 1) - x
+    sign = tf.where(flip, -tf.ones_like(cos), tf.ones_like(cos))
+    tx = tf.where(flip, (out_w - 1) - tx, tx)
+
+    zeros = tf.zeros_like(cos)
+    ones = tf.ones_like(cos)
+    return tf.stack(
+        [
+            tf.stack([sign * cos, sign * -sin, tx], axis=-1),
+            tf.stack([sin, cos, ty], axis=-1),
+            tf.stack([zeros, zeros, ones], axis=-1),
+        ],
+        axis=1,
+    )
+
+
+def rescale_matrix(matrix, input_shape, output_shape, label_input_shape, label_output_shape):
+    # 画像と解像度が違うlabel用に行列を変換する(画素中心の位置を合わせる)
+    # 为分辨率与图像不同的label转换矩阵(对齐像素中心的位置)
+    def _scaling(from_shape, to_shape):
+        ry = to_shape[0] / from_shape[0]
+        rx = to_shape[1] / from_shape[1]
+        return tf.constant(
+            [[rx, 0.0, 0.5 * rx - 0.5], [0.0, ry, 0.5 * ry - 0.5], [0.0, 0.0, 1.0]], dtype=matrix.dtype
+        )
+
+    to_label_out = _scaling(output_shape, label_output_shape)
+    from_label_in = tf.linalg.inv(_scaling(input_shape, label_input_shape))
+    return tf.matmul(tf.matmul(to_label_out[tf.newaxis], matrix), from_label_in[tf.newaxis])
+
+
+def _warp(images, matrix, output_shape, interpolation, fill_value):
+    # ImageProjectiveTransformは出力座標->入力座標の変換を受け取るので逆行列を渡す
+    # ImageProjectiveTransform接收输出坐标->输入坐标的变换，所以传入逆矩阵
+    inverse = tf.linalg.inv(matrix)
+    transforms = tf.reshape(inverse, [-1, 9])[:, :8] / inverse[:, 2:3, 2]
+    output_shape = tf.constant(output_shape, dtype=tf.int32)
+    if version.parse(tf.__version__) < version.parse("2.4.0"):
+        # V2はfill_valueがないので、maskで埋める
+        # V2没有fill_value，用mask填充
+        warped = tf.raw_ops.ImageProjectiveTransformV2(
+            images=images, transforms=transforms, output_shape=output_shape, interpolation=interpolation
+        )
+        mask = tf.raw_ops.ImageProjectiveTransformV2(
+            images=tf.ones_like(images[..., :1], dtype=tf.float32),
+            transforms=transforms,
+            output_shape=output_shape,
+            interpolation=interpolation,
+        )
+        fill = tf.cast((1.0 - mask) * fill_value, images.dtype)
+        return warped + fill
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=output_shape,
+        fill_value=tf.cast(fill_value, tf.float32),
+        interpolation=interpolation,
+        fill_mode="CONSTANT",
+    )
+
+
+def _cutout_mask(cutout, height, width):
+    # [B, H, W, 1]、cutout領域が1
+    ys = (tf.range(height, dtype=tf.float32) + 0.5) / height
+    xs = (tf.range(width, dtype=tf.float32) + 0.5) / width
+    ymin, xmin, ymax, xmax = tf.unstack(cutout[:, tf.newaxis, tf.newaxis, :], axis=-1)
+    in_y = tf.logical_and(ys[tf.newaxis, :, tf.newaxis] >= ymin, ys[tf.newaxis, :, tf.newaxis] < ymax)
+    in_x = tf.logical_and(xs[tf.newaxis, tf.newaxis, :] >= xmin, xs[tf.newaxis, tf.newaxis, :] < xmax)
+    return tf.cast(tf.logical_and(in_y, in_x), tf.float32)[..., tf.newaxis]
+
+
+def augment_image_batch(
+    images: tf.Tensor,
+    params: BatchDataaugParams,
+    mean_pixel: Union[float, Sequence[float]] = 0.0,
+    value_range: Tuple[float, float] = (0.0, 255.0),
+) -> tf.Tensor:
+    """[B, H, W, C]の画像にbrightness/sharpness/noise/cutoutとaffine warpをまとめて適用する
+    (对[B, H, W, C]的图像统一应用brightness/sharpness/noise/cutout和affine warp)
+    cutoutはwarp前の入力画像上で行う、padding/cutoutの領域はmean_pixelで埋める
+    """
+    dtype = images.dtype
+    images = tf.cast(images, tf.float32)
+    mean_pixel = tf.cast(tf.reshape(mean_pixel, [1, 1, 1, -1]), tf.float32)
+    height, width, channels = images.shape[1], images.shape[2], images.shape[3]
+
+    images += params.brightness[:, tf.newaxis, tf.newaxis, tf.newaxis] * (value_range[1] - value_range[0])
+
+    kernel = tf.constant(_SMOOTH_KERNEL, tf.float32) / tf.reduce_sum(_SMOOTH_KERNEL)
+    kernel = tf.tile(kernel[:, :, tf.newaxis, tf.newaxis], [1, 1, channels, 1])
+    blurred = tf.nn.depthwise_conv2d(images, kernel, strides=[1, 1, 1, 1], padding="SAME")
+    images = blurred + params.sharpness[:, tf.newaxis, tf.newaxis, tf.newaxis] * (images - blurred)
+
+    noise = tf.random.normal(tf.shape(images), dtype=tf.float32)
+    images += noise * params.noise_stddev[:, tf.newaxis, tf.newaxis, tf.newaxis]
+    images = tf.clip_by_value(images, value_range[0], value_range[1])
+
+    cutout_mask = _cutout_mask(params.cutout, height, width)
+    images = images * (1.0 - cutout_mask) + mean_pixel * cutout_mask
+
+    # mean pixelを引いてから0埋めでwarpして戻すと、padding領域がmean pixelになる
+    # 先减去mean pixel再用0填充warp然后加回，padding区域就是mean pixel
+    images = _warp(images - mean_pixel, params.matrix, params.output_shape, "BILINEAR", 0.0) + mean_pixel
+
+    return tf.cast(images, dtype)
+
+
+def augment_label_batch(
+    labels: tf.Tensor,
+    params: BatchDataaugParams,
+    ignore_label: int = 255,
+) -> tf.Tensor:
+    """[B, h, w]または[B, h, w, 1]のラベル画像にaffine warpを適用する(nearest、範囲外はignore_label)
+    (对[B, h, w]或[B, h, w, 1]的标签图像应用affine warp(nearest，范围外为ignore_label))
+    ラベルの解像度が画像と違う場合(output stride)は同じ比率で出力サイズを決める
+    """
+    squeeze = labels.shape.rank == 3
+    if squeeze:
+        labels = labels[..., tf.newaxis]
+    label_in_shape = (labels.shape[1], labels.shape[2])
+    label_out_shape = (
+        params.output_shape[0] * label_in_shape[0] // params.input_shape[0],
+        params.output_shape[1] * label_in_shape[1] // params.input_shape[1],
+    )
+    matrix = params.matrix
+    if label_in_shape != tuple(params.input_shape):
+        matrix = rescale_matrix(matrix, params.input_shape, params.output_shape, label_in_shape, label_out_shape)
+    labels = _warp(labels, matrix, label_out_shape, "NEAREST", float(ignore_label))
+    if squeeze:
+        labels = labels[..., 0]
+
+    return labels
+
+
+def augment_bbox_batch(
+    bbox: tf.Tensor,
+    params: BatchDataaugParams,
+    corner_x: Optional[tf.Tensor] = None,
+) -> Tuple[tf.Tensor, Optional[tf.Tensor]]:
+    """[B, N, 4]の相対座標bbox(xmin, ymin, xmax, ymax)をaffine行列で変換する
+    (用affine矩阵变换[B, N, 4]的相对坐标bbox(xmin, ymin, xmax, ymax))
+    回転後は4隅の外接矩形、出力画像の範囲でclipし、面積0になったbbox(padding含む)は0にする
+    corner_x([B, N])はbboxの上下辺との交点の中点を新しいcorner_xにする
+    """
+    in_h, in_w = params.input_shape
+    out_h, out_w = params.output_shape
+    in_size = tf.constant([in_w, in_h], bbox.dtype)
+    out_size = tf.constant([out_w, out_h], bbox.dtype)
+    matrix = tf.cast(params.matrix, bbox.dtype)
+
+    def _transform(points):
+        # points: [B, N, K, 2]の相対座標(画素の端が0/1) -> 出力画像の相対座標
+        pixel = points * in_size - 0.5  # 画素中心基準の座標
+        pixel = tf.concat([pixel, tf.ones_like(pixel[..., :1])], axis=-1)
+        pixel = tf.einsum("bij,bnkj->bnki", matrix, pixel)[..., :2]
+        return (pixel + 0.5) / out_size
+
+    valid = tf.logical_and(bbox[..., 2] > bbox[..., 0], bbox[..., 3] > bbox[..., 1])
+    xmin, ymin, xmax, ymax = tf.unstack(bbox, axis=-1)
+    corners = tf.stack(
+        [
+            tf.stack([xmin, ymin], axis=-1),
+            tf.stack([xmax, ymin], axis=-1),
+            tf.stack([xmax, ymax], axis=-1),
+            tf.stack([xmin, ymax], axis=-1),
+        ],
+        axis=2,
+    )
+    corners = _transform(corners)
+    min_points = tf.reduce_min(corners, axis=2)
+    max_points = tf.reduce_max(corners, axis=2)
+    new_bbox = tf.clip_by_value(tf.concat([min_points, max_points], axis=-1), 0.0, 1.0)
+    valid = tf.logical_and(valid, new_bbox[..., 2] > new_bbox[..., 0])
+    valid = tf.logical_and(valid, new_bbox[..., 3] > new_bbox[..., 1])
+    new_bbox = tf.where(valid[..., tf.newaxis], new_bbox, tf.zeros_like(new_bbox))
+
+    new_corner_x = None
+    if corner_x is not None:
+        points = tf.stack([tf.stack([corner_x, ymin], axis=-1), tf.stack([corner_x, ymax], axis=-1)], axis=2)
+        new_corner_x = tf.reduce_mean(_transform(points)[..., 0], axis=-1)
+        new_corner_x = tf.where(valid, tf.clip_by_value(new_corner_x, 0.0, 1.0), tf.zeros_like(new_corner_x))
+
+    return new_bbox, new_corner_x
@@ -12,6 +12,7 @@ from ..utils.preproc_params import (
     ScaleParamHolder,
 )
 from .abstract import AbstractDecoder
+from .batch_dataaug import BatchDataaugParams, augment_bbox_batch
 
 # YOLOラベルDA用
 class YOLODecoder(AbstractDecoder):
@@ -73,6 +74,23 @@ class YOLODecoder(AbstractDecoder):
         # 相対座標で処理するため何もしない
         return sample
 
+    def preprocess_on_device_batch(
+        self,
+        batch: Dict[str, tf.Tensor],
+        batch_da_params: BatchDataaugParams,
+    ) -> Dict[str, tf.Tensor]:
+        # bbox([B, max_boxes, 4]、padding行は0)を画像と同じaffine行列で変換、flip時のcorner class idの入れ替えは行わない
+        corner_x = batch["corner_x"] if self.class_3d else None
+        bbox, corner_x = augment_bbox_batch(batch["bbox"], batch_da_params, corner_x)
+        if self.class_3d:
+            update_values = {
+                "bbox": bbox,
+                "corner_x": corner_x,
+            }
+        else:
+            update_values = {"bbox": bbox}
+        return self.update_sample_values(batch, update_values)
+
     def _rotate(
         self,
         sample: Dict[str, tf.Tensor],
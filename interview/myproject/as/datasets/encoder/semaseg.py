@@ -1,6 +1,11 @@
+import os
+import time
 from collections import namedtuple
+from functools import lru_cache
 from importlib import import_module
+from multiprocessing import Pool, cpu_count
 
+import cv2
 import numpy as np
 import tensorflow as tf
 from PIL import Image, ImageDraw
@@ -25,6 +30,7 @@ class PreprocLabelImage(PreprocJson):
                     skip_ghost: True   # ゴースト画像の場合、invisibleをネガティブとして描画（省略の場合False）
                     repl_invisible: True   # 無視ラベルの描画をスキップ（省略の場合False）
                     skip_road_marking: True   # 前処理の際に道路標示ラベルの描画をスキップ（省略の場合False）
+                    use_opencv_rasterizer: True   # OpenCVで描画する(annot2labelArray、省略の場合False)
             feature_config:  # データセットのinfo用設定
                 type: image
                 args: 
@@ -43,14 +49,26 @@ class PreprocLabelImage(PreprocJson):
         repl_invisible = preproc_args.get("repl_invisible", False)
         skip_road_marking = preproc_args.get("skip_road_marking", False)
 
-        label_img = annot2labelImg(
-            annotation,
-            label_def.name2label,
-            "trainIds",
-            skip_ghost=skip_ghost,
-            repl_invisible=repl_invisible,
-            skip_road_marking=skip_road_marking,
-        )
+        if preproc_args.get("use_opencv_rasterizer", False):
+            _, label_lut = _load_label_def(preproc_args["label"], "trainIds")
+            label_img = annot2labelArray(
+                annotation,
+                label_def.name2label,
+                "trainIds",
+                skip_ghost=skip_ghost,
+                repl_invisible=repl_invisible,
+                skip_road_marking=skip_road_marking,
+                label_lut=label_lut,
+            )
+        else:
+            label_img = annot2labelImg(
+                annotation,
+                label_def.name2label,
+                "trainIds",
+                skip_ghost=skip_ghost,
+                repl_invisible=repl_invisible,
+                skip_road_marking=skip_road_marking,
+            )
 
         label_img = np.array(label_img, dtype=np.uint8)
         if label_img.ndim == 2:
@@ -159,6 +177,112 @@ class PreprocLabelImage(PreprocJson):
 
         return (bname, element)
 
+Point = namedtuple("Point", ["x", "y"])
+
+# ghost系ラベル(skip_ghost時は描画しない)
+GHOST_LABELS = frozenset([
+    "smoke",
+    "wiper streak",
+    "splash",
+    "aeb",
+    "invisible",
+])
+
+# 白線ラベル
+LANE_LABELS = frozenset([
+    "line solid white - ego lane",
+    "line solid yellow - ego lane",
+    "line solid other - ego lane",
+    "line dashed white - ego lane",
+    "line dashed yellow - ego lane",
+    "line dashed other - ego lane",
+    "line solid white - other lane",
+    "line solid yellow - other lane",
+    "line solid other - other lane",
+    "line dashed white - other lane",
+    "line dashed yellow - other lane",
+    "line dashed other - other lane",
+    "line solid white - unknown",
+    "line solid yellow - unknown",
+    "line solid other - unknown",
+    "line dashed white - unknown",
+    "line dashed yellow - unknown",
+    "line dashed other - unknown",
+])
+
+# 路面標示ラベル
+ROAD_MARKING_LABELS = frozenset([
+    "road marking crosswalk",
+    "road marking stopline",
+    "road marking arrow",
+    "road marking diamond",
+    "road marking text stop",
+    "road marking text other",
+    "road marking other",
+])
+
+# skip_road_marking時は白線&路面標示系ラベルを描画しない
+SKIP_ROAD_MARKING_LABELS = LANE_LABELS | ROAD_MARKING_LABELS
+
+# 上面角のpadding後の高さ
+LABEL_IMG_HEIGHT = 624
+
+_ENCODING_ATTR = {"ids": "id", "trainIds": "trainId", "color": "color"}
+
+
+def _resolve_label(obj, annotation, name2label, skip_ghost, repl_invisible, skip_road_marking):
+    # 描画するラベル名を返す、描画しないobjectはNone
+    label = obj.label
+
+    # If the object is deleted, skip it
+    if obj.deleted:
+        return None
+
+    # If the label is not known, but ends with a 'group' (e.g. cargroup)
+    # try to remove the s and see if that works
+    if (label not in name2label) and label.endswith("group"):
+        label = label[: -len("group")]
+
+    if obj.drivindDivision == "Unable to drive.":
+        if label == "sidewalk":
+            label = "sidewalk unable to drive"
+        elif label == "terrain":
+            label = "terrain unable to drive"
+
+    # # 高濃度moku以外はじく
+    # if label == "smoke" and obj.Steam != "HighDensity":
+    #     continue
+    # ghost系ラベルは描画しない
+    if skip_ghost:
+        if label in GHOST_LABELS:
+            return None
+
+    # 単独アノテのinvisibleはネガティブクラス扱い
+    if repl_invisible:
+        if annotation.AnnotationPattern.get("SingleAnotation", "none") != "none" and label == "invisible":
+            label = "not ghost"
+
+    # 白線&路面標示系ラベルは描画しない
+    if skip_road_marking:
+        if label in SKIP_ROAD_MARKING_LABELS:
+            return None
+
+    if label not in name2label:
+        raise ValueError("Label '{}' not known.".format(label))
+
+    return label
+
+
+def build_label_lut(name2label, encoding):
+    """ラベル名 -> 描画値のテーブル、idが負のラベルはNone(描画しない)
+    encodingが未対応の場合はNone
+    """
+    if encoding not in _ENCODING_ATTR:
+        return None
+    attr = _ENCODING_ATTR[encoding]
+    return {name: (getattr(label, attr) if label.id >= 0 else None) for name, label in name2label.items()}
+
+
 # Convert the given annotation to a label image
 def annot2labelImg(
     annotation,
@@ -198,82 +322,11 @@ def annot2labelImg(
 
     # loop over all objects
     for obj in annotation.objects:
-        label = obj.label
         polygon = obj.polygon
-
-        # If the object is deleted, skip it
-        if obj.deleted:
+        label = _resolve_label(obj, annotation, name2label, skip_ghost, repl_invisible, skip_road_marking)
+        if label is None:
             continue
 
-        # If the label is not known, but ends with a 'group' (e.g. cargroup)
-        # try to remove the s and see if that works
-        if (label not in name2label) and label.endswith("group"):
-            label = label[: -len("group")]
-
-        if obj.drivindDivision == "Unable to drive.":
-            if label == "sidewalk":
-                label = "sidewalk unable to drive"
-            elif label == "terrain":
-                label = "terrain unable to drive"
-
-        # # 高濃度moku以外はじく
-        # if label == "smoke" and obj.Steam != "HighDensity":
-        #     continue
-        # ghost系ラベルは描画しない
-        ghost_labels = [
-            "smoke",
-            "wiper streak",
-            "splash",
-            "aeb",
-            "invisible",
-        ]
-        if skip_ghost:
-            if label in ghost_labels:
-                continue
-
-        # 単独アノテのinvisibleはネガティブクラス扱い
-        if repl_invisible:
-            if annotation.AnnotationPattern.get("SingleAnotation", "none") != "none" and label == "invisible":
-                label = "not ghost"
-
-        # 白線&路面標示系ラベルは描画しない
-        lane_label = [
-            "line solid white - ego lane",
-            "line solid yellow - ego lane",
-            "line solid other - ego lane",
-            "line dashed white - ego lane",
-            "line dashed yellow - ego lane",
-            "line dashed other - ego lane",
-            "line solid white - other lane",
-            "line solid yellow - other lane",
-            "line solid other - other lane",
-            "line dashed white - other lane",
-            "line dashed yellow - other lane",
-            "line dashed other - other lane",
-            "line solid white - unknown",
-            "line solid yellow - unknown",
-            "line solid other - unknown",
-            "line dashed white - unknown",
-            "line dashed yellow - unknown",
-            "line dashed other - unknown",
-        ]
-
-        road_marking_label = [
-            "road marking crosswalk",
-            "road marking stopline",
-            "road marking arrow",
-            "road marking diamond",
-            "road marking text stop",
-            "road marking text other",
-            "road marking other",
-        ]
-        if skip_road_marking:
-            if label in lane_label or label in road_marking_label:
-                continue
-
-        if label not in name2label:
-            raise ValueError("Label '{}' not known.".format(label))
-
         # If the ID is negative that polygon should not be drawn
         if name2label[label].id < 0:
             continue
@@ -286,7 +339,6 @@ def annot2labelImg(
             val = name2label[label].color
 
         try:
-            Point = namedtuple("Point", ["x", "y"])
             polygon_scale = [Point(round(pol[0] / scale), round(pol[1] / scale)) for pol in polygon]
 
             # If polygon_scale does not contain at least 2 coordinates that polygon should not be drawn
@@ -305,10 +357,230 @@ def annot2labelImg(
         labelImg = labelImg.crop(scaled_crop_box)
 
     # moku上面角
-    pad = 624 - labelImg.height
+    pad = LABEL_IMG_HEIGHT - labelImg.height
     if pad > 0:
-        new_labelImg = Image.new(labelImg.mode, (labelImg.width, 624), background)
+        new_labelImg = Image.new(labelImg.mode, (labelImg.width, LABEL_IMG_HEIGHT), background)
         new_labelImg.paste(labelImg, (0, pad))
         labelImg = new_labelImg
 
     return labelImg
+
+
+def _crop_array(label_array, crop_box, fill):
+    # PIL.Image.cropと同じく(left, upper, right, lower)、範囲外はfillで埋める
+    left, upper, right, lower = crop_box
+    cropped = np.full((lower - upper, right - left) + label_array.shape[2:], fill, dtype=label_array.dtype)
+    src_top, src_left = max(upper, 0), max(left, 0)
+    src_bottom, src_right = min(lower, label_array.shape[0]), min(right, label_array.shape[1])
+    if src_bottom > src_top and src_right > src_left:
+        cropped[src_top - upper:src_bottom - upper, src_left - left:src_right - left] = \
+            label_array[src_top:src_bottom, src_left:src_right]
+    return cropped
+
+
+# Convert the given annotation to a label image (numpy/OpenCV版)
+def annot2labelArray(
+    annotation,
+    name2label,
+    encoding,
+    outline=None,
+    scale=1,
+    crop_box=(),
+    skip_ghost=False,
+    repl_invisible=False,
+    skip_road_marking=False,
+    label_lut=None,
+):
+    """annot2labelImgと同じラベル画像をnp.ndarrayで返す([H, W]、colorの場合[H, W, 4])
+    objectの順(z-order)にcv2.fillPolyで上書きする、label_lutはbuild_label_lutの結果を使い回す
+    """
+    if label_lut is None:
+        label_lut = build_label_lut(name2label, encoding)
+    if label_lut is None:
+        print("Unknown encoding '{}'".format(encoding))
+        return None
+
+    width = round((annotation.imgWidth / scale))
+    height = round((annotation.imgHeight / scale))
+
+    background = getattr(name2label["unlabeled"], _ENCODING_ATTR[encoding])
+    # colorの場合はパレットのindexを1chで描画して最後にRGBA(alphaは255)に変換する
+    palette = None
+    if encoding == "color":
+        palette = {tuple(background): 0}
+
+        def _pixel_value(value):
+            return palette.setdefault(tuple(value), len(palette))
+
+        label_array = np.zeros((height, width), dtype=np.uint16)
+    else:
+
+        def _pixel_value(value):
+            return value
+
+        label_array = np.full((height, width), background, dtype=np.uint8)
+    if outline is not None:
+        outline = _pixel_value(outline)
+
+    # 描画するobjectを先に決め、全polygonの座標変換をまとめて行う
+    draw_labels = []
+    polygons = []
+    for obj in annotation.objects:
+        label = _resolve_label(obj, annotation, name2label, skip_ghost, repl_invisible, skip_road_marking)
+        if label is None:
+            continue
+        # If the ID is negative that polygon should not be drawn
+        if label_lut[label] is None:
+            continue
+        if len(obj.polygon) == 0:
+            continue
+        draw_labels.append(label)
+        polygons.append(obj.polygon)
+
+    if polygons:
+        lengths = np.array([len(polygon) for polygon in polygons])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        points = np.array([point for polygon in polygons for point in polygon], dtype=np.float64)
+        points = np.rint(points / scale).astype(np.int32)
+        # If polygon_scale does not contain at least 2 coordinates that polygon should not be drawn
+        distinct = np.any(
+            np.maximum.reduceat(points, starts, axis=0) != np.minimum.reduceat(points, starts, axis=0), axis=1
+        )
+        for label, start, length, is_distinct in zip(draw_labels, starts, lengths, distinct):
+            if not is_distinct:
+                continue
+            try:
+                polygon = points[start:start + length].reshape(-1, 1, 2)
+                cv2.fillPoly(label_array, [polygon], _pixel_value(label_lut[label]))
+                if outline is not None:
+                    cv2.polylines(label_array, [polygon], True, outline)
+            except Exception as e:
+                print(f"Failed to draw polygon with label {label}, \n exception: {e}")
+
+    if crop_box:
+        scaled_crop_box = tuple(int(crop / scale) for crop in crop_box)
+        # PIL.Image.cropの範囲外は0(colorの場合は透明の黒)
+        label_array = _crop_array(label_array, scaled_crop_box, _pixel_value((0, 0, 0, 0)) if palette else 0)
+
+    # moku上面角
+    pad = LABEL_IMG_HEIGHT - label_array.shape[0]
+    if pad > 0:
+        padding = np.full((pad, label_array.shape[1]), _pixel_value(background), dtype=label_array.dtype)
+        label_array = np.concatenate([padding, label_array], axis=0)
+
+    if palette is not None:
+        colors = np.zeros((len(palette), 4), dtype=np.uint8)
+        for color, index in palette.items():
+            colors[index] = color + (255,) if len(color) == 3 else color
+        # RGBAを1つのuint32として引く
+        label_array = np.take(colors.view(np.uint32)[:, 0], label_array)
+        label_array = label_array.view(np.uint8).reshape(label_array.shape + (4,))
+
+    return label_array
+
+
+@lru_cache(maxsize=None)
+def _load_label_def(label, encoding):
+    # ラベル定義とテーブルはラベル定義毎に1回だけ読み込む
+    name2label = import_module("labels." + label).name2label
+    return name2label, build_label_lut(name2label, encoding)
+
+
+def _init_label_worker(label, encoding):
+    # ワーカー起動時にラベル定義とテーブルを読み込んでおく
+    _load_label_def(label, encoding)
+
+
+def _json2labelImg_file(args):
+    path, out_path, load_fn, label, encoding, kwargs = args
+    name2label, label_lut = _load_label_def(label, encoding)
+    annotation = load_fn(path)
+    label_array = annot2labelArray(annotation, name2label, encoding, label_lut=label_lut, **kwargs)
+    Image.fromarray(label_array).save(out_path)
+    return out_path
+
+
+def json2labelImgs(paths, load_fn, out_dir, label, encoding="trainIds", processes=None, **kwargs):
+    """アノテーションファイルをプロセスプールでラベル画像(png)に変換する
+    Args:
+        paths: アノテーションファイルのpathのlist
+        load_fn: pathからアノテーション(imgWidth/imgHeight/objects/AnnotationPattern)を読み込む関数、
+            ワーカーに渡すためpickle可能なモジュールレベルの関数にする
+        label: ラベル定義のモジュール名(labels.<label>)
+        processes: プロセス数(省略の場合cpu_count())
+        kwargs: annot2labelArrayの引数(skip_ghost等)
+    Returns:
+        出力したpngのpathのlist
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [
+        (
+            path,
+            os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + ".png"),
+            load_fn,
+            label,
+            encoding,
+            kwargs,
+        )
+        for path in paths
+    ]
+    processes = processes or cpu_count()
+    with Pool(processes, initializer=_init_label_worker, initargs=(label, encoding)) as pool:
+        out_paths = pool.map(_json2labelImg_file, jobs, chunksize=max(1, len(jobs) // (4 * processes)))
+    return out_paths
+
+
+def benchmark_annot2label(annotations, name2label, encoding="trainIds", **kwargs):
+    """annot2labelImg(PIL)とannot2labelArray(OpenCV)の速度(label images/sec)と画素の一致率を比較する"""
+    label_lut = build_label_lut(name2label, encoding)
+
+    start_time = time.time()
+    pil_images = [np.array(annot2labelImg(annotation, name2label, encoding, **kwargs)) for annotation in annotations]
+    pil_time = time.time() - start_time
+
+    start_time = time.time()
+    arrays = [annot2labelArray(annotation, name2label, encoding, label_lut=label_lut, **kwargs) for annotation in annotations]
+    array_time = time.time() - start_time
+
+    match = np.mean([np.mean(pil_image == array) for pil_image, array in zip(pil_images, arrays)])
+    results = {
+        "pil_images_per_sec": len(annotations) / max(pil_time, 1e-6),
+        "array_images_per_sec": len(annotations) / max(array_time, 1e-6),
+        "pixel_match": float(match),
+    }
+    print(
+        "PIL: {:.1f} images/sec, OpenCV: {:.1f} images/sec, pixel match {:.4%}".format(
+            results["pil_images_per_sec"], results["array_images_per_sec"], results["pixel_match"]
+        )
+    )
+    return results
+
+
+def benchmark_json2labelImgs(paths, load_fn, out_dir, label, encoding="trainIds", processes=None, **kwargs):
+    """読み込み~png保存までのend to endの速度(label images/sec)を比較する
+    1プロセスでannot2labelImg(PIL)を使う場合とjson2labelImgs(プロセスプール+OpenCV)
+    """
+    name2label, _ = _load_label_def(label, encoding)
+    single_dir = os.path.join(out_dir, "single")
+    os.makedirs(single_dir, exist_ok=True)
+
+    start_time = time.time()
+    for path in paths:
+        label_img = annot2labelImg(load_fn(path), name2label, encoding, **kwargs)
+        label_img.save(os.path.join(single_dir, os.path.splitext(os.path.basename(path))[0] + ".png"))
+    single_time = time.time() - start_time
+
+    start_time = time.time()
+    json2labelImgs(paths, load_fn, os.path.join(out_dir, "pool"), label, encoding, processes=processes, **kwargs)
+    pool_time = time.time() - start_time
+
+    results = {
+        "single_images_per_sec": len(paths) / max(single_time, 1e-6),
+        "pool_images_per_sec": len(paths) / max(pool_time, 1e-6),
+    }
+    print(
+        "single process PIL: {:.1f} images/sec, json2labelImgs: {:.1f} images/sec".format(
+            results["single_images_per_sec"], results["pool_images_per_sec"]
+        )
+    )
+    return results
@@ -1,9 +1,11 @@
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
 
 import numpy as np
 import tensorflow.compat.v1 as tf
-from tensorflow.keras.callbacks import ProgbarLogger
+from tensorflow.keras.utils import Progbar
 
 from datasets.decode import DatasetDecoder
 from datasets.decoder.dataaug_params import DataaugParamHolder
@@ -18,10 +20,14 @@ from postprocess import semaseg
 # 日语: スコア計算
 # 中文: 评分计算
 
-def _calculate_score(pred, label, ignore_label, num_classes):
-    conf = Utils.calculate_conf_matrix(pred, label, ignore_label, num_classes)
-    class_score = Utils.get_class_score(conf, num_classes)
-    return class_score, conf
+def _calc_conf_matrix_batch(pred, label, ignore_label, num_classes):
+    # batch分の混同行列(行: label、列: pred)をbincountで計算する、ignore_label/範囲外のlabel・predは除外
+    # 用bincount计算一个batch的混淆矩阵(行: label、列: pred)，排除ignore_label/范围外的label和pred
+    label = np.asarray(label, dtype=np.int64).reshape(-1)
+    pred = np.asarray(pred, dtype=np.int64).reshape(-1)
+    valid = (label != ignore_label) & (label >= 0) & (label < num_classes) & (pred >= 0) & (pred < num_classes)
+    conf = np.bincount(label[valid] * num_classes + pred[valid], minlength=num_classes * num_classes)
+    return conf.reshape(num_classes, num_classes)
 
 """
 ローカルpngへ画像出力
@@ -50,6 +56,66 @@ def _save_vis_to_img(out_dir, inputs, preds, cfg, Labels, filenames):
         Utils.flush_progress_bar("save image", (idx + 1) / len(inputs))
     print("")
 
+"""
+batch毎の可視化
+"""
+# 日语: batch毎の可視化
+# 中文: 每个batch的可视化
+
+def _save_vis_batch(cfg, out_dir, inputs, preds, labels, Labels, filenames):
+    if cfg["save_pred_img"]:
+        # tensorboardログ保存
+        if cfg["vis_vflip_images"]:
+            _inputs = image_utils.vertical_flip_image(inputs)
+            _preds = np.squeeze(image_utils.vertical_flip_image(preds[..., np.newaxis]), axis=-1)
+        else:
+            _inputs = inputs
+            _preds = preds
+
+        if cfg["save_tb"]:
+            _inputs = np.array([image_utils.scale_image(_input, scale_value=0.5, resize_method="nearest") for _input in _inputs])
+            _preds = np.squeeze([image_utils.scale_image(_pred[..., np.newaxis], scale_value=0.5, resize_method="nearest") for _pred in _preds], axis=-1)
+
+            Utils.save_annotations_to_tb(
+                _inputs,
+                _preds,
+                Labels,
+                "pred_image/",
+                filenames,
+                out_dir,
+                overlay_ratio=cfg["overlay_ratio"],
+                input_scale_values=True,
+                input_normalize_mode=cfg["model_mode"],
+            )
+        # png保存
+        else:
+            _save_vis_to_img(out_dir, _inputs, _preds, cfg, Labels, filenames)
+
+    if cfg["save_label_img"]:
+        # tensorboardログ保存
+        if cfg["vis_vflip_images"]:
+            _inputs = image_utils.vertical_flip_image(inputs)
+            _labels = np.squeeze(image_utils.vertical_flip_image(labels[..., np.newaxis]), axis=-1)
+        else:
+            _inputs = inputs
+            _labels = labels
+
+        if cfg["save_tb"]:
+            Utils.save_annotations_to_tb(
+                _inputs,
+                np.where(_labels == 255, 0, _labels),
+                Labels,
+                "label_image/",
+                filenames,
+                out_dir,
+                overlay_ratio=cfg["overlay_ratio"],
+                input_scale_values=True,
+                input_normalize_mode=cfg["model_mode"],
+            )
+        # png保存
+        else:
+            _save_vis_to_img(out_dir, _inputs, _labels, cfg, Labels, filenames)
+
 """
 eval
 """
@@ -110,11 +176,6 @@ def eval(cfg):
         use_condition_input=use_condition_input,
     )
 
-    if cfg["batch_size"] != 1:
-        cfg["batch_size"] = 1  # 未対応のためdetection以外のタスクはbatch sizeを1にする
-        # 日语: 未対応のためdetection以外のタスクはbatch sizeを1にする
-        # 中文: 由于不支持，将检测以外的任务的批次大小设为1
-
     dataset = decoder.get_data(
         cfg["task"],
         cfg["dataset_path"],
@@ -131,18 +192,7 @@ def eval(cfg):
     data_num = ds_info.splits[cfg["tfs_load_split_eval"]].num_examples
     if cfg["num_samples"] is not None:
         data_num = min(data_num, cfg["num_samples"])
-        dataset = dataset.unbatch().batch(cfg["batch_size"], drop_remainder=True)
-    dataset, inputs, labels, filenames = Utils.get_datasets(cfg["task"], dataset)
-
-    progbar = ProgbarLogger(count_mode="steps")
-
-    preds = sema_evaluator.predict(dataset, steps=len(labels) / cfg["batch_size"], verbose=1, callbacks=[progbar])
-
-    if concatenated:
-        preds = preds[:, :, :, :, task_idx]
-
-    labels = np.array(labels)
-    inputs = np.array(inputs)
+        dataset = dataset.unbatch().take(data_num).batch(cfg["batch_size"])
 
     # 特にcrop位置の指定忘れがぱば入力量のpaddingした部分をcrop
     # 日语: 特にcrop位置の指定忘れがぱば入力量のpaddingした部分をcrop
@@ -177,69 +227,58 @@ def eval(cfg):
     post_inputs = semaseg.Post(label_crop_box=label_crop_box, scale=cfg["pred_scaling"])
     post_labels = semaseg.Post(label_crop_box=label_crop_box, scale=cfg["pred_scaling"])
 
-    preds = post_preds.process(preds)
-    inputs = post_inputs.process(inputs)
-    labels = post_labels.process(labels)
-
-    if preds.shape != labels.shape:
-        raise ValueError
-
-    if cfg["save_pred_img"]:
-        # tensorboardログ保存
-        if cfg["vis_vflip_images"]:
-            _inputs = image_utils.vertical_flip_image(inputs)
-            _preds = np.squeeze(image_utils.vertical_flip_image(preds[..., np.newaxis]), axis=-1)
-        else:
-            _inputs = inputs
-            _preds = preds
-
-        if cfg["save_tb"]:
-            _inputs = np.array([image_utils.scale_image(_input, scale_value=0.5, resize_method="nearest") for _input in _inputs])
-            _preds = np.squeeze([image_utils.scale_image(_pred[..., np.newaxis], scale_value=0.5, resize_method="nearest") for _pred in _preds], axis=-1)
-
-            Utils.save_annotations_to_tb(
-                _inputs,
-                _preds,
-                Labels,
-                "pred_image/",
-                filenames,
-                out_dir,
-                overlay_ratio=cfg["overlay_ratio"],
-                input_scale_values=True,
-                input_normalize_mode=cfg["model_mode"],
+    ignore_label = cfg["dataset_map"][cfg["task"]]["preproc_func"]["args"]["ignore_label"]
+    num_classes = cfg["dataset_map"][cfg["task"]]["preproc_func"]["args"]["num_classes"]
+    conf_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    # 可視化は別スレッドで保存、未完了のbatchがvis_max_pendingを超えたら待つ
+    # 日语: 可視化は別スレッドで保存、未完了のbatchがvis_max_pendingを超えたら待つ
+    # 中文: 可视化在其他线程中保存，未完成的batch超过vis_max_pending时等待
+    vis_executor = ThreadPoolExecutor(max_workers=cfg.get("vis_workers", 1))
+    vis_futures = deque()
+    vis_max_pending = cfg.get("vis_max_pending", 4)
+
+    # batch毎に推論/後処理/混同行列の加算を行い、データ全体をメモリに持たない
+    # datasetの要素は(model_inputs, model_labels, metadata)
+    # 日语: batch毎に推論/後処理/混同行列の加算を行い、データ全体をメモリに持たない
+    # 中文: 每个batch进行推理/后处理/累加混淆矩阵，不在内存中保存全部数据
+    steps = int(np.ceil(data_num / cfg["batch_size"]))
+    progbar = Progbar(target=steps)
+    for step, (model_inputs, model_labels, metadata) in enumerate(dataset):
+        # predictはbatch毎にdataset/callbackを作り直すため、1batchだけ推論するpredict_on_batchを使う
+        # 日语: predictはbatch毎にdataset/callbackを作り直すため、1batchだけ推論するpredict_on_batchを使う
+        # 中文: predict每个batch都会重新创建dataset/callback，因此使用只推理一个batch的predict_on_batch
+        preds = np.asarray(sema_evaluator.predict_on_batch(model_inputs))
+        if concatenated:
+            preds = preds[:, :, :, :, task_idx]
+
+        inputs = model_inputs[0] if inputs_to_tuple else model_inputs[input_name]
+        preds = post_preds.process(preds)
+        inputs = post_inputs.process(np.asarray(inputs))
+        labels = post_labels.process(np.asarray(model_labels[cfg["task"]]))
+
+        if preds.shape != labels.shape:
+            raise ValueError
+
+        conf_matrix += _calc_conf_matrix_batch(preds, labels, ignore_label, num_classes)
+
+        if cfg["save_pred_img"] or cfg["save_label_img"]:
+            filenames = [
+                f.decode("utf-8") if isinstance(f, bytes) else str(f) for f in np.asarray(metadata["filename"])
+            ]
+            while len(vis_futures) >= vis_max_pending:
+                vis_futures.popleft().result()
+            vis_futures.append(
+                vis_executor.submit(_save_vis_batch, cfg, out_dir, inputs, preds, labels, Labels, filenames)
             )
-        # png保存
-        else:
-            _save_vis_to_img(out_dir, _inputs, _preds, cfg, Labels, filenames)
-
-    if cfg["save_label_img"]:
-        # tensorboardログ保存
-        if cfg["vis_vflip_images"]:
-            _inputs = image_utils.vertical_flip_image(inputs)
-            _labels = np.squeeze(image_utils.vertical_flip_image(labels[..., np.newaxis]), axis=-1)
-        else:
-            _inputs = inputs
-            _labels = labels
+        progbar.update(step + 1)
 
-        if cfg["save_tb"]:
-            Utils.save_annotations_to_tb(
-                _inputs,
-                np.where(_labels == 255, 0, _labels),
-                Labels,
-                "label_image/",
-                filenames,
-                out_dir,
-                overlay_ratio=cfg["overlay_ratio"],
-                input_scale_values=True,
-                input_normalize_mode=cfg["model_mode"],
-            )
-        # png保存
-        else:
-            _save_vis_to_img(out_dir, _inputs, labels, cfg, Labels, filenames)
+    # 保存中の例外はここで送出される
+    while vis_futures:
+        vis_futures.popleft().result()
+    vis_executor.shutdown()
 
-    ignore_label = cfg["dataset_map"][cfg["task"]]["preproc_func"]["args"]["ignore_label"]
-    num_classes = cfg["dataset_map"][cfg["task"]]["preproc_func"]["args"]["num_classes"]
-    class_score, conf_matrix = _calculate_score(preds, labels, ignore_label, num_classes)
+    class_score = Utils.get_class_score(conf_matrix, num_classes)
 
     Utils.print_iou(class_score[0])
 
@@ -248,3 +287,4 @@ def eval(cfg):
     else:
         Utils.save_score_data(os.path.join(out_dir, "score.csv"), Utils.get_classname_list(Labels), class_score)
 
+    return class_score, conf_matrix
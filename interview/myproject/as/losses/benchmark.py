@@ -0,0 +1,54 @@
+import time
+
+import tensorflow.compat.v1 as tf
+
+from .losses import SparseWeightedCategoricalCrossentropy, WeightedCategoricalCrossentropy
+
+
+def compare_categorical_crossentropy(y_true, y_logit, num_iters=10, **kwargs):
+    """WeightedCategoricalCrossentropyとSparseWeightedCategoricalCrossentropyの結果/時間/メモリを比較する
+    (比较WeightedCategoricalCrossentropy和SparseWeightedCategoricalCrossentropy的结果/时间/内存)
+    メモリはGPUのpeak(GPUがない場合は0)、時間はforward+backwardの1batch当たり(tf.functionのtrace後に計測)
+    CPUの時間は入力サイズによってはsparse版の方が遅い、省メモリの効果はGPUのpeakメモリで判断する
+    """
+    results = dict()
+    losses = dict()
+    for name, loss_class in [
+        ("dense", WeightedCategoricalCrossentropy),
+        ("sparse", SparseWeightedCategoricalCrossentropy),
+    ]:
+        loss_obj = loss_class(**kwargs)
+        logit = tf.Variable(y_logit)
+
+        @tf.function
+        def step():
+            with tf.GradientTape() as tape:
+                loss = loss_obj(y_true, logit)
+            return loss, tape.gradient(loss, logit)
+
+        use_gpu = bool(tf.config.list_physical_devices("GPU"))
+        losses[name] = loss_obj.call(y_true, logit)
+        # 1回目はtf.functionのtraceを含むので計測前に実行しておく
+        # 第一次调用包含tf.function的trace，所以在计时前先执行一次
+        _ = step()[1].numpy()
+        if use_gpu:
+            tf.config.experimental.reset_memory_stats("GPU:0")
+        start_time = time.time()
+        for _ in range(num_iters):
+            loss, grad = step()
+        _ = grad.numpy()
+        elapsed = (time.time() - start_time) / num_iters
+        peak_mb = tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2 ** 20 if use_gpu else 0.0
+        results[name] = {"loss": float(loss), "ms_per_batch": elapsed * 1000, "peak_mem_mb": peak_mb}
+
+    results["max_abs_diff"] = float(tf.reduce_max(tf.abs(losses["dense"] - losses["sparse"])))
+    print(
+        "dense: {:.2f} ms/batch, {:.1f} MB / sparse: {:.2f} ms/batch, {:.1f} MB / max abs diff {:.3g}".format(
+            results["dense"]["ms_per_batch"],
+            results["dense"]["peak_mem_mb"],
+            results["sparse"]["ms_per_batch"],
+            results["sparse"]["peak_mem_mb"],
+            results["max_abs_diff"],
+        )
+    )
+    return results
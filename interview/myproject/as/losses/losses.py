@@ -8,6 +8,7 @@ from . import yolo_loss
 def name_to_class(name):
     LOSS_TBL = {
         "weighted_categorical_crossentropy": WeightedCategoricalCrossentropy,
+        "sparse_weighted_categorical_crossentropy": SparseWeightedCategoricalCrossentropy,
         "weighted_binary_crossentropy": WeightedBinaryCrossentropy,
         "weighted_evidential_loss": WeightedEvidentialLoss,
         "categorical_crossentropy": tf_losses.categorical_crossentropy,
@@ -74,6 +75,13 @@ class LossBase(tf.keras.losses.Loss):
         })
         return config
     
+    def get_class_weights(self, num_classes):
+        # get_weightsと同じ値のクラス毎の重み(ignore_label以外は1.0 + balancing_weight)
+        # 与get_weights数值相同的每个类别的权重(ignore_label以外为1.0 + balancing_weight)
+        balancing_weight = tf.constant([float(w) for w in self.balancing_weight], dtype=tf.float32)
+        pad_size = tf.maximum(num_classes - len(self.balancing_weight), 0)
+        return 1.0 + tf.pad(balancing_weight, [[0, pad_size]])[:num_classes]
+
     @staticmethod
     def get_one_hot(y_true, num_classes):
         y_true_one_hot = tf.squeeze(y_true)
@@ -98,6 +106,37 @@ class WeightedCategoricalCrossentropy(LossBase):
         loss = -K.sum(loss, -1)
         return loss
 
+# 重み付きCrossEntropy(sparse label版)
+# one-hot/softmax/クラス毎のtf.equalを作らず、log-softmaxのtarget要素と重みのtf.gatherだけで計算する
+# mixed_float16でもlogitはfloat32にcastして計算、結果はWeightedCategoricalCrossentropyと同じ
+class SparseWeightedCategoricalCrossentropy(LossBase):
+    def __init__(self, **kwargs):
+        super(SparseWeightedCategoricalCrossentropy, self).__init__(**kwargs)
+
+    def call(self, y_true, y_logit):
+        y_logit = tf.cast(y_logit, tf.float32)
+        num_classes = tf.shape(y_logit)[-1]
+        labels = tf.to_int32(y_true)
+        if y_true.shape.rank == y_logit.shape.rank:
+            labels = labels[..., 0]
+        # ignore_label/範囲外のlabelは重み0(sparse_softmax_cross_entropyは範囲外のlabelでNaN/エラーになる)
+        # ignore_label/范围外的label权重为0(sparse_softmax_cross_entropy遇到范围外的label会NaN/报错)
+        valid = tf.logical_and(
+            tf.not_equal(labels, self.ignore_label),
+            tf.logical_and(labels >= 0, labels < num_classes),
+        )
+        safe_labels = tf.where(valid, labels, tf.zeros_like(labels))
+
+        # -log_softmax[target]、WeightedCategoricalCrossentropyのclipと同じ範囲に収める
+        # -log_softmax[target]，限制在与WeightedCategoricalCrossentropy的clip相同的范围
+        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=safe_labels, logits=y_logit)
+        loss = tf.clip_by_value(loss, -tf.log(1.0 - K.epsilon()), -tf.log(K.epsilon()))
+
+        weights = tf.gather(self.get_class_weights(num_classes), safe_labels)
+        weights = tf.where(valid, weights, tf.zeros_like(weights))
+        return loss * weights
+
+
 # 重み付きBinaryCrossEntropy
 class WeightedBinaryCrossentropy(LossBase):
     def __init__(self, **kwargs):
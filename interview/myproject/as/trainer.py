@@ -154,6 +154,8 @@ def _get_dataset(cfg, outputs):
     (获取train和val数据集生成数据)
     フルスクラッチ学習時にメモリエラーが起きるため、デフォルトはuse_cache=Falseにする
     (由于在全新训练时可能会发生内存错误，默认设置为use_cache=False)
+    pre_decoded_cache_dir指定時はDA前までの処理済みデータをファイルにキャッシュする
+    (指定pre_decoded_cache_dir时将DA之前的处理结果缓存到文件)
     """
     decoder = DatasetDecoder(cfg, outputs, cfg["dataset_path"], normalize_mode="training", for_training_label=True)
 
@@ -166,6 +168,7 @@ def _get_dataset(cfg, outputs):
         repeat=True,
         use_cache=False,
         with_split_info=True,
+        pre_decoded_cache_dir=cfg.get("pre_decoded_cache_dir", None),
     )
 
     val_dataset, val_split_info = decoder.get_data(
@@ -177,6 +180,7 @@ def _get_dataset(cfg, outputs):
         repeat=True,
         use_cache=False,
         with_split_info=True,
+        pre_decoded_cache_dir=cfg.get("pre_decoded_cache_dir", None),
     )
 
     train_example_num = train_split_info.num_examples